@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import hdb.hdbdownload
+from hdb import asyncfetch, throttle
+
+# drives the crawl stages against the local stand-in server (fakehdb.py) and reports the request rate,
+# CPU time and peak memory of each stage (or of the pipelined crawl, all stages at once)
+
+
+def _start_server(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakehdb.py'),
+               '--port', '0', '--buildings', str(args.buildings), '--latency', str(args.latency),
+               '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+               '--max-concurrency', str(args.max_concurrency), '--rate-limit', str(args.server_rate_limit)]
+    if args.replay_cache:
+        command += ['--replay-cache', args.replay_cache]
+
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    # first line: listening on <url>
+    server_url = server.stdout.readline().split()[-1]
+    return server, server_url
+
+
+def _server_stats(server_url):
+    with urllib.request.urlopen(server_url + '/__stats') as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def _cpu_seconds():
+    # parser processes are counted once reaped, the server process only exits at the end
+    own_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own_usage.ru_utime + own_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the crawl stages against a local fake HDB server.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--buildings', type=int, help='highest building id served', default=2000)
+    parser.add_argument('--latency', type=float, help='server response latency in seconds', default=0.01)
+    parser.add_argument('--jitter', type=float, help='random extra server latency in seconds, up to', default=0.01)
+    parser.add_argument('--error-rate', type=float, help='share of requests answered with HTTP 500', default=0.)
+    parser.add_argument('--max-concurrency', type=int, help='server concurrency before HTTP 429 (0: no limit)',
+                        default=0)
+    parser.add_argument('--server-rate-limit', type=float, help='server requests per second before HTTP 429 '
+                                                                '(0: no limit)', default=0.)
+    parser.add_argument('--replay-cache', help='url cache whose recorded responses the server replays')
+    parser.add_argument('--ntasks', type=int, help='number of simultaneous downloads', default=40)
+    parser.add_argument('--nparsers', type=int, help='number of parser processes', default=0)
+    parser.add_argument('--engine', choices=['threads', 'async'], help='download engine', default='threads')
+    parser.add_argument('--adaptive', help='adaptive concurrency per endpoint', action='store_true')
+    parser.add_argument('--rate-limit', type=float, help='client max requests per second on each endpoint')
+    parser.add_argument('--skip-ethnic', help='skips the ethnic data stage (12 requests per postal code)',
+                        action='store_true')
+    parser.add_argument('--pipelined', help='runs the buildings, units, leases and ethnic stages as one pipelined '
+                                            'stage', action='store_true')
+    parser.add_argument('--output-format', choices=['xlsx', 'csv', 'parquet'], help='output file format',
+                        default='xlsx')
+    parser.add_argument('--json', help='also writes the results to this JSON file')
+    args = parser.parse_args()
+
+    server, server_url = _start_server(args)
+    work_dir = tempfile.mkdtemp(prefix='hdb-bench-')
+    data_dir = os.path.join(work_dir, 'data') + '/'
+    results = list()
+    try:
+        hdb.hdbdownload.set_data_dir(data_dir)
+        hdb.hdbdownload.set_hdb_url(server_url)
+        hdb.hdbdownload.set_pool_size(args.ntasks)
+        hdb.hdbdownload.set_parse_workers(args.nparsers)
+        hdb.hdbdownload.set_engine(args.engine)
+        throttle.set_rate_limit(args.rate_limit)
+        if args.adaptive:
+            throttle.set_adaptive_concurrency(args.ntasks)
+
+        output_file = 'hdb.' + args.output_format
+        stages = [
+            ('buildings', lambda: hdb.hdbdownload.generate_buildings_db(args.buildings)),
+            ('units', hdb.hdbdownload.generate_units_db),
+            ('leases', hdb.hdbdownload.generate_leases_db),
+            ('ethnic', lambda: hdb.hdbdownload.generate_ethnic_db(os.path.join(work_dir, 'ethnic.' +
+                                                                               args.output_format))),
+            ('excel', lambda: hdb.hdbdownload.generate_excel(data_dir, work_dir + '/', output_file)),
+        ]
+        if args.skip_ethnic:
+            stages = [stage for stage in stages if stage[0] != 'ethnic']
+
+        if args.pipelined:
+            # the same fetches as one DAG on the shared worker budget
+            ethnic_path = None if args.skip_ethnic else os.path.join(work_dir, 'ethnic.' + args.output_format)
+            stages = [('pipelined', lambda: hdb.hdbdownload.generate_pipelined_dbs(
+                args.buildings, ethnic_output_path=ethnic_path))] + stages[-1:]
+
+        print('%-10s %9s %9s %10s %9s %9s %9s %13s' % ('stage', 'wall s', 'requests', 'req/s', 'errors',
+                                                       'throttled', 'cpu s', 'peak rss MB'))
+        for name, stage_function in stages:
+            stats_before = _server_stats(server_url)
+            cpu_before = _cpu_seconds()
+            start = time.monotonic()
+            stage_function()
+            elapsed = time.monotonic() - start
+            cpu_seconds = _cpu_seconds() - cpu_before
+            stats_after = _server_stats(server_url)
+            deltas = dict((counter, stats_after.get(counter, 0) - stats_before.get(counter, 0))
+                          for counter in ('requests', 'errors', 'throttled'))
+            # the stats requests themselves are not counted by the server
+            result = {
+                'stage': name,
+                'wall_seconds': elapsed,
+                'requests': deltas['requests'],
+                'requests_per_second': deltas['requests'] / elapsed,
+                'errors': deltas['errors'],
+                'throttled': deltas['throttled'],
+                'cpu_seconds': cpu_seconds,
+                'peak_rss_mb': _peak_rss_mb(),
+            }
+            results.append(result)
+            print('%-10s %9.2f %9d %10.1f %9d %9d %9.2f %13.1f' % (
+                name, elapsed, result['requests'], result['requests_per_second'], result['errors'],
+                result['throttled'], cpu_seconds, result['peak_rss_mb']))
+
+        asyncfetch.close()
+
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'arguments': vars(args), 'stages': results}, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import csv
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy
+import pandas
+
+from hdb import hdbdownload, stores
+
+# row-wise export from the CSV files as done by generate_excel before vectorization, kept as the reference
+
+
+def apply_build_export_frame(data_dir):
+    buildings_df = pandas.read_csv(data_dir + 'buildings-db.csv').drop_duplicates()
+    leases_df = pandas.read_csv(data_dir + 'leases-db.csv').drop_duplicates()
+    units_df = pandas.read_csv(data_dir + 'units-db.csv').drop_duplicates()
+    units_pivot_df = units_df.pivot(index='postal_code', columns='room_type', values='room_count')
+    buildings_enhanced_df = buildings_df.join(units_pivot_df, on='postal_code')
+    final_df = buildings_enhanced_df.join(leases_df.set_index('postal_code', inplace=False), on='postal_code')
+
+    def make_address(row):
+        return '{number} {street}'.format(number=row['number'], street=row['street'])
+
+    final_df['Short Address'] = final_df.apply(make_address, axis=1)
+    final_df['Postal Code'] = final_df['postal_code']
+    final_df['Lease Date'] = final_df['lease_commenced']
+
+    def extract_year(row):
+        if not pandas.isnull(row['lease_commenced']):
+            return row['lease_commenced'][-4:]
+
+        else:
+            return numpy.nan
+
+    final_df['Lease Year'] = final_df.apply(extract_year, axis=1)
+    final_df['Lease Duration'] = final_df['lease_period']
+    return final_df[hdbdownload._EXPORT_COLUMNS].sort_values(by='Postal Code')
+
+
+def apply_write_xlsx(export_df, full_path):
+    with pandas.ExcelWriter(full_path, engine='xlsxwriter') as writer:
+        export_df.to_excel(writer, index=False)
+
+
+def generate_dataset(data_dir, buildings, rng):
+    # several blocks share a postal code, some postal codes have no lease record,
+    # postal codes starting with 0 check that leading zeros are preserved
+    postal_codes = ['%06d' % code for code in rng.sample(range(10000, 830000), buildings // 3)]
+    with open(os.path.join(data_dir, 'buildings-db.csv'), 'w', newline='') as buildings_file:
+        writer = csv.writer(buildings_file)
+        writer.writerow(['building', 'number', 'street', 'postal_code'])
+        for building_id in range(1, buildings + 1):
+            writer.writerow([building_id, '%d%s' % (rng.randint(1, 999), rng.choice(['', 'A', 'B'])),
+                             'ANG MO KIO AVE %d' % rng.randint(1, 10), rng.choice(postal_codes)])
+
+    with open(os.path.join(data_dir, 'units-db.csv'), 'w', newline='') as units_file:
+        writer = csv.writer(units_file)
+        writer.writerow(['postal_code', 'room_type', 'room_count'])
+        for position, postal_code in enumerate(postal_codes):
+            # the former code fails when a room type is missing from the data: the first postal code has all
+            room_types = stores.ROOM_TYPES if position == 0 else rng.sample(stores.ROOM_TYPES,
+                                                                                   rng.randint(1, 4))
+            for room_type in room_types:
+                writer.writerow([postal_code, room_type, rng.randint(1, 200)])
+
+    with open(os.path.join(data_dir, 'leases-db.csv'), 'w', newline='') as leases_file:
+        writer = csv.writer(leases_file)
+        writer.writerow(['postal_code', 'lease_commenced', 'lease_remaining', 'lease_period'])
+        for postal_code in postal_codes:
+            if rng.random() < 0.9:
+                writer.writerow([postal_code, '01/%02d/19%02d' % (rng.randint(1, 12), rng.randint(60, 99)),
+                                 '%d years' % rng.randint(40, 99), '99 years'])
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the vectorized export with the former row-wise export.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--buildings', type=int, help='number of synthetic buildings', default=100000)
+    parser.add_argument('--skip-xlsx', help='skips the (slow) Excel writers', action='store_true')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='bench-excel-')
+    try:
+        data_dir = work_dir + os.sep
+        generate_dataset(data_dir, args.buildings, random.Random(42))
+        apply_time, apply_df = timed(apply_build_export_frame, data_dir)
+        # the CSV files are imported once into the typed columnar stores read by the export
+        import_time, _ = timed(lambda: [stores.open_store(data_dir, name) for name in stores.SCHEMAS])
+        vectorized_time, export_df = timed(hdbdownload.build_export_frame, data_dir)
+        if len(apply_df) != len(export_df):
+            raise AssertionError('exports disagree on row count')
+
+        lost_zeros = (export_df['Postal Code'].str.len() != 6).sum()
+        print('%d buildings, %d export rows, %d postal codes with lost leading zeros (former export: %d)' % (
+            args.buildings, len(export_df), lost_zeros, (apply_df['Postal Code'].astype(str).str.len() != 6).sum()))
+        print('%-28s %10s' % ('step', 'seconds'))
+        print('%-28s %10.2f' % ('build frame (row-wise)', apply_time))
+        print('%-28s %10.2f' % ('import CSV to column stores', import_time))
+        print('%-28s %10.2f' % ('build frame (vectorized)', vectorized_time))
+        writers = [('csv', lambda path: hdbdownload.write_export(export_df, path, 'csv')),
+                   ('parquet', lambda path: hdbdownload.write_export(export_df, path, 'parquet'))]
+        if not args.skip_xlsx:
+            writers.append(('xlsx (pandas.to_excel)', lambda path: apply_write_xlsx(export_df, path)))
+            writers.append(('xlsx (constant_memory)', lambda path: hdbdownload.write_export(export_df, path, 'xlsx')))
+
+        for name, writer in writers:
+            path = os.path.join(work_dir, 'export.' + name.split()[0])
+            write_time, _ = timed(writer, path)
+            print('%-28s %10.2f %8.1f MB' % ('write ' + name, write_time, os.path.getsize(path) / 1e6))
+
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
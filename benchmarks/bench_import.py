@@ -0,0 +1,67 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# import time of each command line path (python -X importtime), checked against a budget: each path should
+# only load what it uses (no pandas for --help or cache-stats, no HTTP stack to generate outputs)
+
+# name, modules imported, budget in milliseconds
+_SCENARIOS = [
+    ('import hdb', ['hdb'], 20),
+    ('--help', ['hdb.cli'], 50),
+    ('cache-stats', ['hdb.cli', 'hdb.urlcaching'], 150),
+    ('export', ['hdb.cli', 'hdb.hdbdownload', 'pandas'], 1200),
+    ('crawl', ['hdb.cli', 'hdb.hdbdownload', 'hdb.urlcaching', 'hdb.asyncfetch'], 500),
+]
+
+
+def _import_report(modules):
+    # (name, nesting level, self microseconds, cumulative microseconds) of each import
+    environment = dict(os.environ)
+    source_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [source_dir, environment.get('PYTHONPATH')]))
+    command = [sys.executable, '-X', 'importtime', '-c', 'import %s' % ', '.join(modules) if modules else 'pass']
+    report = subprocess.run(command, stderr=subprocess.PIPE, universal_newlines=True, env=environment,
+                            check=True).stderr
+    entries = list()
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((name.strip(), level, int(self_time), int(cumulative)))
+
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of each command line path against its budget.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--repeat', type=int, help='runs per path (best is reported)', default=5)
+    parser.add_argument('--top', type=int, help='heaviest modules listed per path', default=0)
+    args = parser.parse_args()
+    # modules imported by the interpreter itself (site, encodings...) are not counted
+    startup_modules = set(name for name, _, _, _ in _import_report([]))
+    over_budget = list()
+    print('%-12s %10s %10s' % ('path', 'import ms', 'budget ms'))
+    for name, modules, budget in _SCENARIOS:
+        reports = [[entry for entry in _import_report(modules) if entry[0] not in startup_modules]
+                   for _ in range(args.repeat)]
+        totals = [sum(cumulative for _, level, _, cumulative in report if level == 0) for report in reports]
+        best = min(totals) / 1000.
+        print('%-12s %10.1f %10d%s' % (name, best, budget, '  OVER BUDGET' if best > budget else ''))
+        if best > budget:
+            over_budget.append(name)
+
+        heaviest = sorted(reports[totals.index(min(totals))], key=lambda entry: entry[2], reverse=True)
+        for module, _, self_time, _ in heaviest[:args.top]:
+            print('    %8.1f ms  %s' % (self_time / 1000., module))
+
+    if over_budget:
+        raise SystemExit('over budget: %s' % ', '.join(over_budget))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import argparse
+import collections
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas
+
+import fakehdb
+from hdb import hdbdownload, stores, xmlparse
+from hdb.columnstore import ColumnStore
+
+# memory of the record path of a crawl, offline: synthetic responses for every building and postal code are
+# parsed and written to the stores, and the ethnic quotas of all the postal codes are kept until their output
+# is written; the record types and column accumulators are compared with the former rows (lists, tuples and
+# dicts, buffered as lists of tuples). Each variant runs in its own process, once under tracemalloc (peak
+# traced memory, blocks still allocated once all the quotas are accumulated) and once without (peak RSS, time)
+
+
+class _TupleBufferStore(ColumnStore):
+    # the former buffering: appended rows kept as a list of tuples until the flush
+
+    def append(self, rows, key=None):
+        self._tuples = getattr(self, '_tuples', list())
+        self._tuples.extend(rows)
+        if key is not None:
+            self._keys.append(key)
+
+        if len(self._tuples) >= self._flush_rows:
+            return self.flush()
+
+        return list()
+
+    def flush(self):
+        tuples = getattr(self, '_tuples', list())
+        if tuples:
+            self._write_part(self._table(tuples))
+
+        keys = self._keys
+        self._tuples = list()
+        self._keys = list()
+        return keys
+
+
+def _former_parse_ethnic_data(postal_code, ethnic_code, citizenship_code, xml_text):
+    seller_results, buyer_results, buyer_results_comment = xmlparse.parse_ethnic_result(xml_text)
+    return {
+        'postal_code': postal_code,
+        'ethnic': hdbdownload._ETHNIC_CODES[ethnic_code],
+        'citizenship': hdbdownload._CITIZENSHIPS[citizenship_code],
+        'seller': seller_results,
+        'buyer': buyer_results,
+        'buyer_results_comment': buyer_results_comment,
+    }
+
+
+def _former_merge_ethnic_results(postal_code_rows):
+    merged = collections.OrderedDict()
+    for row in postal_code_rows:
+        key = (row['postal_code'], row['citizenship'], row['ethnic'])
+        if row['seller'] == '':
+            merged.setdefault(key, dict())
+            merged[key]['buyer'] = row['buyer']
+            merged[key]['buyer_results_comment'] = row['buyer_results_comment']
+
+        if row['buyer'] == '':
+            merged.setdefault(key, dict())
+            merged[key]['seller'] = row['seller']
+
+    return [key + (values.get('seller'), values.get('buyer'), values.get('buyer_results_comment'))
+            for key, values in merged.items()]
+
+
+def _former_write_ethnic_db(rows, output_path):
+    merged_df = pandas.DataFrame.from_records(rows, columns=hdbdownload._ETHNIC_COLUMNS)
+    merged_df = merged_df.sort_values(by=['postal_code', 'citizenship', 'ethnic'], kind='stable')
+    hdbdownload.write_export(merged_df, output_path, 'csv')
+
+
+def _postal_codes(buildings):
+    return sorted(set(fakehdb._postal_code(building_id) for building_id in range(1, buildings + 1)))
+
+
+def _ethnic_documents(postal_code):
+    return [fakehdb.ethnic_document(enquiry, postal_code, ethnic_code, hdbdownload._CITIZENSHIPS[citizenship])
+            for enquiry, ethnic_code, citizenship in hdbdownload._ethnic_queries()]
+
+
+def run_variant(variant, buildings, work_dir, on_accumulated):
+    data_dir = os.path.join(work_dir, variant) + os.sep
+    store_class = _TupleBufferStore if variant == 'former' else ColumnStore
+    column_stores = dict((name, store_class(data_dir + name, stores.SCHEMAS[name]))
+                         for name in ('buildings-db', 'units-db', 'leases-db'))
+    for building_id in range(1, buildings + 1):
+        xml_text = fakehdb.prop_info_document(building_id, buildings, 0.1)
+        if variant == 'former':
+            prop_info = xmlparse.parse_prop_info(xml_text)
+            result = [building_id] + list(prop_info) if prop_info else None
+            column_stores['buildings-db'].append([tuple(result)] if result is not None else [], building_id)
+
+        else:
+            result = hdbdownload._parse_building(building_id, xml_text)
+            column_stores['buildings-db'].append([result] if result is not None else [], building_id)
+
+    postal_codes = _postal_codes(buildings)
+    for postal_code in postal_codes:
+        # the parsers return plain tuples in the former variant
+        units = xmlparse.parse_residential_units(postal_code, fakehdb.units_document(postal_code))
+        lease = xmlparse.parse_lease_data(postal_code, fakehdb.lease_document(postal_code, 0))
+        if variant == 'former':
+            units = [tuple(unit) for unit in units]
+            lease = tuple(lease)
+
+        column_stores['units-db'].append(units, postal_code)
+        column_stores['leases-db'].append([lease], postal_code)
+
+    for store in column_stores.values():
+        store.flush()
+
+    if variant == 'former':
+        rows = list()
+        for postal_code in postal_codes:
+            results = [_former_parse_ethnic_data(postal_code, ethnic_code, citizenship_code, xml_text)
+                       for (_, ethnic_code, citizenship_code), xml_text in zip(hdbdownload._ethnic_queries(),
+                                                                                _ethnic_documents(postal_code))]
+            rows.extend(_former_merge_ethnic_results(results))
+
+        on_accumulated()
+        _former_write_ethnic_db(rows, os.path.join(work_dir, 'ethnic-former.csv'))
+
+    else:
+        rows = hdbdownload._ethnic_accumulator()
+        for postal_code in postal_codes:
+            rows.extend(hdbdownload._merge_ethnic_results(
+                hdbdownload._parse_ethnic_results(postal_code, _ethnic_documents(postal_code))))
+
+        on_accumulated()
+        hdbdownload._write_ethnic_db(rows, os.path.join(work_dir, 'ethnic-records.csv'), 'csv')
+
+    return len(postal_codes)
+
+
+def _measure(variant, buildings, traced):
+    # runs in the child process
+    work_dir = tempfile.mkdtemp(prefix='bench-memory-')
+    result = dict()
+    try:
+        if traced:
+            tracemalloc.start()
+
+        def on_accumulated():
+            if traced:
+                snapshot = tracemalloc.take_snapshot()
+                result['accumulated_blocks'] = sum(statistic.count for statistic in snapshot.statistics('filename'))
+                result['accumulated_mb'] = tracemalloc.get_traced_memory()[0] / 1e6
+
+        start = time.perf_counter()
+        result['postal_codes'] = run_variant(variant, buildings, work_dir, on_accumulated)
+        result['seconds'] = time.perf_counter() - start
+        if traced:
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+
+        else:
+            # ru_maxrss is in kB on Linux
+            result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(json.dumps(result))
+
+
+def _run_child(variant, buildings, traced):
+    command = [sys.executable, os.path.abspath(__file__), '--buildings', str(buildings), '--variant', variant]
+    if traced:
+        command.append('--traced')
+
+    output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory of the record path of a crawl: record types and column '
+                                                 'accumulators against the former rows.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--buildings', type=int, help='number of synthetic buildings (about 13k for the whole '
+                                                      'island)', default=13000)
+    parser.add_argument('--variant', choices=['former', 'records'], help=argparse.SUPPRESS)
+    parser.add_argument('--traced', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.variant:
+        _measure(args.variant, args.buildings, args.traced)
+        return
+
+    results = dict()
+    for variant in ('former', 'records'):
+        results[variant] = _run_child(variant, args.buildings, traced=True)
+        results[variant].update(_run_child(variant, args.buildings, traced=False))
+
+    print('%d buildings, %d postal codes' % (args.buildings, results['former']['postal_codes']))
+    print('%-8s %14s %18s %16s %14s %10s' % ('variant', 'traced peak MB', 'accumulated blocks', 'accumulated MB',
+                                             'peak RSS MB', 'seconds'))
+    for variant in ('former', 'records'):
+        result = results[variant]
+        print('%-8s %14.1f %18d %16.1f %14.1f %10.2f' % (variant, result['peak_mb'], result['accumulated_blocks'],
+                                                         result['accumulated_mb'], result['peak_rss_mb'],
+                                                         result['seconds']))
+
+if __name__ == '__main__':
+    main()
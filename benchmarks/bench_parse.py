@@ -0,0 +1,149 @@
+import argparse
+import random
+import timeit
+
+from bs4 import BeautifulSoup
+
+from hdb import xmlparse
+
+# BeautifulSoup parsers as used by the loaders before the lxml parsing layer, kept as the reference
+
+
+def soup_parse_prop_info(xml_text):
+    xml = BeautifulSoup(xml_text, 'xml')
+    block_tag = xml.find('Block')
+    if not block_tag or not block_tag.contents:
+        return None
+
+    block = block_tag.contents[0].strip()
+    street_name = xml.find('StreetName').contents[0].strip()
+    postal_code = xml.find('PostalCode').contents[0].strip()
+
+    return block, street_name, postal_code
+
+
+def soup_parse_residential_units(postal_code, xml_text):
+    xml = BeautifulSoup(xml_text, 'xml')
+    unit_data = list()
+    for unit in xml.find_all('ResidentUnit'):
+        room_type = ''
+        room_count = 0
+        if unit.find_next('actUseTypTxt').contents:
+            room_type = unit.find_next('actUseTypTxt').contents[0].strip()
+
+        if unit.find_next('count').contents:
+            # the counts are typed by the parsers since the column stores
+            room_count = int(unit.find_next('count').contents[0].strip())
+
+        unit_data.append((postal_code, room_type, room_count))
+
+    return unit_data
+
+
+def soup_parse_lease_data(postal_code, xml_text):
+    xml = BeautifulSoup(xml_text, 'xml')
+    lease_info = xml.find('LeaseInformation')
+
+    lease_commenced = ''
+    if lease_info.find('LeaseCommencedDate'):
+        lease_commenced = lease_info.find_next('LeaseCommencedDate').contents[0].strip()
+
+    lease_remaining = ''
+    if lease_info.find('LeaseRemaining'):
+        lease_remaining = lease_info.find_next('LeaseRemaining').contents[0].strip()
+
+    lease_period = ''
+    if lease_info.find('LeasePeriod'):
+        lease_period = lease_info.find_next('LeasePeriod').contents[0].strip()
+
+    return postal_code, lease_commenced, lease_remaining, lease_period
+
+
+def _extract_tag_content(xml, tag_name):
+    tag = xml.find(tag_name)
+    if tag and tag.contents:
+        return tag.contents[0].strip()
+
+    else:
+        return ''
+
+
+def soup_parse_ethnic_result(xml_text):
+    xml = BeautifulSoup(xml_text, 'xml')
+    seller_results = _extract_tag_content(xml, 'sellerResults')
+    buyer_results_comment = _extract_tag_content(xml, 'buyerResultsTableHeading2')
+    buyer_results = _extract_tag_content(xml, 'buyerResults')
+    return seller_results, buyer_results, buyer_results_comment
+
+
+def _prop_info_document(building_id, rng):
+    if rng.random() < 0.3:
+        return '<?xml version="1.0" encoding="UTF-8"?><PropInfo><Block></Block></PropInfo>'
+
+    return ('<?xml version="1.0" encoding="UTF-8"?><PropInfo><Building><Block> %dA </Block>'
+            '<StreetName> ANG MO KIO AVE %d </StreetName><PostalCode>%06d</PostalCode>'
+            '<Status>Active</Status></Building></PropInfo>') % (building_id, building_id % 10, 560000 + building_id)
+
+
+def _units_document(rng):
+    room_types = ['1-room', '2-room', '3-room', '4-room', '5-room', 'Executive']
+    units = ''.join('<ResidentUnit><actUseTypTxt>%s</actUseTypTxt><count>%d</count></ResidentUnit>'
+                    % (room_type, rng.randint(0, 200)) for room_type in rng.sample(room_types, rng.randint(1, 4)))
+    return '<?xml version="1.0" encoding="UTF-8"?><ResidentUnits>%s</ResidentUnits>' % units
+
+
+def _lease_document(rng):
+    return ('<?xml version="1.0" encoding="UTF-8"?><Response><LeaseInformation>'
+            '<LeaseCommencedDate>01/%02d/19%02d</LeaseCommencedDate><LeaseRemaining>%d years %d months</LeaseRemaining>'
+            '<LeasePeriod>99 years</LeasePeriod></LeaseInformation></Response>') % (
+        rng.randint(1, 12), rng.randint(60, 99), rng.randint(40, 99), rng.randint(0, 11))
+
+
+def _ethnic_document(rng):
+    if rng.random() < 0.5:
+        return ('<?xml version="1.0" encoding="UTF-8"?><EthnicResult><sellerResults>You can sell your flat to all '
+                'eligible buyers</sellerResults></EthnicResult>')
+
+    return ('<?xml version="1.0" encoding="UTF-8"?><EthnicResult><buyerResultsTableHeading2>Block limit: %d%%'
+            '</buyerResultsTableHeading2><buyerResults>You can buy from any seller</buyerResults></EthnicResult>'
+            % rng.randint(10, 90))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the lxml parsing layer with the BeautifulSoup parsers.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--documents', type=int, help='documents per endpoint', default=2000)
+    parser.add_argument('--repeat', type=int, help='timing repetitions (best is reported)', default=3)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    prop_documents = [_prop_info_document(building_id, rng) for building_id in range(args.documents)]
+    units_documents = [_units_document(rng) for _ in range(args.documents)]
+    lease_documents = [_lease_document(rng) for _ in range(args.documents)]
+    ethnic_documents = [_ethnic_document(rng) for _ in range(args.documents)]
+    cases = [
+        ('prop info', prop_documents, soup_parse_prop_info, xmlparse.parse_prop_info, False),
+        ('units', units_documents, soup_parse_residential_units, xmlparse.parse_residential_units, True),
+        ('lease', lease_documents, soup_parse_lease_data, xmlparse.parse_lease_data, True),
+        ('ethnic', ethnic_documents, soup_parse_ethnic_result, xmlparse.parse_ethnic_result, False),
+    ]
+    print('%-10s %12s %12s %8s' % ('endpoint', 'soup docs/s', 'lxml docs/s', 'speedup'))
+    for name, documents, soup_parser, lxml_parser, with_postal_code in cases:
+        if with_postal_code:
+            soup_run = lambda: [soup_parser('560001', document) for document in documents]
+            lxml_run = lambda: [lxml_parser('560001', document) for document in documents]
+
+        else:
+            soup_run = lambda: [soup_parser(document) for document in documents]
+            lxml_run = lambda: [lxml_parser(document) for document in documents]
+
+        if soup_run() != lxml_run():
+            raise AssertionError('parsers disagree on %s documents' % name)
+
+        soup_time = min(timeit.repeat(soup_run, number=1, repeat=args.repeat))
+        lxml_time = min(timeit.repeat(lxml_run, number=1, repeat=args.repeat))
+        print('%-10s %12.0f %12.0f %7.1fx' % (name, len(documents) / soup_time, len(documents) / lxml_time,
+                                             soup_time / lxml_time))
+
+if __name__ == '__main__':
+    main()
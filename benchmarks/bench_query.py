@@ -0,0 +1,187 @@
+import argparse
+import http.client
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy
+
+from hdb import query, stores
+
+# load time and lookup latency of the query index (hdb.query), in process and through its HTTP endpoint,
+# against filtering a pandas frame of the merged data as downstream apps do with the export; the number of
+# buildings found by both is checked along the way
+
+
+def generate_stores(data_dir, buildings, rng):
+    # two or three blocks per postal code, about 40 blocks per street, 10% of postal codes without a lease
+    postal_codes = ['%06d' % code for code in rng.sample(range(10000, 830000), buildings // 3 + 1)]
+    streets = ['%s %d' % (rng.choice(['ANG MO KIO AVE', 'BEDOK NTH ST', 'JURONG WEST ST', 'TAMPINES ST']), number)
+               for number in range(max(1, buildings // 40))]
+    buildings_store = stores.open_store(data_dir, 'buildings-db')
+    buildings_store.append([(building_id, '%d%s' % (rng.randint(1, 999), rng.choice(['', 'A', 'B'])),
+                             rng.choice(streets), postal_codes[(building_id - 1) // 3])
+                            for building_id in range(1, buildings + 1)])
+    buildings_store.close()
+    units_store = stores.open_store(data_dir, 'units-db')
+    units_store.append([(postal_code, room_type, rng.randint(1, 200)) for postal_code in postal_codes
+                        for room_type in rng.sample(stores.ROOM_TYPES, rng.randint(1, 4))])
+    units_store.close()
+    leases_store = stores.open_store(data_dir, 'leases-db')
+    leases_store.append([(postal_code, '01/%02d/%d' % (rng.randint(1, 12), rng.randint(1960, 2020)),
+                          '%d years' % rng.randint(40, 99), '99 years')
+                         for postal_code in postal_codes if rng.random() < 0.9])
+    leases_store.close()
+
+
+def merged_frame(data_dir):
+    # the merged data as a pandas frame, one row per building (same joins as build_export_frame)
+    buildings_df = stores.open_store(data_dir, 'buildings-db').read_frame()
+    buildings_df = buildings_df.drop_duplicates('building', keep='last')
+    units_df = stores.open_store(data_dir, 'units-db').read_frame()
+    units_df = units_df.drop_duplicates(subset=['postal_code', 'room_type'], keep='last')
+    units_pivot_df = units_df.pivot(index='postal_code', columns='room_type', values='room_count')
+    units_pivot_df.columns = units_pivot_df.columns.astype(str)
+    leases_df = stores.open_store(data_dir, 'leases-db').read_frame()
+    leases_df = leases_df.drop_duplicates(subset='postal_code', keep='last').set_index('postal_code')
+    final_df = buildings_df.join(units_pivot_df, on='postal_code').join(leases_df, on='postal_code')
+    final_df['lease_year'] = final_df['lease_commenced'].str[-4:].astype(float)
+    final_df['street_key'] = final_df['street'].str.upper()
+    final_df['block_key'] = final_df['number'].str.upper()
+    return final_df
+
+
+def frame_find(final_df, postal_code=None, street=None, block=None, lease_years=None, room_type=None):
+    mask = numpy.ones(len(final_df), dtype=bool)
+    if postal_code is not None:
+        mask &= (final_df['postal_code'] == postal_code).values
+
+    if street is not None:
+        mask &= (final_df['street_key'] == street.upper()).values
+
+    if block is not None:
+        mask &= (final_df['block_key'] == block.upper()).values
+
+    if lease_years is not None:
+        mask &= final_df['lease_year'].between(*lease_years).values
+
+    if room_type is not None:
+        mask &= (final_df[room_type] > 0).values if room_type in final_df else False
+
+    return final_df[mask]
+
+
+def lookups(index, count, rng):
+    # (kind, criteria) drawn from the indexed data
+    records = [index.record(position) for position in rng.sample(range(len(index)), min(count, len(index)))]
+    room_types = index.room_types
+    kinds = [
+        ('postal code', lambda record: {'postal_code': record['postal_code']}),
+        ('street', lambda record: {'street': record['street']}),
+        ('block', lambda record: {'street': record['street'], 'block': record['block']}),
+        ('lease years', lambda record: {'lease_years': (record['lease_year'] or 1990,
+                                                        (record['lease_year'] or 1990) + rng.randint(0, 5))}),
+        ('room type', lambda record: {'room_type': rng.choice(room_types)}),
+        ('combined', lambda record: {'street': record['street'], 'room_type': rng.choice(room_types),
+                                     'lease_years': (1970, 2000)}),
+    ]
+    return [(kind, [make(record) for record in records]) for kind, make in kinds]
+
+
+def _latencies(function, criteria_list):
+    latencies = list()
+    for criteria in criteria_list:
+        start = time.perf_counter()
+        function(criteria)
+        latencies.append(time.perf_counter() - start)
+
+    return numpy.array(latencies) * 1e6
+
+
+def _query_string(criteria):
+    parameters = dict((name, value) for name, value in criteria.items() if name != 'lease_years')
+    if 'lease_years' in criteria:
+        parameters['lease_year_from'], parameters['lease_year_to'] = criteria['lease_years']
+
+    return urllib.parse.urlencode(parameters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load time and lookup latency of the query index.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--buildings', type=int, help='number of synthetic buildings', default=13000)
+    parser.add_argument('--data-dir', help='stores of a previous crawl instead of synthetic data')
+    parser.add_argument('--lookups', type=int, help='lookups per kind', default=1000)
+    parser.add_argument('--frame-lookups', type=int, help='lookups per kind on the pandas frame', default=100)
+    parser.add_argument('--http', help='also measures the lookups through the HTTP endpoint', action='store_true')
+    args = parser.parse_args()
+    rng = random.Random(42)
+    work_dir = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='bench-query-')
+        data_dir = work_dir + '/'
+        generate_stores(data_dir, args.buildings, rng)
+
+    try:
+        # the first load also initializes pyarrow and numpy internals
+        start = time.perf_counter()
+        query.load(data_dir)
+        first_load = time.perf_counter() - start
+        start = time.perf_counter()
+        index = query.load(data_dir)
+        index_load = time.perf_counter() - start
+        start = time.perf_counter()
+        final_df = merged_frame(data_dir)
+        frame_load = time.perf_counter() - start
+        print('%d buildings: index loaded in %.3f s (first load %.3f s), pandas frame in %.3f s' % (
+            len(index), index_load, first_load, frame_load))
+
+        server = None
+        connection = None
+        if args.http:
+            server = query.QueryServer(index, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            connection = http.client.HTTPConnection(*server.server_address)
+
+        def http_find(criteria):
+            connection.request('GET', '/buildings?' + _query_string(criteria))
+            return json.loads(connection.getresponse().read())['buildings']
+
+        print('%-12s %10s %10s %10s %10s %10s %10s' % ('lookup', 'index us', 'median us', 'p99 us', 'frame us',
+                                                       'http us', 'buildings'))
+        for kind, criteria_list in lookups(index, args.lookups, rng):
+            for criteria in criteria_list[:args.frame_lookups]:
+                found = len(index.positions(**criteria))
+                expected = len(frame_find(final_df, **criteria))
+                if found != expected:
+                    raise AssertionError('%s: %d buildings found, %d expected for %s' % (kind, found, expected,
+                                                                                         criteria))
+
+            # positions only, then with the records of the buildings found
+            index_latencies = _latencies(lambda criteria: index.positions(**criteria), criteria_list)
+            latencies = _latencies(lambda criteria: index.find(**criteria), criteria_list)
+            frame_latencies = _latencies(lambda criteria: frame_find(final_df, **criteria).to_dict('records'),
+                                         criteria_list[:args.frame_lookups])
+            http_median = numpy.median(_latencies(http_find, criteria_list)) if connection is not None else numpy.nan
+            found = numpy.mean([len(index.positions(**criteria)) for criteria in criteria_list])
+            print('%-12s %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f' % (
+                kind, numpy.median(index_latencies), numpy.median(latencies), numpy.percentile(latencies, 99),
+                numpy.median(frame_latencies), http_median, found))
+
+        if server is not None:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
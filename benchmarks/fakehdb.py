@@ -0,0 +1,293 @@
+import argparse
+import collections
+import email.utils
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# local stand-in for the HDB web services: serves synthetic (or recorded) XML for the four endpoints used by
+# the crawler, with configurable latency, error rate and throttling; responses carry validators (ETag,
+# Last-Modified) and conditional requests get 304 Not Modified when the document did not change
+
+_ROOM_TYPES = ['1-room', '2-room', '3-room', '4-room', '5-room', 'Executive', 'HUDC', 'Multi-generation',
+               'Studio Apartment', 'Type S1', 'Type S2']
+_ETHNIC_GROUPS = {'C': 'Chinese', 'M': 'Malay', 'I': 'Indian/Other'}
+_RECORDED_HDB_URL = 'https://services2.hdb.gov.sg'
+# Last-Modified of the documents, lease documents change every --day
+_EPOCH = 1577836800
+
+
+def _postal_code(building_id):
+    # two or three blocks per postal code, some postal codes starting with 0
+    return '%06d' % ((building_id // 3 * 7919) % 1000000)
+
+
+def prop_info_document(building_id, buildings, missing_ratio):
+    if building_id > buildings or random.Random(building_id).random() < missing_ratio:
+        return '<?xml version="1.0" encoding="UTF-8"?><PropInfo><Block></Block></PropInfo>'
+
+    return ('<?xml version="1.0" encoding="UTF-8"?><PropInfo><Building><Block> %dA </Block>'
+            '<StreetName> ANG MO KIO AVE %d </StreetName><PostalCode>%s</PostalCode>'
+            '<Status>Active</Status></Building></PropInfo>') % (building_id, building_id % 10,
+                                                                  _postal_code(building_id))
+
+
+def units_document(postal_code):
+    rng = random.Random(postal_code)
+    units = ''.join('<ResidentUnit><actUseTypTxt>%s</actUseTypTxt><count>%d</count></ResidentUnit>'
+                    % (room_type, rng.randint(1, 200)) for room_type in rng.sample(_ROOM_TYPES, rng.randint(1, 4)))
+    return '<?xml version="1.0" encoding="UTF-8"?><ResidentUnits>%s</ResidentUnits>' % units
+
+
+def lease_document(postal_code, day):
+    rng = random.Random(postal_code)
+    commenced_year = rng.randint(1960, 2015)
+    remaining_days = (commenced_year + 99 - 1970) * 365 - day
+    return ('<?xml version="1.0" encoding="UTF-8"?><Response><LeaseInformation>'
+            '<LeaseCommencedDate>01/%02d/%d</LeaseCommencedDate>'
+            '<LeaseRemaining>%d years %d months</LeaseRemaining>'
+            '<LeasePeriod>99 years</LeasePeriod></LeaseInformation></Response>') % (
+        rng.randint(1, 12), commenced_year, remaining_days // 365, remaining_days % 365 // 31)
+
+
+def ethnic_document(enquiry, postal_code, ethnic_code, citizenship):
+    if enquiry == 'S':
+        return ('<?xml version="1.0" encoding="UTF-8"?><EthnicResult><sellerResults>You can sell your flat to '
+                '%s buyers (%s)</sellerResults></EthnicResult>') % (_ETHNIC_GROUPS.get(ethnic_code, ethnic_code),
+                                                                   citizenship)
+
+    return ('<?xml version="1.0" encoding="UTF-8"?><EthnicResult><buyerResultsTableHeading2>Block limit: %d%%'
+            '</buyerResultsTableHeading2><buyerResults>You can buy from any seller</buyerResults></EthnicResult>'
+            % random.Random(postal_code + ethnic_code).randint(10, 90))
+
+
+class _Settings(object):
+
+    def __init__(self, buildings=1000, missing_ratio=0.3, latency=0., jitter=0., error_rate=0.,
+                 max_concurrency=0, rate_limit=0., day=0, replay=False, validators=True):
+        self.buildings = buildings
+        self.missing_ratio = missing_ratio
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.day = day
+        self.replay = replay
+        self.validators = validators
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body='', content_type='text/xml'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_document(self, endpoint, document):
+        settings = self.server.settings
+        if not settings.validators:
+            self._send(200, document)
+            return
+
+        etag = '"%s"' % hashlib.sha1(document.encode('utf-8')).hexdigest()[:20]
+        modified = _EPOCH + (settings.day * 86400 if endpoint == 'BB14SGenerateLeaseInfoXML' else 0)
+        # If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_none_match is not None:
+            not_modified = etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        elif if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            not_modified = since is not None and modified <= email.utils.mktime_tz(since)
+
+        else:
+            not_modified = False
+
+        if not_modified:
+            self.server.count('not_modified')
+
+        data = b'' if not_modified else document.encode('utf-8')
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(modified, usegmt=True))
+        if not not_modified:
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(data)))
+
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _document(self, endpoint, query):
+        settings = self.server.settings
+        if settings.replay:
+            from hdb import urlcaching
+            recorded = urlcaching._get_from_cache(_RECORDED_HDB_URL + self.path)
+            if recorded is not None:
+                return recorded
+
+        if endpoint == 'BC16SRetrievePropInfoXML':
+            return prop_info_document(int(query['bldngGL']), settings.buildings, settings.missing_ratio)
+
+        if endpoint == 'BC16SRetrieveResiUnitCountXML':
+            return units_document(query['postalCode'])
+
+        if endpoint == 'BB14SGenerateLeaseInfoXML':
+            return lease_document(query['postalCode'], settings.day)
+
+        if endpoint == 'BB29SEthnicMap':
+            return ethnic_document(query['enquiry'], query['postal'], query['ethnic'], query['citizenship'])
+
+        return None
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        if endpoint == '__stats':
+            self._send(200, json.dumps(self.server.stats()), 'application/json')
+            return
+
+        query = dict(urllib.parse.parse_qsl(url.query))
+        status = self.server.admit(endpoint)
+        try:
+            if status != 200:
+                self._send(status)
+                return
+
+            settings = self.server.settings
+            if settings.latency or settings.jitter:
+                time.sleep(settings.latency + random.uniform(0., settings.jitter))
+
+            if settings.error_rate and random.random() < settings.error_rate:
+                self.server.count('errors')
+                self._send(500)
+                return
+
+            document = self._document(endpoint, query)
+            if document is None:
+                self._send(404)
+                return
+
+            self._send_document(endpoint, document)
+
+        finally:
+            self.server.leave()
+
+
+class FakeHDBServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, **settings):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.settings = _Settings(**settings)
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._active = 0
+        self._tokens = float(self.settings.rate_limit)
+        self._last_refill = time.monotonic()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def admit(self, endpoint):
+        # 429 beyond max_concurrency simultaneous requests or above rate_limit requests per second
+        with self._lock:
+            self._active += 1
+            self._counters['requests'] += 1
+            self._counters['requests:' + endpoint] += 1
+            settings = self.settings
+            if settings.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(settings.rate_limit, self._tokens + (now - self._last_refill) * settings.rate_limit)
+                self._last_refill = now
+                if self._tokens < 1.:
+                    self._counters['throttled'] += 1
+                    return 429
+
+                self._tokens -= 1.
+
+            if settings.max_concurrency and self._active > settings.max_concurrency:
+                self._counters['throttled'] += 1
+                return 429
+
+        return 200
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def start(self):
+        # serves from a background thread, for in-process use
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the HDB web services.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--port', type=int, help='listening port (0 picks a free one)', default=8765)
+    parser.add_argument('--buildings', type=int, help='highest building id served', default=1000)
+    parser.add_argument('--missing-ratio', type=float, help='share of building ids without a building', default=0.3)
+    parser.add_argument('--latency', type=float, help='response latency in seconds', default=0.)
+    parser.add_argument('--jitter', type=float, help='random extra latency in seconds, up to', default=0.)
+    parser.add_argument('--error-rate', type=float, help='share of requests answered with HTTP 500', default=0.)
+    parser.add_argument('--max-concurrency', type=int, help='simultaneous requests before HTTP 429 (0: no limit)',
+                        default=0)
+    parser.add_argument('--rate-limit', type=float, help='requests per second before HTTP 429 (0: no limit)',
+                        default=0.)
+    parser.add_argument('--day', type=int, help='days elapsed, shifts the remaining leases', default=0)
+    parser.add_argument('--no-validators', help='sends neither ETag nor Last-Modified and ignores conditional '
+                                                'requests', action='store_true')
+    parser.add_argument('--replay-cache', help='serves the responses recorded in this url cache when available')
+    args = parser.parse_args()
+    if args.replay_cache:
+        from hdb import urlcaching
+        urlcaching.set_cache_http(args.replay_cache)
+
+    server = FakeHDBServer(args.port, buildings=args.buildings, missing_ratio=args.missing_ratio,
+                           latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                           max_concurrency=args.max_concurrency, rate_limit=args.rate_limit, day=args.day,
+                           replay=args.replay_cache is not None, validators=not args.no_validators)
+    # the harness reads the address from the first line
+    print('listening on %s' % server.url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
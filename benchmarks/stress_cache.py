@@ -0,0 +1,135 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from hdb import cachestore, urlcaching
+
+# many threads reading and writing the url cache while the directory tree keeps rebalancing: every read of a
+# key written before must hit with the exact value, and misses on the same url must share a single download
+
+
+def _value(key):
+    # deterministic and large enough to compress
+    return '<?xml version="1.0" encoding="UTF-8"?><PropInfo>%s</PropInfo>' % ('<Block>%s</Block>' % key * 20)
+
+
+def _stress_store(store, threads, operations, keys):
+    written = set()
+    errors = list()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(operations):
+            key = 'key-%d' % rng.randrange(keys)
+            if rng.random() < 0.3:
+                store.put(key, _value(key))
+                written.add(key)
+
+            else:
+                # checked before the read: a key written meanwhile may hit too
+                must_hit = key in written
+                value = store.get(key)
+                if value is None and must_hit:
+                    errors.append('miss on written key %s' % key)
+
+                elif value is not None and value != _value(key):
+                    errors.append('wrong value for key %s' % key)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    start = time.monotonic()
+    for thread in workers:
+        thread.start()
+
+    for thread in workers:
+        thread.join()
+
+    return time.monotonic() - start, errors
+
+
+def _stress_coalescing(threads, urls):
+    downloads = list()
+    original_download = urlcaching._download
+
+    def slow_download(url):
+        downloads.append(url)
+        time.sleep(0.01)
+        return _value(url)
+
+    urlcaching._download = slow_download
+    try:
+        barrier = threading.Barrier(threads)
+
+        def worker():
+            barrier.wait()
+            for url in urls:
+                if urlcaching.open_url(url) != _value(url):
+                    raise AssertionError('wrong content for %s' % url)
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+
+        for thread in workers:
+            thread.join()
+
+    finally:
+        urlcaching._download = original_download
+
+    return len(downloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress test of the url cache under concurrent reads, writes and '
+                                                 'rebalancing.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('--threads', type=int, help='number of threads', default=40)
+    parser.add_argument('--operations', type=int, help='operations per thread', default=1000)
+    parser.add_argument('--keys', type=int, help='distinct keys', default=3000)
+    args = parser.parse_args()
+    # small nodes so that the tree is split many times during the run
+    cachestore._MAX_NODE_FILES = 32
+    cachestore._REBALANCING_LIMIT = 256
+    work_dir = tempfile.mkdtemp(prefix='hdb-cache-stress-')
+    failed = False
+    try:
+        for backend in ('tree', 'sqlite'):
+            backend_dir = os.path.join(work_dir, backend)
+            os.makedirs(backend_dir)
+            if backend == 'tree':
+                store = cachestore.DirectoryTreeCache(backend_dir)
+
+            else:
+                store = cachestore.SQLiteCache(os.path.join(backend_dir, 'cache.sqlite'))
+
+            elapsed, errors = _stress_store(store, args.threads, args.operations, args.keys)
+            store.close()
+            nodes = sum(1 for _ in os.walk(backend_dir))
+            print('%-7s %8.0f ops/s, %d errors, %d directories' % (backend, args.threads * args.operations / elapsed,
+                                                                   len(errors), nodes))
+            for error in errors[:10]:
+                print('  ' + error)
+
+            failed = failed or bool(errors)
+
+        urlcaching.set_cache_http(os.path.join(work_dir, 'coalescing'))
+        urls = ['http://localhost/%d' % index for index in range(50)]
+        downloads = _stress_coalescing(args.threads, urls)
+        print('coalescing: %d downloads for %d urls requested by %d threads' % (downloads, len(urls), args.threads))
+        failed = failed or downloads != len(urls)
+        urlcaching.close_cache()
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failed:
+        raise SystemExit('FAILED')
+
+    print('OK')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import logging
+
+from hdb import cachearchive, urlcaching
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description='Exports, imports and merges packed URL cache archives.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='packs the cache into an archive')
+    export_parser.add_argument('archive', type=str, help='archive file to write')
+    import_parser = subparsers.add_parser('import', help='merges archives into the cache (newest entries win)')
+    import_parser.add_argument('archives', type=str, nargs='+', help='archive files to import')
+    merge_parser = subparsers.add_parser('merge', help='merges archives into a new one (newest entries win)')
+    merge_parser.add_argument('output', type=str, help='archive file to write')
+    merge_parser.add_argument('archives', type=str, nargs='+', help='archive files to merge')
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument('--cache-path', type=str, help='cache directory', default='~/.urlcaching')
+        subparser.add_argument('--backend', choices=['sqlite', 'tree'], help='cache backend', default='sqlite')
+
+    args = parser.parse_args()
+    if args.command == 'merge':
+        cachearchive.merge_archives(args.archives, args.output)
+        return
+
+    urlcaching.set_cache_http(args.cache_path, backend=args.backend)
+    if args.command == 'export':
+        urlcaching.export_cache(args.archive)
+
+    else:
+        for archive in args.archives:
+            urlcaching.import_cache(archive)
+
+    urlcaching.close_cache()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import argparse
+import logging
+
+from hdb import urlcaching
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description='Imports a directory-tree URL cache into the single-file cache store.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('cache_path', type=str, nargs='?', help='directory-tree cache to migrate', default='~/.urlcaching')
+    parser.add_argument('--target', type=str, help='target cache file (defaults to cache.sqlite under cache_path)')
+    args = parser.parse_args()
+    urlcaching.migrate_cache_tree(args.cache_path, args.target)
+
+if __name__ == '__main__':
+    main()
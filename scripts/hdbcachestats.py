@@ -0,0 +1,25 @@
+import argparse
+import logging
+
+from hdb import urlcaching
+from hdb.cli import print_cache_stats
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description='Reports URL cache size and compression ratio.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    parser.add_argument('cache_path', type=str, nargs='?', help='cache directory', default='~/.urlcaching')
+    parser.add_argument('--backend', choices=['sqlite', 'tree'], help='cache backend', default='sqlite')
+    parser.add_argument('--train-dictionary', help='trains a zstd dictionary on cached entries for future writes',
+                        action='store_true')
+    args = parser.parse_args()
+    urlcaching.set_cache_http(args.cache_path, backend=args.backend)
+    if args.train_dictionary:
+        urlcaching.train_cache_dictionary()
+
+    print_cache_stats(urlcaching.cache_stats())
+
+if __name__ == '__main__':
+    main()
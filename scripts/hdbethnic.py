@@ -17,10 +17,13 @@ def main():
     parser = argparse.ArgumentParser(description='Loading ethnic data from HDB.',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter
                                      )
+    parser.add_argument('output_file', type=str, nargs='?', help='name of the output file', default='ethnic.xlsx')
+    parser.add_argument('--output-format', choices=['xlsx', 'csv', 'parquet'],
+                        help='output file format (inferred from the file extension by default)')
     parser.add_argument('--ntasks', type=int, help='number of simultaneous downloads', default=40)
     args = parser.parse_args()
     set_pool_size(args.ntasks)
-    generate_ethnic_db()
+    generate_ethnic_db(args.output_file, args.output_format)
 
 if __name__ == '__main__':
     main()
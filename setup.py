@@ -22,24 +22,33 @@ setup(
     version=get_version(),
     packages=find_packages('src'),
     package_dir={'': 'src'},   # for distutils
-    scripts=['scripts/hdbretrieve.py'],
+    scripts=['scripts/hdbretrieve.py', 'scripts/hdbcachemigrate.py',
+             'scripts/hdbcachestats.py', 'scripts/hdbcachearchive.py'],
     url='',
     license='',
     author='Christophe Alexandre',
     author_email='ch.alexandre@bluewin.ch',
     description='Extracting building data from HDB website',
     long_description=read('README.md'),
+    classifiers=[
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+    ],
+    # asyncio.get_running_loop and contextlib.asynccontextmanager
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'hdbretrieve = hdb:main',
         ],
     },
     install_requires = [
-        'beautifulsoup4>=4.4.1',
         'retrying>=1.3.3',
-        'pandas>=0.18.0',
+        'pandas>=1.1.0',
         'requests>=2.10.0',
+        'aiohttp>=3.3.0',
         'lxml>=3.6.0',
+        'pyarrow>=7.0.0',
         'xlsxwriter>=0.9.2',
     ],
 )
@@ -1,46 +1,58 @@
-import argparse
-import logging
+import importlib
 
 __version__ = '0.2'
 
-from hdb.hdbdownload import generate_buildings_db, generate_units_db, generate_leases_db, set_data_dir, set_hdb_url, \
-    set_pool_size, generate_excel
-from hdb.urlcaching import set_cache_http
+# the public API is imported on first access (PEP 562), so that importing hdb, e.g. for the command line,
+# does not load pandas, pyarrow or the HTTP stack
+_LAZY_ATTRIBUTES = {
+    'generate_buildings_db': 'hdb.hdbdownload',
+    'generate_units_db': 'hdb.hdbdownload',
+    'generate_leases_db': 'hdb.hdbdownload',
+    'generate_ethnic_db': 'hdb.hdbdownload',
+    'generate_pipelined_dbs': 'hdb.hdbdownload',
+    'generate_excel': 'hdb.hdbdownload',
+    'generate_changelog': 'hdb.hdbdownload',
+    'export_csv': 'hdb.hdbdownload',
+    'refresh_buildings_db': 'hdb.hdbdownload',
+    'refresh_units_db': 'hdb.hdbdownload',
+    'refresh_leases_db': 'hdb.hdbdownload',
+    'merge_shards': 'hdb.hdbdownload',
+    'set_data_dir': 'hdb.hdbdownload',
+    'set_hdb_url': 'hdb.hdbdownload',
+    'set_pool_size': 'hdb.hdbdownload',
+    'set_parse_workers': 'hdb.hdbdownload',
+    'close_parse_workers': 'hdb.hdbdownload',
+    'set_engine': 'hdb.hdbdownload',
+    'set_cache_expiry': 'hdb.hdbdownload',
+    'set_shard': 'hdb.hdbdownload',
+    'shard_data_dir': 'hdb.hdbdownload',
+    'set_cache_http': 'hdb.urlcaching',
+    'set_cache_max_size': 'hdb.urlcaching',
+    'set_cache_revalidation': 'hdb.urlcaching',
+    'cache_counters': 'hdb.urlcaching',
+    'import_cache': 'hdb.urlcaching',
+    'close_cache': 'hdb.urlcaching',
+    'reset_checkpoints': 'hdb.checkpoint',
+    'set_rate_limit': 'hdb.throttle',
+    'set_adaptive_concurrency': 'hdb.throttle',
+    'set_circuit_breaker': 'hdb.throttle',
+}
+_LAZY_MODULES = ('asyncfetch', 'metrics', 'query')
+
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        return importlib.import_module('hdb.' + name)
+
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
 
 
 def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
-    logging.getLogger('requests').setLevel(logging.WARNING)
-    file_handler = logging.FileHandler('hdb.log', mode='w')
-    formatter = logging.Formatter('%(asctime)s:%(name)s:%(levelname)s:%(message)s')
-    file_handler.setFormatter(formatter)
-    logging.getLogger().addHandler(file_handler)
-    parser = argparse.ArgumentParser(description='Loading building data from HDB.',
-                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
-                                     )
-    parser.add_argument('output_file', type=str, nargs='?', help='name of the output Excel file', default='hdb.xlsx')
-    parser.add_argument('--ntasks', type=int, help='number of simultaneous downloads', default=40)
-    parser.add_argument('--use-cache', help='stores downloaded HDB files locally', action='store_true')
-    parser.add_argument('--only-output', help='skips downloading steps (will fail if missing cache files)', action='store_true')
-    parser.add_argument('--max-building-id', type=int, help='max building id to scan', default=15288)
-    args = parser.parse_args()
-    DATA_DIR = '.hdb/'
-    HDB_URL = 'https://services2.hdb.gov.sg'
-    set_data_dir(DATA_DIR)
-
-    if not args.only_output:
-        set_hdb_url(HDB_URL)
-        set_pool_size(args.ntasks)
-        if args.use_cache:
-            set_cache_http('~/.urlcaching')
-
-        logging.info('started')
-        logging.info('generating buildings data')
-        generate_buildings_db(args.max_building_id)
-        logging.info('generating leases data')
-        generate_leases_db()
-        logging.info('generating units data')
-        generate_units_db()
-
-    logging.info('generating output')
-    generate_excel(DATA_DIR, './', args.output_file)
+    from hdb.cli import main as cli_main
+    cli_main()
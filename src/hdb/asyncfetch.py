@@ -0,0 +1,267 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+import time
+
+from hdb import metrics, throttle, urlcaching
+
+_CONCURRENCY = 10
+_KEEPALIVE_TIMEOUT = 30
+_HTTP_TIMEOUT = 60
+
+_loop_lock = threading.Lock()
+_loop = None
+_loop_thread = None
+_session = None
+_semaphore = None
+# only touched from the event loop thread
+_in_flight = dict()
+
+
+def set_concurrency(concurrency):
+    global _CONCURRENCY
+    if _session is not None:
+        close()
+
+    _CONCURRENCY = concurrency
+
+
+def _get_loop():
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='asyncfetch', daemon=True)
+            _loop_thread.start()
+            logging.debug('started async fetch loop (concurrency %d)', _CONCURRENCY)
+
+        return _loop
+
+
+def _get_session():
+    global _session, _semaphore
+    # only ever called from the loop thread
+    if _session is None:
+        # imported on first use: aiohttp is only needed by the async engine
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=_CONCURRENCY, limit_per_host=_CONCURRENCY,
+                                         keepalive_timeout=_KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=_HTTP_TIMEOUT))
+        _semaphore = asyncio.Semaphore(_CONCURRENCY)
+
+    return _session
+
+
+async def download(url):
+    session = _get_session()
+    async with throttle.request_async(url):
+        async with _semaphore:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.text()
+
+
+async def download_conditional(url, headers):
+    # (text, etag, last_modified) where text is None for a 304 Not Modified response
+    session = _get_session()
+    async with throttle.request_async(url):
+        async with _semaphore:
+            async with session.get(url, headers=headers) as response:
+                response.raise_for_status()
+                text = None if response.status == 304 else await response.text()
+                return text, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+async def open_url_async(url):
+    return (await open_url_checked_async(url))[0]
+
+
+async def open_url_checked_async(url):
+    # (content, modified), see urlcaching.open_url_checked
+    # concurrent requests for the same url share a single download
+    future = _in_flight.get(url)
+    if future is not None:
+        urlcaching._count('coalesced')
+        return await asyncio.shield(future)
+
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[url] = future
+    try:
+        result = await _open_url_async(url)
+        future.set_result(result)
+        return result
+
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+
+    except BaseException as error:
+        future.set_exception(error)
+        # the error is raised here: waiters are optional
+        future.exception()
+        raise
+
+    finally:
+        del _in_flight[url]
+
+
+async def _open_url_async(url):
+    metrics.debug_sampled('opening url: %s', url)
+    loop = asyncio.get_running_loop()
+    if urlcaching.is_cache_used():
+        start = time.monotonic()
+        # cache access is blocking I/O: keep it off the event loop
+        content = await loop.run_in_executor(None, urlcaching._get_from_cache, url)
+        if content is not None:
+            metrics.observe('hdb_open_url_seconds', time.monotonic() - start, source='cache')
+            metrics.count('hdb_open_url_bytes_total', len(content), source='cache')
+            return content, True
+
+        if urlcaching._REVALIDATE:
+            return await _revalidate_async(url)
+
+    start = time.monotonic()
+    content = await download(url)
+    metrics.observe('hdb_open_url_seconds', time.monotonic() - start, source='network')
+    metrics.count('hdb_open_url_bytes_total', len(content), source='network')
+    if urlcaching.is_cache_used():
+        await loop.run_in_executor(None, urlcaching._add_to_cache, url, content)
+
+    return content, True
+
+
+async def _revalidate_async(url):
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    stale, validators, headers = await loop.run_in_executor(None, urlcaching._revalidation_request, url)
+    content, etag, last_modified = await download_conditional(url, headers)
+    source = 'network' if content is not None else 'revalidated'
+    content, modified = await loop.run_in_executor(None, urlcaching._store_revalidated, url, stale, validators,
+                                                   content, etag, last_modified)
+    metrics.observe('hdb_open_url_seconds', time.monotonic() - start, source=source)
+    metrics.count('hdb_open_url_bytes_total', len(content), source=source)
+    return content, modified
+
+
+def retry_async(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_delay=30000):
+    # same semantics as the retrying.retry arguments used for the synchronous loaders
+
+    def decorator(coroutine_function):
+
+        @functools.wraps(coroutine_function)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                try:
+                    return await coroutine_function(*args, **kwargs)
+
+                except Exception:
+                    attempt += 1
+                    wait_ms = min(wait_exponential_multiplier * (2 ** attempt), wait_exponential_max)
+                    elapsed_ms = (time.monotonic() - start) * 1000
+                    if elapsed_ms + wait_ms > stop_max_delay:
+                        raise
+
+                    await asyncio.sleep(wait_ms / 1000.)
+
+        return wrapper
+
+    return decorator
+
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+def open_url(url):
+    return run(open_url_async(url))
+
+
+async def _gather(coroutine_function, args_list):
+    return await asyncio.gather(*[coroutine_function(*args) for args in args_list])
+
+
+def gather(coroutine_function, args_list):
+    # concurrency is bounded by the shared semaphore in download()
+    return run(_gather(coroutine_function, args_list))
+
+
+async def _timed(coroutine_function, args, submitted):
+    started = time.monotonic()
+    metrics.observe('hdb_taskpool_queue_wait_seconds', started - submitted, pool='async')
+    try:
+        return await coroutine_function(*args)
+
+    finally:
+        metrics.observe('hdb_taskpool_run_seconds', time.monotonic() - started, pool='async')
+
+
+def submit(coroutine_function, args):
+    # schedules coroutine_function(*args) on the loop, returns a concurrent.futures.Future
+    return asyncio.run_coroutine_threadsafe(_timed(coroutine_function, args, time.monotonic()), _get_loop())
+
+
+def map_unordered(coroutine_function, args_iterable, max_pending=None, on_error=None):
+    # streaming counterpart of gather(): arguments are pulled lazily and results yielded as they complete;
+    # on_error(args, error) is called for each failed call (same as TaskPool), otherwise the failure is raised
+    max_pending = max_pending or 2 * _CONCURRENCY
+    args_iterator = iter(args_iterable)
+    pending = dict()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    args = next(args_iterator)
+
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                pending[submit(coroutine_function, args)] = args
+
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                args = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    yield future.result()
+
+                elif on_error is None:
+                    raise error
+
+                else:
+                    on_error(args, error)
+
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def _close():
+    global _session, _semaphore
+    if _session is not None:
+        await _session.close()
+        _session = None
+        _semaphore = None
+
+
+def close():
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(_close(), _loop).result()
+        _loop.call_soon_threadsafe(_loop.stop)
+        _loop_thread.join()
+        _loop.close()
+        _loop = None
+        _loop_thread = None
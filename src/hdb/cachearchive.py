@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import struct
+import zlib
+
+from hdb import cachecodec
+
+# single-file pack of cache entries, for sharing a crawled cache across machines:
+#   magic | payloads (zlib-compressed, back to back) | index (zlib-compressed JSON) | footer
+# the index lists [key, offset, size, stored_at] for every payload, the footer locates the index
+_MAGIC = b'HDBPACK1'
+_FOOTER = struct.Struct('>QQ8s')
+_INDEX_LEVEL = 6
+
+
+def _read_footer(archive_file):
+    archive_file.seek(0, os.SEEK_END)
+    archive_size = archive_file.tell()
+    if archive_size < len(_MAGIC) + _FOOTER.size:
+        raise ValueError('not a cache archive: %s' % archive_file.name)
+
+    archive_file.seek(archive_size - _FOOTER.size)
+    index_offset, index_size, magic = _FOOTER.unpack(archive_file.read(_FOOTER.size))
+    if magic != _MAGIC:
+        raise ValueError('not a cache archive: %s' % archive_file.name)
+
+    return index_offset, index_size
+
+
+def read_index(archive_path):
+    # key -> (offset, size, stored_at)
+    with open(archive_path, 'rb') as archive_file:
+        index_offset, index_size = _read_footer(archive_file)
+        archive_file.seek(index_offset)
+        index = json.loads(zlib.decompress(archive_file.read(index_size)).decode('utf-8'))
+
+    return dict((key, (offset, size, stored_at)) for key, offset, size, stored_at in index)
+
+
+def iter_payloads(archive_path, index=None):
+    # (key, payload, stored_at) in file order, i.e. a single sequential read
+    if index is None:
+        index = read_index(archive_path)
+
+    with open(archive_path, 'rb') as archive_file:
+        for key, (offset, size, stored_at) in sorted(index.items(), key=lambda item: item[1][0]):
+            archive_file.seek(offset)
+            yield key, archive_file.read(size), stored_at
+
+
+class ArchiveWriter(object):
+
+    def __init__(self, archive_path):
+        self._archive_path = archive_path
+        self._temp_path = archive_path + '.tmp'
+        self._file = open(self._temp_path, 'wb')
+        self._file.write(_MAGIC)
+        self._index = list()
+
+    def add(self, key, payload, stored_at):
+        # payloads are stored as zlib cache payloads, readable without any trained dictionary
+        payload = cachecodec.portable(payload)
+        self._index.append([key, self._file.tell(), len(payload), stored_at])
+        self._file.write(payload)
+
+    def close(self):
+        index_offset = self._file.tell()
+        index_data = zlib.compress(json.dumps(self._index).encode('utf-8'), _INDEX_LEVEL)
+        self._file.write(index_data)
+        self._file.write(_FOOTER.pack(index_offset, len(index_data), _MAGIC))
+        self._file.close()
+        os.replace(self._temp_path, self._archive_path)
+        return len(self._index)
+
+
+def export_archive(cache, archive_path):
+    writer = ArchiveWriter(archive_path)
+    for key, payload, stored_at in cache.payload_items():
+        writer.add(key, payload, stored_at)
+
+    count = writer.close()
+    logging.info('exported %d cache entries to %s (%d bytes)', count, archive_path, os.path.getsize(archive_path))
+    return count
+
+
+def merge_archives(archive_paths, output_path):
+    # newest entry of each key wins
+    newest = dict()
+    for archive_path in archive_paths:
+        for key, (offset, size, stored_at) in read_index(archive_path).items():
+            if key not in newest or stored_at > newest[key][2]:
+                newest[key] = (archive_path, (offset, size, stored_at), stored_at)
+
+    writer = ArchiveWriter(output_path)
+    for archive_path in archive_paths:
+        index = dict((key, location) for key, (path, location, _) in newest.items() if path == archive_path)
+        for key, payload, stored_at in iter_payloads(archive_path, index):
+            writer.add(key, payload, stored_at)
+
+    count = writer.close()
+    logging.info('merged %d archives into %s: %d entries', len(archive_paths), output_path, count)
+    return count
+
+
+def import_archive(cache, archive_path):
+    # bulk merge into the cache, keeping the entries that are newer in the cache
+    written = cache.merge_payloads(iter_payloads(archive_path))
+    logging.info('imported %d cache entries from %s', written, archive_path)
+    return written
@@ -0,0 +1,159 @@
+import logging
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+
+except ImportError:
+    zstandard = None
+
+# compressed payloads start with a NUL byte (never the case for cached XML text), followed by
+# the codec identifier and the uncompressed size
+_HEADER = struct.Struct('>ccI')
+_MARKER = b'\x00'
+_CODEC_IDS = {'zlib': b'z', 'zstd': b's', 'zstd-dict': b'd'}
+_ZLIB_LEVEL = 6
+_ZSTD_LEVEL = 9
+_DICTIONARY_SIZE = 0x1b800
+_DICTIONARY_FILE = 'zstd.dict'
+
+_codec = 'zlib'
+_dictionary = None
+_generation = 0
+_local = threading.local()
+
+
+def set_codec(codec, dictionary_data=None):
+    global _codec, _dictionary, _generation
+    if codec not in _CODEC_IDS and codec != 'none':
+        raise ValueError('unknown cache codec: %s' % codec)
+
+    if codec.startswith('zstd') and zstandard is None:
+        raise ValueError('codec %s requires the zstandard package' % codec)
+
+    if codec == 'zstd-dict' and dictionary_data is None:
+        raise ValueError('codec zstd-dict requires a trained dictionary')
+
+    _codec = codec
+    _dictionary = None
+    if dictionary_data is not None and zstandard is not None:
+        _dictionary = zstandard.ZstdCompressionDict(dictionary_data)
+
+    # invalidates the per-thread (de)compressors
+    _generation += 1
+    logging.debug('cache codec: %s', codec)
+
+
+def get_codec():
+    return _codec
+
+
+def _thread_state():
+    # zstandard (de)compressor objects are not thread-safe
+    if getattr(_local, 'generation', None) != _generation:
+        _local.__dict__.clear()
+        _local.generation = _generation
+
+    return _local
+
+
+def _zstd_compressor():
+    local = _thread_state()
+    compressor = getattr(local, 'compressor', None)
+    if compressor is None:
+        compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL, dict_data=_dictionary)
+        local.compressor = compressor
+
+    return compressor
+
+
+def _zstd_decompressor(with_dictionary):
+    local = _thread_state()
+    attribute = 'dict_decompressor' if with_dictionary else 'decompressor'
+    decompressor = getattr(local, attribute, None)
+    if decompressor is None:
+        if with_dictionary:
+            if _dictionary is None:
+                raise ValueError('cache entry was compressed with a dictionary that is not loaded')
+
+            decompressor = zstandard.ZstdDecompressor(dict_data=_dictionary)
+
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+
+        setattr(local, attribute, decompressor)
+
+    return decompressor
+
+
+def encode(text):
+    raw = text.encode('utf-8')
+    if _codec == 'none':
+        return raw
+
+    if _codec == 'zlib':
+        payload = zlib.compress(raw, _ZLIB_LEVEL)
+
+    else:
+        payload = _zstd_compressor().compress(raw)
+
+    return _HEADER.pack(_MARKER, _CODEC_IDS[_codec], len(raw)) + payload
+
+
+def decode(payload):
+    if isinstance(payload, str):
+        # entry written before compression was introduced
+        return payload
+
+    if not payload.startswith(_MARKER):
+        return payload.decode('utf-8')
+
+    _, codec_id, raw_size = _HEADER.unpack_from(payload)
+    data = payload[_HEADER.size:]
+    if codec_id == b'z':
+        raw = zlib.decompress(data)
+
+    elif codec_id in (b's', b'd'):
+        if zstandard is None:
+            raise ValueError('cache entry requires the zstandard package')
+
+        raw = _zstd_decompressor(codec_id == b'd').decompress(data, max_output_size=raw_size)
+
+    else:
+        raise ValueError('unknown cache codec identifier: %r' % codec_id)
+
+    if len(raw) != raw_size:
+        raise ValueError('truncated cache entry: %d bytes instead of %d' % (len(raw), raw_size))
+
+    return raw.decode('utf-8')
+
+
+def portable(payload):
+    # zlib payloads decode anywhere: entries compressed with zstd (possibly with a dictionary) or not compressed
+    # are re-encoded
+    if isinstance(payload, bytes) and payload[:2] == _MARKER + _CODEC_IDS['zlib']:
+        return payload
+
+    raw = decode(payload).encode('utf-8')
+    return _HEADER.pack(_MARKER, _CODEC_IDS['zlib'], len(raw)) + zlib.compress(raw, _ZLIB_LEVEL)
+
+
+def raw_size(payload):
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+
+    if not payload.startswith(_MARKER):
+        return len(payload)
+
+    return _HEADER.unpack_from(payload)[2]
+
+
+def train_dictionary(samples, dictionary_size=_DICTIONARY_SIZE):
+    if zstandard is None:
+        raise ValueError('dictionary training requires the zstandard package')
+
+    samples = [sample.encode('utf-8') for sample in samples]
+    logging.info('training compression dictionary on %d samples', len(samples))
+    return zstandard.train_dictionary(dictionary_size, samples).as_bytes()
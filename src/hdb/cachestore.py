@@ -0,0 +1,554 @@
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from datetime import datetime
+
+from hdb import cachecodec
+
+_MAX_NODE_FILES = 0x400
+_REBALANCING_LIMIT = 0x1000
+_WRITE_BATCH_SIZE = 64
+_ACCESS_BATCH_SIZE = 256
+_SQL_VARIABLES_LIMIT = 500
+# evicts down to this fraction of the size cap so that eviction does not run on every write
+_EVICTION_TARGET = 0.9
+
+
+def _today():
+    return datetime.today().strftime('%Y%m%d')
+
+
+def _batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+
+        yield batch
+
+
+def _created_timestamp(created):
+    return time.mktime(datetime.strptime(created, '%Y%m%d').timetuple())
+
+
+# single-file store: keyed lookups go through the primary key index, writes are buffered and committed
+# in batches, and WAL journaling lets reader connections (one per thread) run alongside the writer
+class SQLiteCache(object):
+
+    def __init__(self, path, write_batch_size=_WRITE_BATCH_SIZE):
+        self._path = path
+        self._write_batch_size = write_batch_size
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._write_buffer = dict()
+        self._access_log = collections.deque()
+        self._max_size = None
+        self._eviction_policy = 'lru'
+        self.evictions = 0
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                           'key TEXT PRIMARY KEY, value TEXT NOT NULL, created TEXT NOT NULL)')
+        columns = set(row[1] for row in connection.execute('PRAGMA table_info(cache)'))
+        # bookkeeping columns added after the first release of the store
+        for column, definition in (('stored_at', 'REAL'), ('accessed_at', 'REAL'),
+                                   ('hits', 'INTEGER NOT NULL DEFAULT 0'), ('size', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                connection.execute('ALTER TABLE cache ADD COLUMN %s %s' % (column, definition))
+
+        connection.execute('UPDATE cache SET size = length(CAST(value AS BLOB)) WHERE size = 0')
+        connection.execute('CREATE INDEX IF NOT EXISTS cache_lru ON cache (accessed_at, size)')
+        connection.execute('CREATE INDEX IF NOT EXISTS cache_lfu ON cache (hits, accessed_at, size)')
+        connection.commit()
+        self._total_size = connection.execute('SELECT coalesce(sum(size), 0) FROM cache').fetchone()[0]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+
+        return connection
+
+    def set_max_size(self, max_size, eviction_policy='lru'):
+        if eviction_policy not in ('lru', 'lfu'):
+            raise ValueError('unknown eviction policy: %s' % eviction_policy)
+
+        with self._write_lock:
+            self._max_size = max_size
+            self._eviction_policy = eviction_policy
+            self._evict_locked()
+
+    def contains(self, key):
+        if key in self._write_buffer:
+            return True
+
+        row = self._connection().execute('SELECT 1 FROM cache WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def get_entry(self, key):
+        # returns (value, stored timestamp) or None
+        buffered = self._write_buffer.get(key)
+        if buffered is not None:
+            payload, _, stored_at = buffered
+
+        else:
+            row = self._connection().execute('SELECT value, created, stored_at FROM cache WHERE key = ?',
+                                             (key,)).fetchone()
+            if row is None:
+                return None
+
+            payload, created, stored_at = row
+            if stored_at is None:
+                stored_at = _created_timestamp(created)
+
+        self._record_access(key)
+        return cachecodec.decode(payload), stored_at
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+
+        return entry[0]
+
+    def _record_access(self, key):
+        # deque appends are thread-safe: readers never wait for the write lock, and only fold the access log
+        # into the table when the lock happens to be free (otherwise the next flush does)
+        self._access_log.append((key, time.time()))
+        if len(self._access_log) >= _ACCESS_BATCH_SIZE and self._write_lock.acquire(blocking=False):
+            try:
+                self._flush_locked()
+
+            finally:
+                self._write_lock.release()
+
+    def _drain_access_log(self):
+        # key -> (last access, hits)
+        accesses = dict()
+        while self._access_log:
+            key, accessed_at = self._access_log.popleft()
+            access = accesses.get(key)
+            accesses[key] = (accessed_at, access[1] + 1 if access else 1)
+
+        return accesses
+
+    def put(self, key, value, created=None):
+        payload = cachecodec.encode(value)
+        with self._write_lock:
+            self._write_buffer[key] = (payload, created or _today(), time.time())
+            if len(self._write_buffer) >= self._write_batch_size:
+                self._flush_locked()
+
+    def put_many(self, items):
+        # items: iterable of (key, value, created)
+        with self._write_lock:
+            self._flush_locked()
+            for batch in _batches(items, _WRITE_BATCH_SIZE * 16):
+                self._write_buffer = dict((key, (cachecodec.encode(value), created, _created_timestamp(created)))
+                                          for key, value, created in batch)
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._write_buffer and not self._access_log:
+            return
+
+        accesses = self._drain_access_log()
+        connection = self._connection()
+        with connection:
+            if self._write_buffer:
+                keys = list(self._write_buffer)
+                replaced_size = 0
+                for offset in range(0, len(keys), _SQL_VARIABLES_LIMIT):
+                    keys_batch = keys[offset:offset + _SQL_VARIABLES_LIMIT]
+                    query = 'SELECT coalesce(sum(size), 0) FROM cache WHERE key IN (%s)' % ','.join('?' * len(keys_batch))
+                    replaced_size += connection.execute(query, keys_batch).fetchone()[0]
+
+                rows = [(key, payload, created, stored_at, stored_at, len(payload))
+                        for key, (payload, created, stored_at) in self._write_buffer.items()]
+                connection.executemany('INSERT OR REPLACE INTO cache (key, value, created, stored_at, accessed_at, size) '
+                                       'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self._total_size += sum(row[-1] for row in rows) - replaced_size
+
+            if accesses:
+                connection.executemany('UPDATE cache SET accessed_at = ?, hits = hits + ? WHERE key = ?',
+                                       ((accessed_at, hits, key) for key, (accessed_at, hits) in accesses.items()))
+
+        self._write_buffer = dict()
+        self._evict_locked()
+
+    def _evict_locked(self):
+        if self._max_size is None or self._total_size <= self._max_size:
+            return
+
+        target_size = int(self._max_size * _EVICTION_TARGET)
+        if self._eviction_policy == 'lru':
+            query = 'SELECT key, size FROM cache ORDER BY accessed_at'
+
+        else:
+            query = 'SELECT key, size FROM cache ORDER BY hits, accessed_at'
+
+        connection = self._connection()
+        evicted_keys = list()
+        for key, size in connection.execute(query):
+            if self._total_size <= target_size:
+                break
+
+            evicted_keys.append((key,))
+            self._total_size -= size
+
+        with connection:
+            connection.executemany('DELETE FROM cache WHERE key = ?', evicted_keys)
+
+        self.evictions += len(evicted_keys)
+        logging.info('evicted %d cache entries (%s), cache size now %d bytes',
+                     len(evicted_keys), self._eviction_policy, self._total_size)
+
+    def flush(self):
+        with self._write_lock:
+            self._flush_locked()
+
+    def items(self):
+        self.flush()
+        for key, value, created in self._connection().execute('SELECT key, value, created FROM cache'):
+            yield key, cachecodec.decode(value), created
+
+    def payload_items(self):
+        # (key, stored payload, stored timestamp), without decoding
+        self.flush()
+        for key, payload, created, stored_at in self._connection().execute(
+                'SELECT key, value, created, stored_at FROM cache ORDER BY key'):
+            yield key, payload, stored_at if stored_at is not None else _created_timestamp(created)
+
+    def merge_payloads(self, items):
+        # bulk write of (key, payload, stored timestamp) items, skipping keys stored more recently in the cache
+        written = 0
+        with self._write_lock:
+            self._flush_locked()
+            connection = self._connection()
+            for batch in _batches(items, _SQL_VARIABLES_LIMIT):
+                query = 'SELECT key, coalesce(stored_at, 0) FROM cache WHERE key IN (%s)' % ','.join('?' * len(batch))
+                stored = dict(connection.execute(query, [key for key, _, _ in batch]).fetchall())
+                self._write_buffer = dict((key, (payload, datetime.fromtimestamp(stored_at).strftime('%Y%m%d'),
+                                                 stored_at))
+                                          for key, payload, stored_at in batch
+                                          if stored_at > stored.get(key, float('-inf')))
+                written += len(self._write_buffer)
+                self._flush_locked()
+
+        return written
+
+    def stats(self):
+        self.flush()
+        entries = raw_bytes = stored_bytes = 0
+        # only the payload header is needed to find the uncompressed size
+        query = 'SELECT length(CAST(value AS BLOB)), CASE typeof(value) WHEN \'blob\' THEN substr(value, 1, 6) ' \
+                'ELSE NULL END FROM cache'
+        for stored_size, header in self._connection().execute(query):
+            entries += 1
+            stored_bytes += stored_size
+            raw_bytes += cachecodec.raw_size(header) if header is not None and header.startswith(b'\x00') else stored_size
+
+        return entries, raw_bytes, stored_bytes
+
+    def close(self):
+        self.flush()
+
+
+def _get_directories_under(path):
+    return (node for node in os.listdir(path) if os.path.isdir(os.path.join(path, node)))
+
+
+def _get_files_under(path):
+    return (node for node in os.listdir(path) if os.path.isfile(os.path.join(path, node)))
+
+
+def _generator_count(a_generator):
+    return sum(1 for item in a_generator)
+
+
+def _divide_node(path, nodes_path):
+    level = len(nodes_path)
+    new_node_sup_init = 'FF' * 20
+    new_node_inf_init = '7F' + 'FF' * 19
+    if level > 0:
+        new_node_sup = nodes_path[-1]
+        new_node_diff = (int(new_node_sup_init, 16) - int(new_node_inf_init, 16)) >> level
+        new_node_inf = '%0.40X' % (int(new_node_sup, 16) - new_node_diff)
+
+    else:
+        new_node_sup = new_node_sup_init
+        new_node_inf = new_node_inf_init
+
+    new_path_1 = os.path.sep.join([path] + nodes_path + [new_node_inf.lower()])
+    new_path_2 = os.path.sep.join([path] + nodes_path + [new_node_sup.lower()])
+    return os.path.abspath(new_path_1), os.path.abspath(new_path_2)
+
+
+def file_size(filename):
+    count = -1
+    with open(filename) as file_lines:
+        for count, line in enumerate(file_lines):
+            pass
+
+    return count + 1
+
+
+class CacheTreeError(Exception):
+    pass
+
+
+def _digest(key):
+    hash_md5 = hashlib.md5()
+    hash_md5.update(key.encode('utf-8'))
+    return hash_md5.hexdigest()
+
+
+def _is_digest(filename):
+    # cache entries, as opposed to the index and temporary files
+    return len(filename) == 32
+
+
+# legacy store: one file per MD5 digest in a directory tree that is split in two whenever a node
+# holds too many files, plus an append-only index of "date digest: key" lines
+# writers (puts and rebalancing) are serialized, readers take no lock: entries are renamed into place once
+# complete, and a reader missing an entry retries if a rebalancing ran meanwhile (seqlock-style generation,
+# odd while rebalancing)
+class DirectoryTreeCache(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._write_lock = threading.Lock()
+        self._generation = 0
+        self.evictions = 0
+
+    def set_max_size(self, max_size, eviction_policy='lru'):
+        if max_size is not None:
+            raise ValueError('the directory-tree cache does not support a size cap')
+
+    def rebalance_cache_tree(self):
+        with self._write_lock:
+            self._generation += 1
+            try:
+                self._rebalance_locked(list())
+
+            finally:
+                self._generation += 1
+
+    def _rebalance_locked(self, nodes_path):
+        path = self._path
+        current_path = os.path.sep.join([path] + nodes_path)
+        files_node = (filename for filename in _get_files_under(current_path) if _is_digest(filename))
+        rebalancing_required = _generator_count(itertools.islice(files_node, _MAX_NODE_FILES + 1)) > _MAX_NODE_FILES
+        if rebalancing_required:
+            new_path_1, new_path_2 = _divide_node(path, nodes_path)
+            logging.info('rebalancing required, creating nodes: %s and %s', os.path.abspath(new_path_1), os.path.abspath(new_path_2))
+            # upper node first: on its own it covers every digest of the node being split
+            if not os.path.exists(new_path_2):
+                os.makedirs(new_path_2)
+
+            if not os.path.exists(new_path_1):
+                os.makedirs(new_path_1)
+
+            for filename in _get_files_under(current_path):
+                if not _is_digest(filename):
+                    continue
+
+                file_path = os.path.sep.join([current_path, filename])
+                # digests are compared with the node names (not the paths, which may be relative)
+                if filename <= os.path.basename(new_path_1):
+                    logging.debug('moving %s to %s', filename, new_path_1)
+                    os.rename(file_path, os.path.sep.join([new_path_1, filename]))
+
+                else:
+                    logging.debug('moving %s to %s', filename, new_path_2)
+                    os.rename(file_path, os.path.sep.join([new_path_2, filename]))
+
+        for directory in _get_directories_under(current_path):
+            self._rebalance_locked(nodes_path + [directory])
+
+    def find_node(self, digest, path=None):
+        if not path:
+            path = self._path
+
+        directories = sorted(_get_directories_under(path))
+
+        if not directories:
+            return path
+
+        else:
+            target_directory = None
+            for directory_name in directories:
+                if digest <= directory_name:
+                    target_directory = directory_name
+                    break
+
+            if not target_directory:
+                raise CacheTreeError('Inconsistent cache tree')
+
+            return self.find_node(digest, path=os.path.sep.join([path, target_directory]))
+
+    def get_cache_filename(self, key):
+        digest = _digest(key)
+        target_node = self.find_node(digest)
+        cache_filename = os.sep.join([target_node, digest])
+        return cache_filename
+
+    def contains(self, key):
+        return self._read(key) is not None
+
+    def put(self, key, value, created=None):
+        payload = cachecodec.encode(value)
+        index_name = os.path.sep.join([self._path, 'index'])
+        with self._write_lock:
+            filename = self.get_cache_filename(key)
+            # a crash while writing leaves a temporary file, never a truncated entry
+            temp_filename = '%s.%d.tmp' % (filename, threading.get_ident())
+            with open(temp_filename, 'wb') as cache_content:
+                cache_content.write(payload)
+
+            os.replace(temp_filename, filename)
+            with open(index_name, 'a') as index_file:
+                filename_digest = filename.split(os.path.sep)[-1]
+                index_file.write('%s %s: "%s"\n' % (created or _today(), filename_digest, key))
+
+            rebalancing_required = file_size(index_name) % _REBALANCING_LIMIT == 0
+
+        if rebalancing_required:
+            logging.debug('rebalancing cache')
+            self.rebalance_cache_tree()
+
+    def _read(self, key):
+        # (payload, stored timestamp) or None
+        digest = _digest(key)
+        while True:
+            generation = self._generation
+            try:
+                with open(os.sep.join([self.find_node(digest), digest]), 'rb') as cache_content:
+                    return cache_content.read(), os.fstat(cache_content.fileno()).st_mtime
+
+            except (OSError, CacheTreeError):
+                # only a miss if no rebalancing ran during the lookup
+                if generation % 2 == 0 and generation == self._generation:
+                    return None
+
+                time.sleep(0.001)
+
+    def get_entry(self, key):
+        entry = self._read(key)
+        if entry is None:
+            return None
+
+        content, stored_at = entry
+        try:
+            return cachecodec.decode(content), stored_at
+
+        except (ValueError, zlib.error, struct.error):
+            # truncated by a crash before writes were atomic: treated as missing, the next download overwrites it
+            logging.warning('ignoring corrupted cache entry: %s', key)
+            return None
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+
+        return entry[0]
+
+    def _indexed_keys(self):
+        # the index is append-only: the last line for a key carries the date of the file on disk
+        index_name = os.path.sep.join([self._path, 'index'])
+        if not os.path.exists(index_name):
+            return list()
+
+        created_by_key = dict()
+        with open(index_name) as index_file:
+            for line in index_file:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+
+                created, remainder = line.split(' ', 1)
+                _, quoted_key = remainder.split(': ', 1)
+                created_by_key[quoted_key[1:-1]] = created
+
+        return created_by_key.items()
+
+    def items(self):
+        for key, created in self._indexed_keys():
+            value = self.get(key)
+            if value is None:
+                logging.warning('indexed entry missing from cache tree: %s', key)
+                continue
+
+            yield key, value, created
+
+    def payload_items(self):
+        for key, _ in self._indexed_keys():
+            entry = self._read(key)
+            if entry is None:
+                logging.warning('indexed entry missing from cache tree: %s', key)
+                continue
+
+            payload, stored_at = entry
+            yield key, payload, stored_at
+
+    def merge_payloads(self, items):
+        # one pass under the write lock and a single rebalancing at the end, instead of a put (and its
+        # rebalancing check) per entry
+        index_name = os.path.sep.join([self._path, 'index'])
+        written = 0
+        with self._write_lock:
+            with open(index_name, 'a') as index_file:
+                for key, payload, stored_at in items:
+                    filename = self.get_cache_filename(key)
+                    if os.path.exists(filename) and os.path.getmtime(filename) >= stored_at:
+                        continue
+
+                    temp_filename = '%s.%d.tmp' % (filename, threading.get_ident())
+                    with open(temp_filename, 'wb') as cache_content:
+                        cache_content.write(payload)
+
+                    # the file time is the stored timestamp used for expiry
+                    os.utime(temp_filename, (stored_at, stored_at))
+                    os.replace(temp_filename, filename)
+                    index_file.write('%s %s: "%s"\n' % (datetime.fromtimestamp(stored_at).strftime('%Y%m%d'),
+                                                        filename.split(os.path.sep)[-1], key))
+                    written += 1
+
+        self.rebalance_cache_tree()
+        return written
+
+    def stats(self):
+        entries = raw_bytes = stored_bytes = 0
+        for directory, _, filenames in os.walk(self._path):
+            for filename in filenames:
+                if not _is_digest(filename):
+                    # index and other bookkeeping files
+                    continue
+
+                with open(os.path.join(directory, filename), 'rb') as cache_content:
+                    header = cache_content.read(6)
+
+                stored_size = os.path.getsize(os.path.join(directory, filename))
+                entries += 1
+                stored_bytes += stored_size
+                raw_bytes += cachecodec.raw_size(header) if header.startswith(b'\x00') else stored_size
+
+        return entries, raw_bytes, stored_bytes
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
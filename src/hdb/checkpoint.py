@@ -0,0 +1,102 @@
+import logging
+import os
+import sqlite3
+import time
+
+_CHECKPOINT_FILE = 'checkpoint.sqlite'
+
+
+class Checkpoint(object):
+
+    def __init__(self, data_dir, stage):
+        self._stage = stage
+        self._path = os.path.join(data_dir, _CHECKPOINT_FILE)
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS checkpoint ('
+                                 'stage TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (stage, key)'
+                                 ') WITHOUT ROWID')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS completed_stages (stage TEXT PRIMARY KEY)')
+        self._connection.commit()
+
+    def done_keys(self):
+        rows = self._connection.execute('SELECT key FROM checkpoint WHERE stage = ?', (self._stage,))
+        return set(key for key, in rows)
+
+    def mark_done(self, key):
+        self._connection.execute('INSERT OR IGNORE INTO checkpoint (stage, key) VALUES (?, ?)', (self._stage, key))
+        self._connection.commit()
+
+    def mark_done_many(self, keys):
+        if not keys:
+            return
+
+        self._connection.executemany('INSERT OR IGNORE INTO checkpoint (stage, key) VALUES (?, ?)',
+                                     ((self._stage, key) for key in keys))
+        self._connection.commit()
+
+    def is_complete(self):
+        row = self._connection.execute('SELECT 1 FROM completed_stages WHERE stage = ?', (self._stage,)).fetchone()
+        return row is not None
+
+    def mark_complete(self):
+        self._connection.execute('INSERT OR IGNORE INTO completed_stages (stage) VALUES (?)', (self._stage,))
+        self._connection.commit()
+
+    def reset(self):
+        logging.debug('resetting checkpoint for stage %s', self._stage)
+        self._connection.execute('DELETE FROM checkpoint WHERE stage = ?', (self._stage,))
+        self._connection.execute('DELETE FROM completed_stages WHERE stage = ?', (self._stage,))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+class DeadLetters(object):
+    # tasks that still failed after their retries, kept across runs until a later attempt succeeds: the run
+    # goes on without them and they are retried in a final pass
+
+    def __init__(self, data_dir):
+        self._path = os.path.join(data_dir, _CHECKPOINT_FILE)
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS dead_letters ('
+                                 'stage TEXT NOT NULL, key TEXT NOT NULL, error TEXT NOT NULL, '
+                                 'attempts INTEGER NOT NULL, failed REAL NOT NULL, PRIMARY KEY (stage, key)'
+                                 ') WITHOUT ROWID')
+        self._connection.commit()
+
+    def add(self, stage, key, error):
+        self._connection.execute('INSERT INTO dead_letters (stage, key, error, attempts, failed) '
+                                 'VALUES (?, ?, ?, 1, ?) ON CONFLICT (stage, key) DO UPDATE SET '
+                                 'error = excluded.error, attempts = attempts + 1, failed = excluded.failed',
+                                 (stage, key, error, time.time()))
+        self._connection.commit()
+
+    def remove(self, stage, key):
+        self._connection.execute('DELETE FROM dead_letters WHERE stage = ? AND key = ?', (stage, key))
+        self._connection.commit()
+
+    def keys(self, stage):
+        rows = self._connection.execute('SELECT key FROM dead_letters WHERE stage = ? ORDER BY key', (stage,))
+        return [key for key, in rows]
+
+    def entries(self):
+        # (stage, key, error, attempts) of every dead letter
+        return self._connection.execute('SELECT stage, key, error, attempts FROM dead_letters '
+                                        'ORDER BY stage, key').fetchall()
+
+    def close(self):
+        self._connection.close()
+
+
+def reset_checkpoints(data_dir):
+    path = os.path.join(data_dir, _CHECKPOINT_FILE)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    logging.info('cleared checkpoints under %s', data_dir)
@@ -0,0 +1,332 @@
+import argparse
+import datetime
+import logging
+import sys
+
+from hdb import metrics
+
+# hdbretrieve command line: arguments are parsed before anything heavy is imported, then each command only
+# imports what it uses (pandas and pyarrow to generate outputs, the HTTP stack to crawl)
+
+_DATA_DIR = '.hdb/'
+_HDB_URL = 'https://services2.hdb.gov.sg'
+_LOG_FORMAT = '%(asctime)s:%(name)s:%(levelname)s:%(message)s'
+_COMMANDS = ('crawl', 'export', 'cache-stats', 'serve')
+
+
+def _setup_logging(log_file=None):
+    logging.basicConfig(level=logging.INFO, format=_LOG_FORMAT)
+    logging.getLogger('requests').setLevel(logging.WARNING)
+    if log_file is not None:
+        file_handler = logging.FileHandler(log_file, mode='w')
+        formatter = logging.Formatter(_LOG_FORMAT)
+        file_handler.setFormatter(formatter)
+        logging.getLogger().addHandler(file_handler)
+
+
+def _shard(value):
+    # i/N, 1-based on the command line, 0-based internally
+    try:
+        index, count = (int(part) for part in value.split('/'))
+
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, e.g. 2/4: %s' % value)
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard index must be between 1 and %d: %s' % (count, value))
+
+    return index - 1, count
+
+
+def _configure_downloads(args):
+    from hdb.hdbdownload import set_hdb_url, set_pool_size, set_parse_workers, set_engine, set_cache_expiry
+    from hdb.throttle import set_rate_limit, set_adaptive_concurrency, set_circuit_breaker
+    from hdb.urlcaching import set_cache_http, set_cache_max_size, set_cache_revalidation
+    set_hdb_url(args.hdb_url)
+    set_pool_size(args.ntasks)
+    set_parse_workers(args.nparsers)
+    set_engine(args.engine)
+    set_rate_limit(args.rate_limit)
+    set_circuit_breaker(args.circuit_breaker)
+    if args.adaptive:
+        set_adaptive_concurrency(args.ntasks)
+
+    if args.use_cache or args.prewarm or args.revalidate:
+        if args.cache_max_size:
+            set_cache_max_size(args.cache_max_size * 1024 * 1024, args.cache_eviction)
+
+        set_cache_http('~/.urlcaching')
+        set_cache_expiry()
+        set_cache_revalidation(args.revalidate)
+
+
+def _crawl(args, data_dir):
+    from hdb import asyncfetch
+    from hdb.checkpoint import reset_checkpoints
+    from hdb.hdbdownload import generate_buildings_db, generate_units_db, generate_leases_db, generate_ethnic_db, \
+        generate_pipelined_dbs, refresh_buildings_db, refresh_units_db, refresh_leases_db, set_data_dir, \
+        close_parse_workers
+    from hdb.urlcaching import cache_counters
+    set_data_dir(data_dir)
+    if args.fresh:
+        reset_checkpoints(data_dir)
+
+    logging.info('started')
+    if args.incremental:
+        logging.info('refreshing buildings data')
+        refresh_buildings_db(args.max_building_id, args.miss_limit)
+        logging.info('refreshing leases data')
+        refresh_leases_db()
+        logging.info('refreshing units data')
+        refresh_units_db()
+
+    elif args.sequential:
+        logging.info('generating buildings data')
+        generate_buildings_db(args.max_building_id, args.miss_limit)
+        logging.info('generating leases data')
+        generate_leases_db()
+        logging.info('generating units data')
+        generate_units_db()
+        if args.ethnic:
+            logging.info('generating ethnic data')
+            generate_ethnic_db(args.ethnic)
+
+    else:
+        logging.info('generating buildings, leases and units data')
+        generate_pipelined_dbs(args.max_building_id, args.miss_limit, ethnic_output_path=args.ethnic)
+
+    asyncfetch.close()
+    close_parse_workers()
+    if args.use_cache or args.prewarm or args.revalidate:
+        logging.info('cache counters: %s', cache_counters())
+
+
+def _crawl_shard(args, index, count):
+    # entry point of the local shard processes (spawned, hence configured from scratch)
+    from hdb.hdbdownload import set_data_dir, set_shard, shard_data_dir
+    data_dir = shard_data_dir(_DATA_DIR, index, count)
+    set_data_dir(data_dir)
+    _setup_logging(data_dir + 'hdb.log')
+    metrics.set_report_interval(args.metrics_interval)
+    _configure_downloads(args)
+    set_shard(index, count)
+    _crawl(args, data_dir)
+    metrics.write_json_report(data_dir + 'metrics.json')
+
+
+def _crawl_processes(args, count):
+    # one shard per process; the cache (prewarmed beforehand if requested) is shared through its SQLite file
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_crawl_shard, args=(args, index, count), name='shard-%d' % (index + 1))
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('crawl failed in %s (see the hdb.log file of each shard)' % ', '.join(failed))
+
+
+def _merge_shards(count):
+    from hdb.hdbdownload import merge_shards
+    logging.info('merging %d shards', count)
+    merge_shards(_DATA_DIR, count)
+
+
+def _generate_output(args, changelog=False, changes_since=None):
+    from hdb.hdbdownload import generate_excel, generate_changelog, export_csv
+    logging.info('generating output')
+    generate_excel(_DATA_DIR, './', args.output_file, args.output_format)
+    if changelog:
+        generate_changelog(_DATA_DIR, './', args.output_file, since=changes_since)
+
+    if args.export_csv:
+        export_csv(_DATA_DIR, './')
+
+
+def _write_metrics(args):
+    metrics.log_summary()
+    metrics.write_json_report(args.metrics_report)
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+
+
+def crawl(args):
+    from hdb.hdbdownload import set_data_dir, set_shard, shard_data_dir
+    from hdb.urlcaching import import_cache, close_cache
+    _setup_logging('hdb.log')
+    set_data_dir(_DATA_DIR)
+    started = datetime.datetime.now().replace(microsecond=0)
+    metrics.set_report_interval(args.metrics_interval)
+
+    if args.merge_shards:
+        _merge_shards(args.merge_shards)
+
+    elif not args.only_output:
+        if args.ethnic and (args.shard or args.processes > 1):
+            raise ValueError('--ethnic is not supported by sharded crawls')
+
+        _configure_downloads(args)
+        for archive in args.prewarm or []:
+            import_cache(archive)
+
+        if args.processes > 1:
+            close_cache()
+            _crawl_processes(args, args.processes)
+            _merge_shards(args.processes)
+
+        elif args.shard:
+            index, count = args.shard
+            set_shard(index, count)
+            _crawl(args, shard_data_dir(_DATA_DIR, index, count))
+            logging.info('shard %d/%d complete: combine the shards with --merge-shards %d', index + 1, count, count)
+            metrics.write_json_report(args.metrics_report)
+            return
+
+        else:
+            _crawl(args, _DATA_DIR)
+
+    _generate_output(args, changelog=args.incremental, changes_since=started)
+    _write_metrics(args)
+
+
+def export(args):
+    # outputs from the stores of a previous crawl, without any download
+    from hdb.hdbdownload import set_data_dir
+    _setup_logging('hdb.log')
+    set_data_dir(_DATA_DIR)
+    if args.merge_shards:
+        _merge_shards(args.merge_shards)
+
+    _generate_output(args, changelog=args.changelog)
+
+
+def print_cache_stats(stats):
+    print('entries:           %d' % stats['entries'])
+    print('uncompressed size: %d bytes' % stats['raw_bytes'])
+    print('stored size:       %d bytes' % stats['stored_bytes'])
+    print('compression ratio: %.2f' % stats['compression_ratio'])
+    print('disk saved:        %d bytes' % stats['saved_bytes'])
+
+
+def cache_stats(args):
+    from hdb import urlcaching
+    _setup_logging()
+    urlcaching.set_cache_http(args.cache_path, backend=args.backend)
+    print_cache_stats(urlcaching.cache_stats())
+    urlcaching.close_cache()
+
+
+def serve(args):
+    # lookups over the stores of a previous crawl, see hdb.query
+    from hdb import query
+    _setup_logging()
+    query.serve(query.load(_DATA_DIR), args.port, args.host)
+
+
+def _add_output_arguments(parser):
+    parser.add_argument('output_file', type=str, nargs='?', help='name of the output Excel file', default='hdb.xlsx')
+    parser.add_argument('--output-format', choices=['xlsx', 'csv', 'parquet'],
+                        help='output file format (inferred from the file extension by default)')
+    parser.add_argument('--export-csv', help='also exports the intermediate data as CSV files', action='store_true')
+    parser.add_argument('--merge-shards', type=int, metavar='N', help='combines the partial stores of the N shards '
+                                                                      'into the final dataset, then generates the '
+                                                                      'output (no download)')
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Loading building data from HDB (crawl is the default command).',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                                     )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    crawl_parser = subparsers.add_parser('crawl', help='crawls the HDB services and generates the output',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    crawl_parser.set_defaults(command_function=crawl)
+    _add_output_arguments(crawl_parser)
+    crawl_parser.add_argument('--ntasks', type=int, help='number of simultaneous downloads (maximum with --adaptive)',
+                              default=40)
+    crawl_parser.add_argument('--adaptive', help='adapts the number of simultaneous downloads per endpoint to the '
+                                                 'latency and error rate of the HDB servers', action='store_true')
+    crawl_parser.add_argument('--rate-limit', type=float, help='max requests per second on each HDB endpoint')
+    crawl_parser.add_argument('--circuit-breaker', type=int, metavar='N', help='pauses the requests to an HDB '
+                                                                               'endpoint after N consecutive '
+                                                                               'failures (0 disables)', default=10)
+    crawl_parser.add_argument('--nparsers', type=int, help='number of parser processes (0 parses in the download '
+                                                           'workers)', default=0)
+    crawl_parser.add_argument('--use-cache', help='stores downloaded HDB files locally', action='store_true')
+    crawl_parser.add_argument('--cache-max-size', type=int, help='cache size cap in MB (no cap by default)')
+    crawl_parser.add_argument('--cache-eviction', choices=['lru', 'lfu'], help='cache eviction policy', default='lru')
+    crawl_parser.add_argument('--prewarm', type=str, nargs='+', help='merges these cache archives (see '
+                                                                      'hdbcachearchive.py) into the cache before '
+                                                                      'crawling, implies --use-cache')
+    crawl_parser.add_argument('--revalidate', help='revalidates expired cache entries with conditional requests '
+                                                   '(ETag, Last-Modified) and content hashes, unchanged responses '
+                                                   'keep their stored record; implies --use-cache',
+                              action='store_true')
+    crawl_parser.add_argument('--only-output', help='skips downloading steps (same as the export command)',
+                              action='store_true')
+    crawl_parser.add_argument('--max-building-id', type=int, help='max building id to scan (found automatically by '
+                                                                  'default)')
+    crawl_parser.add_argument('--miss-limit', type=int, help='consecutive missing building ids ending the scan',
+                              default=500)
+    crawl_parser.add_argument('--fresh', help='ignores checkpoints and crawls every stage from scratch',
+                              action='store_true')
+    crawl_parser.add_argument('--incremental', help='re-fetches only the stale records of a previous crawl and '
+                                                    'writes a changelog of the changed buildings', action='store_true')
+    crawl_parser.add_argument('--metrics-report', help='end-of-run metrics report (JSON)', default='.hdb/metrics.json')
+    crawl_parser.add_argument('--prometheus-file', help='also writes the metrics in Prometheus text format to this '
+                                                        'file')
+    crawl_parser.add_argument('--metrics-interval', type=float, help='seconds between metrics summaries in the log',
+                              default=60.)
+    crawl_parser.add_argument('--sequential', help='crawls the stages one after the other instead of fetching the '
+                                                   'units and leases of each postal code as soon as it is found',
+                              action='store_true')
+    crawl_parser.add_argument('--ethnic', metavar='FILE', help='also crawls the ethnic quotas of each postal code '
+                                                               'into this file')
+    crawl_parser.add_argument('--engine', choices=['threads', 'async'], help='download engine', default='threads')
+    crawl_parser.add_argument('--hdb-url', help='HDB web services root, e.g. a local stand-in server',
+                              default=_HDB_URL)
+    crawl_parser.add_argument('--shard', type=_shard, metavar='i/N', help='crawls only shard i of N (building id '
+                                                                          'blocks and their postal codes) into '
+                                                                          'partial stores under .hdb/shard-i-of-N, '
+                                                                          'without output')
+    crawl_parser.add_argument('--processes', type=int, help='crawls in this many local processes, one shard each '
+                                                            '(and --ntasks downloads each), then merges them',
+                              default=1)
+
+    export_parser = subparsers.add_parser('export', help='generates the output from the data of previous crawls',
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    export_parser.set_defaults(command_function=export)
+    _add_output_arguments(export_parser)
+    export_parser.add_argument('--changelog', help='also writes the changes recorded by all incremental runs',
+                               action='store_true')
+
+    stats_parser = subparsers.add_parser('cache-stats', help='reports URL cache size and compression ratio',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    stats_parser.set_defaults(command_function=cache_stats)
+    stats_parser.add_argument('cache_path', type=str, nargs='?', help='cache directory', default='~/.urlcaching')
+    stats_parser.add_argument('--backend', choices=['sqlite', 'tree'], help='cache backend', default='sqlite')
+
+    serve_parser = subparsers.add_parser('serve', help='serves lookups over the data of previous crawls as JSON '
+                                                       'on a local HTTP endpoint',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    serve_parser.set_defaults(command_function=serve)
+    serve_parser.add_argument('--port', type=int, help='listening port', default=8780)
+    serve_parser.add_argument('--host', help='listening address', default='127.0.0.1')
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # crawl is the default command, as before subcommands existed
+    if not argv or argv[0] not in _COMMANDS + ('-h', '--help'):
+        argv = ['crawl'] + list(argv)
+
+    args = _parser().parse_args(argv)
+    args.command_function(args)
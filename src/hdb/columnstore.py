@@ -0,0 +1,227 @@
+import logging
+import os
+import time
+
+import pyarrow
+import pyarrow.compute
+import pyarrow.ipc
+
+from hdb import metrics
+from hdb.records import ColumnAccumulator, EncodedColumn
+
+_PART_PREFIX = 'part-'
+_PART_SUFFIX = '.arrow'
+_FLUSH_ROWS = 1000
+_FLUSH_INTERVAL = 30.
+
+
+def _convert(field, values):
+    # values are typed by the parsers: only the postal codes, checked 6-digit strings, are encoded here
+    if pyarrow.types.is_fixed_size_binary(field.type):
+        return [None if value is None else value.encode('ascii') for value in values]
+
+    return values
+
+
+def _from_text(field, values):
+    # values read back from a CSV file, all strings
+    if pyarrow.types.is_integer(field.type):
+        return [None if value == '' else int(value) for value in values]
+
+    if pyarrow.types.is_fixed_size_binary(field.type):
+        # postal codes written by versions reading them as numbers lost their leading zeros
+        return [None if value == '' else value.zfill(field.type.byte_width) for value in values]
+
+    return values
+
+
+def _is_encoded(field):
+    # integer and timestamp values are mostly distinct: only the other columns are dictionary-encoded
+    return not (pyarrow.types.is_integer(field.type) or pyarrow.types.is_timestamp(field.type))
+
+
+def _encoded_array(field, column):
+    # each distinct value is converted once, then taken (or referenced by a dictionary field) by the codes
+    indices = pyarrow.Array.from_buffers(pyarrow.int32(), len(column.codes), [None, pyarrow.py_buffer(column.codes)])
+    if pyarrow.types.is_dictionary(field.type):
+        dictionary = pyarrow.array(_convert(pyarrow.field(field.name, field.type.value_type), column.values),
+                                   type=field.type.value_type)
+        return pyarrow.DictionaryArray.from_arrays(indices.cast(field.type.index_type), dictionary)
+
+    return pyarrow.array(_convert(field, column.values), type=field.type).take(indices)
+
+
+class ColumnStore(object):
+    # typed columnar table stored as a directory of Arrow IPC files: rows are appended in batches, each batch
+    # becoming a new part file renamed into place once complete, and readers memory-map the parts (zero-copy)
+
+    def __init__(self, path, schema, flush_rows=_FLUSH_ROWS, flush_interval=_FLUSH_INTERVAL):
+        self._path = path
+        self._schema = schema
+        self._flush_rows = flush_rows
+        self._flush_interval = flush_interval
+        # appended rows not yet written, accumulated column by column
+        self._rows = ColumnAccumulator(schema.names, [field.name for field in schema if _is_encoded(field)])
+        self._keys = list()
+        self._last_flush = time.monotonic()
+
+    def exists(self):
+        return os.path.isdir(self._path)
+
+    def modified(self):
+        # time of the last write, 0 for an empty store
+        return max([os.path.getmtime(part_file) for part_file in self._part_files()] or [0.])
+
+    def _part_files(self):
+        if not self.exists():
+            return list()
+
+        return sorted(os.path.join(self._path, filename) for filename in os.listdir(self._path)
+                      if filename.startswith(_PART_PREFIX) and filename.endswith(_PART_SUFFIX))
+
+    def _next_part_file(self):
+        part_files = self._part_files()
+        index = int(os.path.basename(part_files[-1])[len(_PART_PREFIX):-len(_PART_SUFFIX)]) + 1 if part_files else 0
+        return os.path.join(self._path, '%s%08d%s' % (_PART_PREFIX, index, _PART_SUFFIX))
+
+    def reset(self):
+        for part_file in self._part_files():
+            os.remove(part_file)
+
+        os.makedirs(self._path, exist_ok=True)
+        self._rows.clear()
+        self._keys = list()
+
+    def _write_part(self, table):
+        os.makedirs(self._path, exist_ok=True)
+        part_file = self._next_part_file()
+        temp_file = part_file + '.tmp'
+        store_name = os.path.basename(self._path)
+        with metrics.timer('hdb_store_write_seconds', store=store_name):
+            with pyarrow.OSFile(temp_file, 'wb') as sink:
+                with pyarrow.ipc.new_file(sink, self._schema) as writer:
+                    writer.write_table(table)
+
+            os.replace(temp_file, part_file)
+
+        metrics.count('hdb_store_rows_written_total', table.num_rows, store=store_name)
+        metrics.count('hdb_store_bytes_written_total', os.path.getsize(part_file), store=store_name)
+
+    def _table(self, rows):
+        columns = list(zip(*rows)) if rows else [list() for _ in self._schema]
+        arrays = [pyarrow.array(_convert(field, list(values)), type=field.type)
+                  for field, values in zip(self._schema, columns)]
+        return pyarrow.Table.from_arrays(arrays, schema=self._schema)
+
+    def _accumulated_table(self):
+        arrays = list()
+        for field in self._schema:
+            column = self._rows.raw_column(field.name)
+            if isinstance(column, EncodedColumn):
+                arrays.append(_encoded_array(field, column))
+
+            else:
+                arrays.append(pyarrow.array(_convert(field, column), type=field.type))
+
+        return pyarrow.Table.from_arrays(arrays, schema=self._schema)
+
+    def typed_rows(self, rows):
+        # rows as read back from the store
+        return [tuple(row.values()) for row in self._table(rows).to_pylist()]
+
+    def append(self, rows, key=None):
+        # rows are tuples in schema order; key identifies the unit of work the rows belong to (possibly
+        # without any row) and is returned by the flush that made those rows durable
+        self._rows.extend(rows)
+        if key is not None:
+            self._keys.append(key)
+
+        if len(self._rows) >= self._flush_rows or time.monotonic() - self._last_flush >= self._flush_interval:
+            return self.flush()
+
+        return list()
+
+    def flush(self):
+        # returns the keys whose rows are now on disk
+        if len(self._rows):
+            self._write_part(self._accumulated_table())
+
+        else:
+            os.makedirs(self._path, exist_ok=True)
+
+        keys = self._keys
+        self._rows.clear()
+        self._keys = list()
+        self._last_flush = time.monotonic()
+        return keys
+
+    def compact(self):
+        part_files = self._part_files()
+        if len(part_files) < 2:
+            return
+
+        # the compacted part is written before the former parts are removed: an interruption in between
+        # leaves duplicated rows, which readers drop anyway
+        self._write_part(self.read_table().combine_chunks())
+        for part_file in part_files:
+            os.remove(part_file)
+
+        logging.debug('compacted %d parts under %s', len(part_files), self._path)
+
+    def replace(self, key_column, keys, rows):
+        # rewrites the store without the rows of the given keys, followed by their new rows
+        if not keys:
+            return
+
+        part_files = self._part_files()
+        table = self.read_table()
+        key_field = self._schema.field(key_column)
+        key_values = pyarrow.array(_convert(key_field, list(keys)), type=key_field.type)
+        kept = table.filter(pyarrow.compute.invert(pyarrow.compute.is_in(table.column(key_column),
+                                                                         value_set=key_values)))
+        self._write_part(pyarrow.concat_tables([kept, self._table(rows)]).combine_chunks())
+        for part_file in part_files:
+            os.remove(part_file)
+
+        logging.debug('replaced %d keys (%d rows) under %s', len(keys), len(rows), self._path)
+
+    def overwrite(self, table):
+        # replaces the whole content of the store with the given table
+        part_files = self._part_files()
+        self._write_part(table.cast(self._schema).combine_chunks())
+        for part_file in part_files:
+            os.remove(part_file)
+
+    def close(self):
+        keys = self.flush()
+        self.compact()
+        return keys
+
+    def read_table(self, columns=None):
+        tables = [pyarrow.ipc.open_file(pyarrow.memory_map(part_file)).read_all() for part_file in self._part_files()]
+        table = pyarrow.concat_tables(tables) if tables else self._schema.empty_table()
+        if columns is not None:
+            table = table.select(columns)
+
+        return table
+
+    def read_frame(self, columns=None):
+        table = self.read_table(columns)
+        for position, field in enumerate(table.schema):
+            if pyarrow.types.is_fixed_size_binary(field.type):
+                table = table.set_column(position, field.name, table.column(position).cast(pyarrow.string()))
+
+        return table.to_pandas()
+
+    def import_csv(self, csv_path):
+        import pandas
+        self.reset()
+        csv_df = pandas.read_csv(csv_path, dtype=str, keep_default_na=False)[self._schema.names]
+        self._rows.extend(zip(*[_from_text(field, csv_df[field.name].tolist()) for field in self._schema]))
+        self.flush()
+        return len(csv_df)
+
+    def export_csv(self, csv_path):
+        export_df = self.read_frame()
+        export_df.to_csv(csv_path, index=False)
+        return len(export_df)
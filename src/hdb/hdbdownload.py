@@ -1,24 +1,106 @@
-import csv
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import functools
 import logging
 import os
+import time
 
 import itertools
-import numpy
-import pandas
-from bs4 import BeautifulSoup
+import pyarrow
+import pyarrow.compute
 from retrying import retry
 
-from hdb.taskpool import TaskPool
-from hdb.urlcaching import open_url
+from hdb import asyncfetch, metrics, xmlparse
+from hdb.asyncfetch import open_url_async, open_url_checked_async, retry_async, map_unordered, set_concurrency
+from hdb.checkpoint import Checkpoint, DeadLetters
+from hdb.idscan import BuildingIdScanner, merge_id_maps
+from hdb.pipeline import FetchParsePipeline
+from hdb.recordhash import RecordHashes, has_record, record_hash
+from hdb.records import Building, ColumnAccumulator, EthnicQuota, EthnicResult
+from hdb.scheduler import DagScheduler
+from hdb.stores import ROOM_TYPES, SCHEMAS, last_per_key, open_store
+from hdb.taskpool import TaskPool, timed_task
+from hdb.urlcaching import open_url, open_url_checked, set_http_pool_size, set_cache_ttl
 
 _HDB_URL = 'https://services2.hdb.gov.sg'
 _DATA_DIR = '.hdb/'
 _POOL_SIZE = 10
+_PARSE_WORKERS = 0
+_parse_pool = None
+_ENGINE = 'threads'
+_SHARD = None
+# lease remaining changes daily, building and unit data rarely: incremental runs re-fetch each stage
+# once its interval has elapsed (leases a bit under a day, so that nightly runs always refresh them)
+_REFRESH_INTERVALS = {
+    'leases': 20 * 3600,
+    'units': 29 * 24 * 3600,
+    'buildings': 29 * 24 * 3600,
+}
+# retries of a single request; the final pass over the failed tasks of a stage retries longer, with fewer
+# simultaneous downloads
+_RETRY = {'wait_exponential_multiplier': 1000, 'wait_exponential_max': 10000, 'stop_max_delay': 30000}
+_FINAL_PASS_RETRY = {'wait_exponential_multiplier': 2000, 'wait_exponential_max': 30000, 'stop_max_delay': 120000}
+_FINAL_PASS_POOL_RATIO = 4
+# cached responses must expire before the next refresh of their stage
+_CACHE_TTLS = (
+    ('BB14SGenerateLeaseInfoXML', _REFRESH_INTERVALS['leases']),
+    ('BC16SRetrievePropInfoXML', _REFRESH_INTERVALS['buildings']),
+    ('BC16SRetrieveResiUnitCountXML', _REFRESH_INTERVALS['units']),
+)
 
 
 def set_pool_size(pool_size):
     global _POOL_SIZE
     _POOL_SIZE = pool_size
+    set_http_pool_size(pool_size)
+    set_concurrency(pool_size)
+
+
+def set_parse_workers(parse_workers):
+    # 0 parses in the fetching workers, otherwise parsing runs in a separate pool of processes
+    global _PARSE_WORKERS
+    if parse_workers != _PARSE_WORKERS:
+        close_parse_workers()
+
+    _PARSE_WORKERS = parse_workers
+
+
+def _parse_executor():
+    # the parser processes are started on first use and shared by every stage and pass of the run
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = concurrent.futures.ProcessPoolExecutor(_PARSE_WORKERS)
+
+    return _parse_pool
+
+
+def close_parse_workers():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown()
+        _parse_pool = None
+
+
+def set_engine(engine):
+    global _ENGINE
+    if engine not in ('threads', 'async'):
+        raise ValueError('unknown engine: %s' % engine)
+
+    _ENGINE = engine
+
+
+def set_refresh_interval(stage, seconds):
+    if stage not in _REFRESH_INTERVALS:
+        raise ValueError('unknown stage: %s' % stage)
+
+    _REFRESH_INTERVALS[stage] = seconds
+
+
+def set_cache_expiry():
+    for url_pattern, ttl_seconds in _CACHE_TTLS:
+        set_cache_ttl(url_pattern, ttl_seconds)
 
 
 def set_hdb_url(hdb_url):
@@ -26,6 +108,25 @@ def set_hdb_url(hdb_url):
     _HDB_URL = hdb_url
 
 
+def set_shard(index, count):
+    # 0-based shard index: this process only crawls the building id blocks of the shard (and the postal codes
+    # of the buildings found), None for the whole crawl
+    global _SHARD
+    if count is None:
+        _SHARD = None
+        return
+
+    if not 0 <= index < count:
+        raise ValueError('invalid shard %d of %d' % (index + 1, count))
+
+    _SHARD = (index, count)
+
+
+def shard_data_dir(data_dir, index, count):
+    # partial stores of a shard, under the data directory of the whole crawl
+    return os.path.join(data_dir, 'shard-%d-of-%d' % (index + 1, count)) + '/'
+
+
 def set_data_dir(data_dir):
     global _DATA_DIR
     if not os.path.exists(data_dir):
@@ -34,264 +135,1070 @@ def set_data_dir(data_dir):
     _DATA_DIR = data_dir
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_delay=30000)
-def load_prop_info(prop_id):
+class _Unchanged(object):
+    # stands for the response and the parsed result of a task whose responses were revalidated as unchanged
+    # since the previous run: nothing to parse, the stored record is kept (compared by type, as it is pickled
+    # to and from the parser processes)
+    pass
+
+
+def _timed_parse(parse_function, *args):
+    # also runs in the parser processes: the elapsed time is returned along with the result
+    if isinstance(args[-1], _Unchanged):
+        return 0., args[-1]
+
+    start = time.monotonic()
+    result = parse_function(*args)
+    return time.monotonic() - start, result
+
+
+def _parse(parse_function, *args):
+    elapsed, result = _timed_parse(parse_function, *args)
+    metrics.observe('hdb_parse_seconds', elapsed, parser=parse_function.__name__.lstrip('_'))
+    return result
+
+
+def _prop_info_url(prop_id):
     prop_info_url = _HDB_URL + '/webapp/BC16AWPropInfoXML/BC16SRetrievePropInfoXML?sysId=FI10&bldngGL=%s'
-    xml_text = open_url(prop_info_url % prop_id)
-    xml = BeautifulSoup(xml_text, 'xml')
-    block_tag = xml.find('Block')
-    if not block_tag or not block_tag.contents:
-        return None
+    return prop_info_url % prop_id
+
 
-    block = block_tag.contents[0].strip()
-    street_name = xml.find('StreetName').contents[0].strip()
-    postal_code = xml.find('PostalCode').contents[0].strip()
+@retry(**_RETRY)
+def load_prop_info(prop_id):
+    return _parse(xmlparse.parse_prop_info, open_url(_prop_info_url(prop_id)))
 
-    return block, street_name, postal_code
 
+@retry_async(**_RETRY)
+async def load_prop_info_async(prop_id):
+    return _parse(xmlparse.parse_prop_info, await open_url_async(_prop_info_url(prop_id)))
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_delay=30000)
-def load_residential_units(postal_code):
+
+def _residential_units_url(postal_code):
     url = _HDB_URL + '/webapp/BC16AWPropInfoXML/BC16SRetrieveResiUnitCountXML?systemID=BC16&programName=FI10&postalCode=%s'
-    xml_text = open_url(url % postal_code)
-    xml = BeautifulSoup(xml_text, 'xml')
-    unit_data = list()
-    logging.info('processing units data for postal code %s' % postal_code)
-    for unit in xml.find_all('ResidentUnit'):
-        room_type = ''
-        room_count = 0
-        if unit.find_next('actUseTypTxt').contents:
-            room_type = unit.find_next('actUseTypTxt').contents[0].strip()
+    return url % postal_code
 
-        if unit.find_next('count').contents:
-            room_count = unit.find_next('count').contents[0].strip()
 
-        unit_data.append((postal_code, room_type, room_count))
+@retry(**_RETRY)
+def load_residential_units(postal_code):
+    xml_text = open_url(_residential_units_url(postal_code))
+    metrics.debug_sampled('processing units data for postal code %s', postal_code)
+    return _parse(xmlparse.parse_residential_units, postal_code, xml_text)
 
-    return unit_data
 
+@retry_async(**_RETRY)
+async def load_residential_units_async(postal_code):
+    xml_text = await open_url_async(_residential_units_url(postal_code))
+    metrics.debug_sampled('processing units data for postal code %s', postal_code)
+    return _parse(xmlparse.parse_residential_units, postal_code, xml_text)
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_delay=30000)
-def load_lease_data(postal_code):
+
+def _lease_data_url(postal_code):
     url = _HDB_URL + '/webapp/BB14ALeaseInfo/BB14SGenerateLeaseInfoXML?postalCode=%s'
-    xml_text = open_url(url % postal_code)
-    xml = BeautifulSoup(xml_text, 'xml')
-    logging.info('processing lease data for postal code %s' % postal_code)
-    lease_info = xml.find('LeaseInformation')
+    return url % postal_code
 
-    lease_commenced = ''
-    if lease_info.find('LeaseCommencedDate'):
-        lease_commenced = lease_info.find_next('LeaseCommencedDate').contents[0].strip()
 
-    lease_remaining = ''
-    if lease_info.find('LeaseRemaining'):
-        lease_remaining = lease_info.find_next('LeaseRemaining').contents[0].strip()
+@retry(**_RETRY)
+def load_lease_data(postal_code):
+    xml_text = open_url(_lease_data_url(postal_code))
+    metrics.debug_sampled('processing lease data for postal code %s', postal_code)
+    return _parse(xmlparse.parse_lease_data, postal_code, xml_text)
 
-    lease_period = ''
-    if lease_info.find('LeasePeriod'):
-        lease_period = lease_info.find_next('LeasePeriod').contents[0].strip()
 
-    return postal_code, lease_commenced, lease_remaining, lease_period
+@retry_async(**_RETRY)
+async def load_lease_data_async(postal_code):
+    xml_text = await open_url_async(_lease_data_url(postal_code))
+    metrics.debug_sampled('processing lease data for postal code %s', postal_code)
+    return _parse(xmlparse.parse_lease_data, postal_code, xml_text)
 
 
-def extract_tag_content(xml, tag_name):
-    tag = xml.find(tag_name)
-    if tag and tag.contents:
-        return tag.contents[0].strip()
+_ENQUIRY_CODES = {'B': 'Buyer', 'S': 'Seller'}
+_ETHNIC_CODES = {'C': 'Chinese', 'M': 'Malay', 'I': 'Indian/Other'}
+_CITIZENSHIPS = {'SC': 'Singapore Citizen', 'NSPR': 'Non-Malaysian'}
 
-    else:
-        return ''
 
+def _ethnic_queries():
+    return list(itertools.product(_ENQUIRY_CODES, _ETHNIC_CODES, _CITIZENSHIPS))
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_delay=30000)
-def load_ethnic_data(postal_code):
-    logging.info('processing ethnic data for postal code %s' % postal_code)
+
+def _ethnic_data_urls(postal_code):
     webapp = """/webapp/BB29ETHN/BB29SEthnicMap?block=10R&"""
-    enquiry_codes = {'B': 'Buyer', 'S': 'Seller'}
-    list_ethnic_codes = {'C': 'Chinese', 'M': 'Malay', 'I': 'Indian/Other'}
-    list_citizenships = {'SC': 'Singapore Citizen', 'NSPR': 'Non-Malaysian'}
     query = """enquiry=%(enquiry)s&postal=%(postal_code)s&ethnic=%(ethnic_code)s&citizenship=%(citizenship_code)s"""
-
-    results = list()
-    for enquiry, ethnic_code, citizenship_code in itertools.product(enquiry_codes, list_ethnic_codes, list_citizenships):
+    urls = list()
+    for enquiry, ethnic_code, citizenship_code in _ethnic_queries():
         url = _HDB_URL + webapp + query % {
             'enquiry': enquiry,
             'ethnic_code': ethnic_code,
             'citizenship_code': citizenship_code,
             'postal_code': postal_code,
         }
-        xml_text = open_url(url)
-        xml = BeautifulSoup(xml_text, 'xml')
-        seller_results = extract_tag_content(xml, 'sellerResults')
-        buyer_results_comment = extract_tag_content(xml, 'buyerResultsTableHeading2')
-        buyer_results = extract_tag_content(xml, 'buyerResults')
-        result = {
-            'postal_code': postal_code,
-            'ethnic': list_ethnic_codes[ethnic_code],
-            'citizenship': list_citizenships[citizenship_code],
-            'seller': seller_results,
-            'buyer': buyer_results,
-            'buyer_results_comment': buyer_results_comment,
-        }
-        results.append(result)
+        urls.append(url)
+
+    return urls
+
+
+def _parse_ethnic_data(postal_code, ethnic_code, citizenship_code, xml_text):
+    seller_results, buyer_results, buyer_results_comment = xmlparse.parse_ethnic_result(xml_text)
+    return EthnicResult(postal_code, _ETHNIC_CODES[ethnic_code], _CITIZENSHIPS[citizenship_code], seller_results,
+                        buyer_results, buyer_results_comment)
+
+
+def _parse_ethnic_results(postal_code, xml_texts):
+    results = list()
+    for (_, ethnic_code, citizenship_code), xml_text in zip(_ethnic_queries(), xml_texts):
+        results.append(_parse_ethnic_data(postal_code, ethnic_code, citizenship_code, xml_text))
 
     return results
 
 
-def generate_buildings_db(max_building_id):
+@functools.lru_cache(maxsize=None)
+def _ethnic_fetch_executor():
+    # shared by the load_ethnic_data calls, one thread per sub-request of a postal code
+    return concurrent.futures.ThreadPoolExecutor(len(_ethnic_queries()), thread_name_prefix='ethnic')
+
+
+def load_ethnic_data(postal_code):
+    # the sub-requests are fanned out in parallel, each with its own retry
+    metrics.debug_sampled('processing ethnic data for postal code %s', postal_code)
+    xml_texts = list(_ethnic_fetch_executor().map(_fetch_url, _ethnic_data_urls(postal_code)))
+    return _parse(_parse_ethnic_results, postal_code, xml_texts)
+
+
+async def load_ethnic_data_async(postal_code):
+    metrics.debug_sampled('processing ethnic data for postal code %s', postal_code)
+    xml_texts = await asyncio.gather(*[_fetch_url_async(url) for url in _ethnic_data_urls(postal_code)])
+    return _parse(_parse_ethnic_results, postal_code, xml_texts)
+
+
+def _parse_building(building_id, xml_text):
+    prop_info = xmlparse.parse_prop_info(xml_text)
+    if not prop_info:
+        return None
+
+    # building ids are zero-padded strings as task keys
+    return Building(int(building_id), *prop_info)
+
+
+# checked: returns (content, modified) as open_url_checked
+@retry(**_RETRY)
+def _fetch_url(url, checked=False):
+    return open_url_checked(url) if checked else open_url(url)
+
+
+@retry_async(**_RETRY)
+async def _fetch_url_async(url, checked=False):
+    return await (open_url_checked_async(url) if checked else open_url_async(url))
+
+
+@retry(**_FINAL_PASS_RETRY)
+def _fetch_url_final_pass(url, checked=False):
+    return open_url_checked(url) if checked else open_url(url)
+
 
-    @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_delay=30000)
-    def process_building(building_id):
-        building_id_formatted = '{:05}'.format(building_id)
-        logging.info('processing data for building %s' % building_id_formatted)
-        prop_info = load_prop_info(building_id_formatted)
-        if not prop_info:
-            logging.info('no data found for building %s' % building_id_formatted)
-            return None
+@retry_async(**_FINAL_PASS_RETRY)
+async def _fetch_url_final_pass_async(url, checked=False):
+    return await (open_url_checked_async(url) if checked else open_url_async(url))
 
-        return [building_id_formatted] + list(prop_info)
 
-    mapper = TaskPool(pool_size=_POOL_SIZE)
-    for count in range(1, max_building_id):
-        mapper.add_task(process_building, count)
+def _error_message(error):
+    return '%s: %s' % (type(error).__name__, error)
 
+
+def _stream_stage(url_function, parse_function, args_iterable, dead_letter_stage=None, final_pass=False,
+                  reuse_unchanged=False):
+    # url_function(*args) returns one URL or a list of URLs, parse_function(*args, raw) the parsed result
+    # where raw is the matching response text or list of texts; yields (args, result) in completion order
+    # with a dead_letter_stage, the tasks failing past their retries are recorded as dead letters of the
+    # stage (keyed by their first argument) and skipped, otherwise the first failure is raised;
+    # final_pass retries longer, with fewer simultaneous downloads; with reuse_unchanged, the tasks whose
+    # responses were all revalidated as unchanged are not parsed and yield an _Unchanged result
+    dead_letters = DeadLetters(_DATA_DIR) if dead_letter_stage else None
+    dead_keys = set(dead_letters.keys(dead_letter_stage)) if dead_letters else set()
+    pool_size = max(1, _POOL_SIZE // _FINAL_PASS_POOL_RATIO) if final_pass else _POOL_SIZE
+    fetch_url = _fetch_url_final_pass if final_pass else _fetch_url
+    fetch_url_async = _fetch_url_final_pass_async if final_pass else _fetch_url_async
+
+    def failed(args, error):
+        if dead_letters is None:
+            raise error
+
+        logging.warning('stage %s: %s failed, recorded as a dead letter (%s)', dead_letter_stage, args[0],
+                        _error_message(error))
+        metrics.count('hdb_dead_letters_total', stage=dead_letter_stage)
+        dead_letters.add(dead_letter_stage, args[0], _error_message(error))
+
+    def fetch(task_key, url):
+        return task_key, fetch_url(url, reuse_unchanged)
+
+    async def fetch_async(task_key, url):
+        return task_key, await fetch_url_async(url, reuse_unchanged)
+
+    def fetch_stream(args_iterable):
+        # a list of URLs fans out into one task per URL, so that a slow sub-request does not hold a worker
+        # for the others; the responses are reassembled in URL order once all of them are in
+        parts = dict()
+
+        def url_tasks():
+            for sequence, args in enumerate(args_iterable):
+                urls = url_function(*args)
+                # args, responses, responses remaining, whether any response was modified
+                if isinstance(urls, list):
+                    parts[sequence] = [args, [None] * len(urls), len(urls), not reuse_unchanged]
+                    for position, url in enumerate(urls):
+                        yield (sequence, position), url
+
+                else:
+                    parts[sequence] = [args, None, 1, not reuse_unchanged]
+                    yield (sequence, None), urls
+
+        def fetch_failed(task_args, error):
+            # the first failed sub-request fails the task, the responses of the others are dropped
+            (sequence, _), _ = task_args
+            part = parts.pop(sequence, None)
+            if part is not None:
+                failed(part[0], error)
+
+        if _ENGINE == 'async':
+            responses = map_unordered(fetch_async, url_tasks(), max_pending=2 * pool_size, on_error=fetch_failed)
+
+        else:
+            responses = TaskPool(pool_size=pool_size, on_error=fetch_failed).imap_unordered(fetch, url_tasks())
+
+        for (sequence, position), raw in responses:
+            part = parts.get(sequence)
+            if part is None:
+                continue
+
+            if reuse_unchanged:
+                raw, modified = raw
+                part[3] = part[3] or modified
+
+            if position is None:
+                part[1] = raw
+
+            else:
+                part[1][position] = raw
+
+            part[2] -= 1
+            if part[2] == 0:
+                del parts[sequence]
+                yield part[0], part[1] if part[3] else _Unchanged()
+
+    def parse_inline(fetched):
+        for args, raw in fetched:
+            try:
+                yield args, timed_parse(*(args + (raw,)))
+
+            except Exception as error:
+                failed(args, error)
+
+    timed_parse = functools.partial(_timed_parse, parse_function)
+    if _PARSE_WORKERS:
+        pipeline = FetchParsePipeline(_parse_executor(), _PARSE_WORKERS)
+        results = pipeline.imap_unordered(fetch_stream, timed_parse, args_iterable, on_error=failed)
+
+    else:
+        results = parse_inline(fetch_stream(args_iterable))
+
+    parser = parse_function.__name__.lstrip('_')
+    try:
+        for args, (elapsed, result) in results:
+            if not isinstance(result, _Unchanged):
+                metrics.observe('hdb_parse_seconds', elapsed, parser=parser)
+
+            if args[0] in dead_keys:
+                dead_keys.discard(args[0])
+                dead_letters.remove(dead_letter_stage, args[0])
+
+            yield args, result
+
+    finally:
+        if dead_letters is not None:
+            dead_letters.close()
+
+
+def _final_pass(stage, url_function, parse_function, reuse_unchanged=False):
+    # the dead letters of the stage (from this run or earlier ones) retried with fewer simultaneous downloads
+    # and longer retries; those still failing are kept for the next run
+    dead_letters = DeadLetters(_DATA_DIR)
+    keys = dead_letters.keys(stage)
+    dead_letters.close()
+    if not keys:
+        return
+
+    logging.info('stage %s: final pass over %d failed tasks', stage, len(keys))
+    tasks_args = ((key,) for key in keys)
+    for item in _stream_stage(url_function, parse_function, tasks_args, dead_letter_stage=stage, final_pass=True,
+                              reuse_unchanged=reuse_unchanged):
+        yield item
+
+    _log_dead_letters(stage)
+
+
+def _log_dead_letters(stage):
+    dead_letters = DeadLetters(_DATA_DIR)
+    remaining = dead_letters.keys(stage)
+    dead_letters.close()
+    if remaining:
+        logging.warning('stage %s: %d tasks still failing, retried by the next run: %s', stage, len(remaining),
+                        ', '.join(remaining[:10]) + (', ...' if len(remaining) > 10 else ''))
+
+    return len(remaining)
+
+
+def _open_checkpoint(stage, output_name):
+    checkpoint = Checkpoint(_DATA_DIR, stage)
+    store = open_store(_DATA_DIR, output_name)
+    done_keys = checkpoint.done_keys()
+    resuming = bool(done_keys) and store.exists()
+    if not resuming:
+        if done_keys or checkpoint.is_complete():
+            logging.warning('output %s missing, restarting stage %s from scratch', output_name, stage)
+            checkpoint.reset()
+            done_keys = set()
+
+        store.reset()
+
+    return checkpoint, store, done_keys, resuming
+
+
+def _resume_stage(stage, output_name, keys):
+    checkpoint, store, done_keys, resuming = _open_checkpoint(stage, output_name)
+    pending_keys = [key for key in keys if key not in done_keys]
+    if resuming:
+        logging.info('resuming stage %s: %d done, %d pending', stage, len(done_keys), len(pending_keys))
+
+    return checkpoint, store, pending_keys
+
+
+def generate_buildings_db(max_building_id=None, miss_limit=None):
+    checkpoint, store, done_ids, resuming = _open_checkpoint('buildings', 'buildings-db')
+    if checkpoint.is_complete():
+        logging.info('buildings data complete, skipping')
+        return
+
+    if resuming:
+        logging.info('resuming stage buildings: %d ids done', len(done_ids))
+
+    scanner_options = {'miss_limit': miss_limit} if miss_limit else {}
+    scanner = BuildingIdScanner(_DATA_DIR, max_building_id, shard=_SHARD, **scanner_options)
+    scanner.skip(int(building_id) for building_id in done_ids)
     logging.info('processing...')
-    results = mapper.execute()
+
+    def store_building(building_id, result):
+        if result is None:
+            metrics.debug_sampled('no data found for building %s', building_id)
+
+        # ids are checkpointed once their rows are flushed to the store
+        checkpoint.mark_done_many(store.append([result] if result is not None else [], building_id))
+        scanner.record(int(building_id), result is not None)
+
+    building_ids = scanner.next_batch()
+    while building_ids:
+        tasks_args = (('{:05}'.format(building_id),) for building_id in building_ids)
+        for (building_id,), result in _stream_stage(_prop_info_url, _parse_building, tasks_args,
+                                                    dead_letter_stage='buildings'):
+            store_building(building_id, result)
+
+        building_ids = scanner.next_batch()
+
+    for (building_id,), result in _final_pass('buildings', _prop_info_url, _parse_building):
+        store_building(building_id, result)
+
+    checkpoint.mark_done_many(store.close())
     logging.info('completed')
+    # with ids still failing, the next run resumes the stage instead of skipping it
+    if not _log_dead_letters('buildings'):
+        checkpoint.mark_complete()
 
-    with open(_DATA_DIR + 'buildings-db.csv', 'w') as rooms_file:
-        field_names = ['building', 'number', 'street', 'postal_code']
-        writer = csv.DictWriter(rooms_file, fieldnames=field_names)
-        writer.writeheader()
-        for result in results:
-            if result is None:
-                continue
+    checkpoint.close()
+    scanner.close()
 
-            building, number, street, postal_code = result
-            writer.writerow({
-                'building': building,
-                'number': number,
-                'street': street,
-                'postal_code': postal_code,
-            })
 
+def _load_postal_codes():
+    postal_codes = open_store(_DATA_DIR, 'buildings-db').read_table(['postal_code']).column('postal_code')
+    return sorted(postal_code.decode('ascii') for postal_code in pyarrow.compute.unique(postal_codes).to_pylist())
 
-def generate_units_db():
-    col_types = {'number': str, 'street': str, 'postal_code': str}
-    buildings_df = pandas.read_csv(_DATA_DIR + 'buildings-db.csv', engine='c', dtype=col_types)
-    postal_codes = buildings_df['postal_code'].unique()
-    with open(_DATA_DIR + 'units-db.csv', 'w') as units_file:
-        field_names = ['postal_code', 'room_type', 'room_count']
-        writer = csv.DictWriter(units_file, fieldnames=field_names)
-        writer.writeheader()
-        mapper = TaskPool(pool_size=_POOL_SIZE)
-        for postal_code in sorted(postal_codes):
-            logging.info('queuing postal code: %s' % postal_code)
-            mapper.add_task(load_residential_units, postal_code)
 
-        logging.info('processing...')
-        results = mapper.execute()
+def generate_units_db():
+    postal_codes = _load_postal_codes()
+    checkpoint, store, pending_codes = _resume_stage('units', 'units-db', postal_codes)
+    if not pending_codes:
+        logging.info('units data complete, skipping')
+        return
 
-        for dataset in results:
-            for postal_code, room_type, room_count in dataset:
-                writer.writerow({
-                        'postal_code': postal_code,
-                        'room_type': room_type,
-                        'room_count': room_count
-                })
+    logging.info('queuing %d postal codes' % len(pending_codes))
+    logging.info('processing...')
+    tasks_args = ((postal_code,) for postal_code in pending_codes)
+    results = itertools.chain(
+        _stream_stage(_residential_units_url, xmlparse.parse_residential_units, tasks_args, dead_letter_stage='units'),
+        _final_pass('units', _residential_units_url, xmlparse.parse_residential_units))
+    for (postal_code,), dataset in results:
+        checkpoint.mark_done_many(store.append(dataset, postal_code))
 
-        units_file.close()
+    checkpoint.mark_done_many(store.close())
+    checkpoint.close()
 
 
 def generate_leases_db():
-    col_types = {'number': str, 'street': str, 'postal_code': str}
-    buildings_df = pandas.read_csv(_DATA_DIR + 'buildings-db.csv', engine='c', dtype=col_types)
-    postal_codes = buildings_df['postal_code'].unique()
-    with open(_DATA_DIR + 'leases-db.csv', 'w') as lease_file:
-        field_names = ['postal_code', 'lease_commenced', 'lease_remaining', 'lease_period']
-        writer = csv.DictWriter(lease_file, fieldnames=field_names)
-        writer.writeheader()
-        mapper = TaskPool(pool_size=_POOL_SIZE)
-        for postal_code in sorted(postal_codes):
-            logging.info('queuing postal code: %s' % postal_code)
-            mapper.add_task(load_lease_data, postal_code)
+    postal_codes = _load_postal_codes()
+    checkpoint, store, pending_codes = _resume_stage('leases', 'leases-db', postal_codes)
+    if not pending_codes:
+        logging.info('leases data complete, skipping')
+        return
 
-        logging.info('processing...')
-        results = mapper.execute()
+    logging.info('queuing %d postal codes' % len(pending_codes))
+    logging.info('processing...')
+    tasks_args = ((postal_code,) for postal_code in pending_codes)
+    results = itertools.chain(
+        _stream_stage(_lease_data_url, xmlparse.parse_lease_data, tasks_args, dead_letter_stage='leases'),
+        _final_pass('leases', _lease_data_url, xmlparse.parse_lease_data))
+    for (postal_code,), lease_data in results:
+        checkpoint.mark_done_many(store.append([lease_data], postal_code))
+
+    checkpoint.mark_done_many(store.close())
+    checkpoint.close()
+
+
+def _natural_key(value):
+    # stage keys as used by the crawl: zero-padded building ids, postal code strings
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+
+    if isinstance(value, int):
+        return '{:05}'.format(value)
+
+    return value
+
+
+def _stored_key(key_column, key):
+    # inverse of _natural_key: building ids are stored as integers
+    return int(key) if key_column == 'building' else key
+
+
+def _known_hashes(hashes, stage, store, key_column):
+    known = hashes.hashes(stage)
+    if known or not store.exists():
+        return known
+
+    # first incremental run on crawled data: fingerprints of the stored records, checked when last written
+    stored_rows = collections.defaultdict(list)
+    for row in store.read_table().to_pylist():
+        stored_rows[_natural_key(row[key_column])].append(tuple(row.values()))
 
-        for postal_code, lease_commenced, lease_remaining, lease_period in results:
-            writer.writerow({
-                        'postal_code': postal_code,
-                        'lease_commenced': lease_commenced,
-                        'lease_remaining': lease_remaining,
-                        'lease_period': lease_period,
-            })
+    checked = store.modified()
+    hashes.update_many(stage, ((key, record_hash(rows), checked) for key, rows in stored_rows.items()))
+    logging.info('stage %s: fingerprinted %d stored records', stage, len(stored_rows))
+    return hashes.hashes(stage)
 
-        lease_file.close()
 
+def _refresh_records(stage, store, key_column, hashes, known, results):
+    # results yields (key, rows) pairs from the re-fetched keys: only the keys whose content hash differs
+    # from the stored record are rewritten; None rows (responses revalidated as unchanged) keep the stored
+    # record; returns the (key, change) pairs
+    changes = list()
+    replaced_keys = list()
+    replaced_rows = list()
+    checked = list()
+    now = time.time()
+    for key, rows in results:
+        previous = known.get(key, (None, None))[0]
+        digest = previous if rows is None else record_hash(store.typed_rows(rows))
+        if digest != previous and (has_record(digest) or has_record(previous)):
+            changes.append((key, 'added' if not has_record(previous) else 'removed' if not has_record(digest)
+                            else 'changed'))
+            replaced_keys.append(key)
+            replaced_rows.extend(rows)
 
-def generate_ethnic_db():
-    col_types = {'number': str, 'street': str, 'postal_code': str}
-    buildings_df = pandas.read_csv(_DATA_DIR + 'buildings-db.csv', engine='c', dtype=col_types)
-    postal_codes = buildings_df['postal_code'].unique()
+        checked.append((key, digest, now))
 
-    mapper = TaskPool(pool_size=_POOL_SIZE)
-    for postal_code in sorted(postal_codes):
-        logging.info('queuing postal code: %s' % postal_code)
-        mapper.add_task(load_ethnic_data, postal_code)
+    store.replace(key_column, [_stored_key(key_column, key) for key in replaced_keys], replaced_rows)
+    # hashes are only updated once the store holds the matching rows
+    hashes.update_many(stage, checked)
+    logging.info('stage %s: %d records checked, %d changed', stage, len(checked), len(changes))
+    return changes
 
+
+def _append_changelog(stage, changes):
+    if not changes:
+        return
+
+    run = datetime.datetime.now().replace(microsecond=0)
+    store = open_store(_DATA_DIR, 'changelog')
+    store.append([(run, stage, key, change) for key, change in changes])
+    store.close()
+
+
+def refresh_buildings_db(max_building_id=None, miss_limit=None):
+    # incremental counterpart of generate_buildings_db: rescans the building ids once the refresh interval elapsed
+    checkpoint = Checkpoint(_DATA_DIR, 'buildings')
+    complete = checkpoint.is_complete()
+    checkpoint.close()
+    if not complete:
+        generate_buildings_db(max_building_id, miss_limit)
+        return
+
+    hashes = RecordHashes(_DATA_DIR)
+    store = open_store(_DATA_DIR, 'buildings-db')
+    known = _known_hashes(hashes, 'buildings', store, 'building')
+    last_refresh = hashes.last_refresh('buildings') or store.modified()
+    if time.time() - last_refresh < _REFRESH_INTERVALS['buildings']:
+        logging.info('buildings refreshed %.1f hours ago, skipping', (time.time() - last_refresh) / 3600.)
+        hashes.close()
+        return
+
+    scanner_options = {'miss_limit': miss_limit} if miss_limit else {}
+    scanner = BuildingIdScanner(_DATA_DIR, max_building_id, shard=_SHARD, **scanner_options)
+
+    def checked_building(building_id, result):
+        if isinstance(result, _Unchanged):
+            # same response as when the stored record (if any) was written
+            scanner.record(int(building_id), has_record(known.get(building_id, (None, None))[0]))
+            return building_id, None
+
+        scanner.record(int(building_id), result is not None)
+        return building_id, [result] if result is not None else []
+
+    def results():
+        building_ids = scanner.next_batch()
+        while building_ids:
+            tasks_args = (('{:05}'.format(building_id),) for building_id in building_ids)
+            for (building_id,), result in _stream_stage(_prop_info_url, _parse_building, tasks_args,
+                                                        dead_letter_stage='buildings', reuse_unchanged=True):
+                yield checked_building(building_id, result)
+
+            building_ids = scanner.next_batch()
+
+        for (building_id,), result in _final_pass('buildings', _prop_info_url, _parse_building, reuse_unchanged=True):
+            yield checked_building(building_id, result)
+
+    _append_changelog('buildings', _refresh_records('buildings', store, 'building', hashes, known, results()))
+    hashes.mark_refreshed('buildings')
+    hashes.close()
+    scanner.close()
+
+
+def _refresh_postal_codes(stage, output_name, url_function, parse_function, to_rows):
+    # re-fetches the postal codes not checked within the refresh interval of the stage
+    postal_codes = _load_postal_codes()
+    hashes = RecordHashes(_DATA_DIR)
+    store = open_store(_DATA_DIR, output_name)
+    known = _known_hashes(hashes, stage, store, 'postal_code')
+    now = time.time()
+    # postal codes never fetched (no record) are due as well
+    stale_codes = [postal_code for postal_code in postal_codes
+                   if now - known.get(postal_code, (None, 0.))[1] >= _REFRESH_INTERVALS[stage]]
+    removed_codes = sorted(set(known) - set(postal_codes))
+    logging.info('stage %s: refreshing %d of %d postal codes, %d removed', stage, len(stale_codes),
+                 len(postal_codes), len(removed_codes))
+
+    refreshed_codes = list()
+
+    def results():
+        for postal_code in removed_codes:
+            yield postal_code, []
+
+        # failed postal codes keep their stored record and hash, hence stay stale for the next refresh
+        tasks_args = ((postal_code,) for postal_code in stale_codes)
+        for (postal_code,), result in itertools.chain(
+                _stream_stage(url_function, parse_function, tasks_args, dead_letter_stage=stage, reuse_unchanged=True),
+                _final_pass(stage, url_function, parse_function, reuse_unchanged=True)):
+            refreshed_codes.append(postal_code)
+            yield postal_code, None if isinstance(result, _Unchanged) else to_rows(result)
+
+    _append_changelog(stage, _refresh_records(stage, store, 'postal_code', hashes, known, results()))
+    # removed postal codes are not due any more: their (empty) hash is dropped instead of kept
+    hashes.update_many(stage, ((postal_code, None, now) for postal_code in removed_codes))
+    hashes.close()
+    # keeps the checkpoint of the regular crawl consistent with the refreshed store: the failed postal codes,
+    # now dead letters, are not done
+    checkpoint = Checkpoint(_DATA_DIR, stage)
+    checkpoint.mark_done_many(refreshed_codes)
+    checkpoint.close()
+
+
+def refresh_units_db():
+    _refresh_postal_codes('units', 'units-db', _residential_units_url, xmlparse.parse_residential_units, list)
+
+
+def refresh_leases_db():
+    _refresh_postal_codes('leases', 'leases-db', _lease_data_url, xmlparse.parse_lease_data,
+                          lambda lease_data: [lease_data])
+
+
+_ETHNIC_COLUMNS = ['postal_code', 'citizenship', 'ethnic', 'seller', 'buyer', 'buyer_results_comment']
+
+
+def _merge_ethnic_results(postal_code_rows):
+    # buyer results (no seller text) and seller results (no buyer text) of a postal code, merged into
+    # one quota per citizenship and ethnic group
+    merged = collections.OrderedDict()
+    for result in postal_code_rows:
+        key = (result.postal_code, result.citizenship, result.ethnic)
+        if result.seller == '':
+            values = merged.setdefault(key, [None, None, None])
+            values[1] = result.buyer
+            values[2] = result.buyer_results_comment
+
+        if result.buyer == '':
+            merged.setdefault(key, [None, None, None])[0] = result.seller
+
+    return [EthnicQuota._make(key + tuple(values)) for key, values in merged.items()]
+
+
+def _ethnic_accumulator():
+    # the quotas of all the postal codes are kept until the output is written: the texts, repeated across
+    # postal codes, are stored once
+    return ColumnAccumulator(_ETHNIC_COLUMNS, encoded=_ETHNIC_COLUMNS)
+
+
+def generate_ethnic_db(output_path='ethnic.xlsx', output_format=None):
+    postal_codes = _load_postal_codes()
+    logging.info('queuing %d postal codes' % len(postal_codes))
     logging.info('processing...')
-    results = mapper.execute()
-
-    rows = list()
-    for postal_code_rows in results:
-        rows += postal_code_rows
-
-    result_df = pandas.DataFrame(rows)
-    buyers_df = result_df[result_df['seller'] == ''][[u'postal_code', u'citizenship', u'ethnic', u'buyer', u'buyer_results_comment']]
-    buyers_df.set_index([u'postal_code', u'citizenship', u'ethnic'], inplace=True)
-    sellers_df = result_df[result_df['buyer'] == ''][[u'postal_code', u'citizenship', u'ethnic', u'seller']]
-    sellers_df.set_index([u'postal_code', u'citizenship', u'ethnic'], inplace=True)
-    columns = [u'seller', u'buyer', u'buyer_results_comment']
-    merged_df = pandas.concat([buyers_df, sellers_df], axis=1)
-    merged_df = merged_df[columns]
-    writer = pandas.ExcelWriter('result.xlsx', engine='xlsxwriter')
-    merged_df.reset_index().to_excel(writer, index=False)
-
-
-def generate_excel(data_dir, output_dir, output_file):
-    buildings_df = pandas.read_csv(data_dir + 'buildings-db.csv')
-    leases_df = pandas.read_csv(data_dir + 'leases-db.csv')
-    units_df = pandas.read_csv(data_dir + 'units-db.csv')
-    units_pivot_df = units_df.pivot(index='postal_code', columns='room_type', values='room_count')
-    buildings_enhanced_df = buildings_df.join(units_pivot_df, on='postal_code')
-    final_df = buildings_enhanced_df.join(leases_df.set_index('postal_code', inplace=False), on='postal_code')
+    tasks_args = ((postal_code,) for postal_code in postal_codes)
+    rows = _ethnic_accumulator()
+    for _, postal_code_rows in itertools.chain(
+            _stream_stage(_ethnic_data_urls, _parse_ethnic_results, tasks_args, dead_letter_stage='ethnic'),
+            _final_pass('ethnic', _ethnic_data_urls, _parse_ethnic_results)):
+        rows.extend(_merge_ethnic_results(postal_code_rows))
 
-    def make_address(row):
-        return '{number} {street}'.format(number=row['number'], street=row['street'])
+    _write_ethnic_db(rows, output_path, output_format)
 
-    final_df['Short Address'] = final_df.apply(make_address, axis=1)
-    final_df['Postal Code'] = final_df['postal_code']
-    final_df['Lease Date'] = final_df['lease_commenced']
 
-    def extract_year(row):
-        if not pandas.isnull(row['lease_commenced']):
-            return row['lease_commenced'][-4:]
+def _write_ethnic_db(rows, output_path, output_format=None):
+    import pandas
+    if output_format is None:
+        output_format = _output_format(output_path)
+
+    # rows is a ColumnAccumulator of EthnicQuota
+    merged_df = pandas.DataFrame(collections.OrderedDict((name, rows.column(name)) for name in _ETHNIC_COLUMNS))
+    merged_df = merged_df.sort_values(by=['postal_code', 'citizenship', 'ethnic'], kind='stable')
+    full_path = os.path.abspath(output_path)
+    write_export(merged_df, full_path, output_format)
+    logging.info('ethnic data saved under %s (%d rows, %s)', full_path, len(merged_df), output_format)
+
+
+class _PipelinedCrawl(object):
+    # tasks of generate_pipelined_dbs: building ids are fetched in the passes planned by the scanner, and the
+    # first building found with a postal code queues the units, lease and (optionally) ethnic fetches of
+    # that postal code; failed tasks are recorded as dead letters and retried in a final pass
+
+    def __init__(self, scheduler, fetch_executor, parse_executor, ethnic):
+        self._scheduler = scheduler
+        self._fetch_executor = fetch_executor
+        self._parse_executor = parse_executor
+        self._ethnic = ethnic
+        self._postal_codes = set()
+        self._scanner = None
+        self._scan_complete = False
+        self._batch_remaining = 0
+        self._final_pass = False
+        self._dead_letters = DeadLetters(_DATA_DIR)
+        self._dead_keys = dict()
+        self.stages = dict()
+        self.ethnic_rows = _ethnic_accumulator()
+
+    def _start_fetch(self, url):
+        if self._fetch_executor is None:
+            return asyncfetch.submit(_fetch_url_final_pass_async if self._final_pass else _fetch_url_async, (url,))
+
+        fetch_url = _fetch_url_final_pass if self._final_pass else _fetch_url
+        return self._fetch_executor.submit(timed_task, fetch_url, (url,), time.monotonic())
+
+    def _dead_keys_of(self, stage):
+        if stage not in self._dead_keys:
+            self._dead_keys[stage] = set(self._dead_letters.keys(stage))
+
+        return self._dead_keys[stage]
+
+    def _fetch(self, stage, url_function, parse_function, args, handle, on_failure=None):
+        # a list of URLs fans out into one task per URL, parsed together once all the responses are in; the
+        # first failed one fails the task
+        urls = url_function(*args)
+        parse = functools.partial(self._parse, stage, parse_function, args, handle, on_failure)
+        if not isinstance(urls, list):
+            failed = functools.partial(self._failed, stage, args, on_failure)
+            self._scheduler.add(stage, functools.partial(self._start_fetch, urls), parse, failed)
+            return
+
+        part = [[None] * len(urls), len(urls)]
+
+        def collect(position, raw):
+            part[0][position] = raw
+            part[1] -= 1
+            if part[1] == 0:
+                parse(part[0])
+
+        def failed(error):
+            if part[1] > 0:
+                part[1] = -1
+                self._failed(stage, args, on_failure, error)
+
+        for position, url in enumerate(urls):
+            self._scheduler.add(stage, functools.partial(self._start_fetch, url), functools.partial(collect, position),
+                                failed)
+
+    def _parse(self, stage, parse_function, args, handle, on_failure, raw):
+
+        def parsed(result):
+            if args[0] in self._dead_keys_of(stage):
+                self._dead_keys[stage].discard(args[0])
+                self._dead_letters.remove(stage, args[0])
+
+            handle(args, result)
+
+        if self._parse_executor is None:
+            try:
+                result = _parse(parse_function, *(args + (raw,)))
+
+            except Exception as error:
+                self._failed(stage, args, on_failure, error)
+                return
+
+            parsed(result)
+            return
+
+        def timed_parsed(timed_result):
+            elapsed, result = timed_result
+            metrics.observe('hdb_parse_seconds', elapsed, parser=parse_function.__name__.lstrip('_'))
+            parsed(result)
+
+        start = functools.partial(self._parse_executor.submit, _timed_parse, parse_function, *(args + (raw,)))
+        self._scheduler.add('parse', start, timed_parsed, functools.partial(self._failed, stage, args, on_failure))
+
+    def _failed(self, stage, args, on_failure, error):
+        logging.warning('stage %s: %s failed, recorded as a dead letter (%s)', stage, args[0], _error_message(error))
+        metrics.count('hdb_dead_letters_total', stage=stage)
+        self._dead_letters.add(stage, args[0], _error_message(error))
+        self._dead_keys_of(stage).add(args[0])
+        if on_failure is not None:
+            on_failure(args)
+
+    def scan_buildings(self, scanner):
+        self._scanner = scanner
+        self._next_batch()
+
+    def _next_batch(self):
+        building_ids = self._scanner.next_batch()
+        if not building_ids:
+            self._scan_complete = True
+            return
+
+        self._batch_remaining = len(building_ids)
+        for building_id in building_ids:
+            self._fetch_building('{:05}'.format(building_id))
+
+    def _fetch_building(self, building_id):
+        self._fetch('buildings', _prop_info_url, _parse_building, (building_id,), self._building_done,
+                    self._building_failed)
+
+    def _building_done(self, args, result):
+        building_id, = args
+        checkpoint, store, _ = self.stages['buildings']
+        if result is None:
+            metrics.debug_sampled('no data found for building %s', building_id)
+
+        checkpoint.mark_done_many(store.append([result] if result is not None else [], building_id))
+        if self._scanner is not None:
+            self._scanner.record(int(building_id), result is not None)
+
+        if result is not None:
+            self.add_postal_code(result[-1])
+
+        self._batch_completed()
+
+    def _building_failed(self, args):
+        self._batch_completed()
+
+    def _batch_completed(self):
+        # the final pass fetches ids outside of the scanner batches
+        if self._final_pass:
+            return
+
+        self._batch_remaining -= 1
+        if self._batch_remaining == 0:
+            self._next_batch()
+
+    def add_postal_code(self, postal_code):
+        if postal_code in self._postal_codes:
+            return
+
+        self._postal_codes.add(postal_code)
+        for stage in ('units', 'leases'):
+            if postal_code not in self.stages[stage][2]:
+                self._fetch_postal_code(stage, postal_code)
+
+        if self._ethnic:
+            self._fetch_postal_code('ethnic', postal_code)
+
+    def _fetch_postal_code(self, stage, postal_code):
+        if stage == 'units':
+            self._fetch('units', _residential_units_url, xmlparse.parse_residential_units, (postal_code,),
+                        functools.partial(self._store_rows, 'units', list))
+
+        elif stage == 'leases':
+            self._fetch('leases', _lease_data_url, xmlparse.parse_lease_data, (postal_code,),
+                        functools.partial(self._store_rows, 'leases', lambda lease_data: [lease_data]))
+
+        else:
+            self._fetch('ethnic', _ethnic_data_urls, _parse_ethnic_results, (postal_code,), self._ethnic_done)
+
+    def _store_rows(self, stage, to_rows, args, result):
+        postal_code, = args
+        checkpoint, store, _ = self.stages[stage]
+        checkpoint.mark_done_many(store.append(to_rows(result), postal_code))
+
+    def _ethnic_done(self, args, postal_code_rows):
+        self.ethnic_rows.extend(_merge_ethnic_results(postal_code_rows))
+
+    def retry_failed(self, scheduler):
+        # final pass: the dead letters of the crawled stages (from this run or earlier ones), on a scheduler with
+        # a smaller budget and with longer retries; buildings found meanwhile still queue their postal codes
+        stages = ['buildings', 'units', 'leases'] + (['ethnic'] if self._ethnic else [])
+        failed_keys = dict((stage, sorted(self._dead_keys_of(stage))) for stage in stages)
+        if not any(failed_keys.values()):
+            return False
+
+        logging.info('final pass over %s', ', '.join('%d failed %s tasks' % (len(keys), stage)
+                                                      for stage, keys in failed_keys.items() if keys))
+        self._scheduler = scheduler
+        self._final_pass = True
+        for building_id in failed_keys['buildings']:
+            self._fetch_building(building_id)
+
+        for stage in stages[1:]:
+            for postal_code in failed_keys[stage]:
+                self._fetch_postal_code(stage, postal_code)
+
+        return True
+
+    def close(self):
+        for checkpoint, store, _ in self.stages.values():
+            checkpoint.mark_done_many(store.close())
+
+        checkpoint = self.stages['buildings'][0]
+        remaining = dict((stage, len(keys)) for stage, keys in self._dead_keys.items() if keys)
+        for stage, count in sorted(remaining.items()):
+            logging.warning('stage %s: %d tasks still failing, retried by the next run', stage, count)
+
+        # with ids still failing, the next run resumes the building scan instead of skipping it
+        if self._scan_complete and not remaining.get('buildings'):
+            logging.info('buildings data complete')
+            checkpoint.mark_complete()
+
+        for checkpoint, _, _ in self.stages.values():
+            checkpoint.close()
+
+        self._dead_letters.close()
+        if self._scanner is not None:
+            self._scanner.close()
+
+
+def generate_pipelined_dbs(max_building_id=None, miss_limit=None, ethnic_output_path=None, ethnic_output_format=None):
+    # buildings, units and leases (and ethnic data) crawled as one DAG on a shared worker budget: the stages
+    # overlap instead of each one waiting for the previous one to drain; same checkpoints and stores as the
+    # stage-by-stage generate_*_db functions, which can resume each other's runs
+    buildings_checkpoint, buildings_store, done_ids, resuming = _open_checkpoint('buildings', 'buildings-db')
+    buildings_complete = buildings_checkpoint.is_complete()
+    known_postal_codes = _load_postal_codes() if resuming or buildings_complete else []
+    stages = ['parse', 'buildings', 'units', 'leases'] + (['ethnic'] if ethnic_output_path else [])
+    scheduler = DagScheduler(stages, 2 * _POOL_SIZE)
+    fetch_executor = None
+    if _ENGINE == 'threads':
+        fetch_executor = concurrent.futures.ThreadPoolExecutor(_POOL_SIZE, thread_name_prefix='fetch')
+
+    parse_executor = _parse_executor() if _PARSE_WORKERS else None
+    crawl = _PipelinedCrawl(scheduler, fetch_executor, parse_executor, bool(ethnic_output_path))
+    crawl.stages['buildings'] = (buildings_checkpoint, buildings_store, done_ids)
+    for stage in ('units', 'leases'):
+        checkpoint, store, done_codes, stage_resuming = _open_checkpoint(stage, stage + '-db')
+        if stage_resuming:
+            logging.info('resuming stage %s: %d postal codes done', stage, len(done_codes))
+
+        crawl.stages[stage] = (checkpoint, store, done_codes)
+
+    try:
+        # postal codes of the buildings stored by an interrupted or complete building scan
+        for postal_code in known_postal_codes:
+            crawl.add_postal_code(postal_code)
+
+        if buildings_complete:
+            logging.info('buildings data complete, skipping the building scan')
 
         else:
-            return numpy.nan
+            if resuming:
+                logging.info('resuming stage buildings: %d ids done', len(done_ids))
+
+            scanner_options = {'miss_limit': miss_limit} if miss_limit else {}
+            scanner = BuildingIdScanner(_DATA_DIR, max_building_id, shard=_SHARD, **scanner_options)
+            scanner.skip(int(building_id) for building_id in done_ids)
+            crawl.scan_buildings(scanner)
+
+        logging.info('processing...')
+        scheduler.run()
+        final_scheduler = DagScheduler(stages, 2 * max(1, _POOL_SIZE // _FINAL_PASS_POOL_RATIO))
+        if crawl.retry_failed(final_scheduler):
+            final_scheduler.run()
+
+        crawl.close()
+
+    finally:
+        if fetch_executor is not None:
+            fetch_executor.shutdown(wait=False)
+
+    logging.info('completed')
+    if ethnic_output_path:
+        _write_ethnic_db(crawl.ethnic_rows, ethnic_output_path, ethnic_output_format)
+
+
+# rows fetched by several shards (postal codes shared by buildings of different shards): the last one is kept
+_MERGE_KEYS = {
+    'buildings-db': ['building'],
+    'units-db': ['postal_code', 'room_type'],
+    'leases-db': ['postal_code'],
+    'changelog': None,
+}
+
 
-    final_df['Lease Year'] = final_df.apply(extract_year, axis=1)
+def merge_shards(data_dir, shard_count):
+    # combines the partial stores of the shards into the stores of data_dir, e.g. before generate_excel
+    shard_dirs = [shard_data_dir(data_dir, index, shard_count) for index in range(shard_count)]
+    missing_dirs = [shard_dir for shard_dir in shard_dirs if not os.path.isdir(shard_dir)]
+    if missing_dirs:
+        raise ValueError('missing shard data: %s' % ', '.join(missing_dirs))
+
+    for name in sorted(SCHEMAS):
+        tables = [store.read_table() for store in (open_store(shard_dir, name) for shard_dir in shard_dirs)
+                  if store.exists()]
+        if not tables:
+            continue
+
+        table = pyarrow.concat_tables(tables)
+        if _MERGE_KEYS[name] is not None:
+            table = last_per_key(table, _MERGE_KEYS[name])
+
+        open_store(data_dir, name).overwrite(table)
+        logging.info('merged %s from %d shards: %d rows', name, len(tables), table.num_rows)
+
+    merge_id_maps(data_dir, shard_dirs)
+
+
+_EXPORT_COLUMNS = ['Short Address', 'Postal Code', 'Lease Date', 'Lease Year', 'Lease Duration'] + ROOM_TYPES
+_OUTPUT_FORMATS = ('xlsx', 'csv', 'parquet')
+
+
+def build_export_frame(data_dir):
+    # resumed stages may have re-appended rows that were written just before an interruption
+    buildings_df = open_store(data_dir, 'buildings-db').read_frame().drop_duplicates()
+    leases_df = open_store(data_dir, 'leases-db').read_frame().drop_duplicates()
+    units_df = open_store(data_dir, 'units-db').read_frame()
+    units_df = units_df.drop_duplicates(subset=['postal_code', 'room_type'], keep='last')
+    units_pivot_df = units_df.pivot(index='postal_code', columns='room_type', values='room_count')
+    # room types absent from the data still get their (empty) column
+    units_pivot_df.columns = units_pivot_df.columns.astype(str)
+    units_pivot_df = units_pivot_df.reindex(columns=ROOM_TYPES)
+    leases_df = leases_df.drop_duplicates(subset='postal_code', keep='last').set_index('postal_code')
+    final_df = buildings_df.join(units_pivot_df, on='postal_code').join(leases_df, on='postal_code')
+    final_df['Short Address'] = final_df['number'].str.cat(final_df['street'], sep=' ')
+    final_df['Postal Code'] = final_df['postal_code']
+    final_df['Lease Date'] = final_df['lease_commenced']
+    final_df['Lease Year'] = final_df['lease_commenced'].str[-4:]
     final_df['Lease Duration'] = final_df['lease_period']
-    # re-ordering
-    columns = ['Short Address', 'Postal Code',
-               'Lease Date', 'Lease Year', 'Lease Duration',
-               '1-room', '2-room', '3-room', '4-room', '5-room',
-               'Executive', 'HUDC', 'Multi-generation', 'Studio Apartment', 'Type S1', 'Type S2',
-    ]
-    export_df = final_df[columns].sort_values(by='Postal Code')
+    # stores are written in completion order: the building id makes the order within a postal code the same
+    # from one run (or engine) to the other
+    final_df = final_df.sort_values(by=['postal_code', 'building'], kind='stable')
+    return final_df[_EXPORT_COLUMNS]
+
+
+def _write_xlsx(export_df, full_path):
+    # constant_memory streams each row to disk as soon as it is complete: pandas.to_excel writes cells
+    # column by column, which is incompatible with that mode, hence the direct use of xlsxwriter
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(full_path, {'constant_memory': True})
+    try:
+        worksheet = workbook.add_worksheet()
+        header_format = workbook.add_format({'bold': True})
+        worksheet.write_row(0, 0, export_df.columns.tolist(), header_format)
+        values_df = export_df.astype(object).where(export_df.notna(), None)
+        for row_number, row in enumerate(values_df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_number, 0, row)
+
+    finally:
+        workbook.close()
+
+
+def _output_format(output_file):
+    # inferred from the file extension, Excel by default
+    extension = os.path.splitext(output_file)[1].lstrip('.').lower()
+    return extension if extension in _OUTPUT_FORMATS else 'xlsx'
+
+
+def write_export(export_df, full_path, output_format='xlsx'):
+    with metrics.timer('hdb_export_write_seconds', format=output_format):
+        _write_export(export_df, full_path, output_format)
+
+    metrics.count('hdb_export_rows_total', len(export_df), format=output_format)
+    metrics.count('hdb_export_bytes_total', os.path.getsize(full_path), format=output_format)
+
+
+def _write_export(export_df, full_path, output_format):
+    if output_format == 'xlsx':
+        _write_xlsx(export_df, full_path)
+
+    elif output_format == 'csv':
+        export_df.to_csv(full_path, index=False)
+
+    elif output_format == 'parquet':
+        # requires pyarrow (or fastparquet)
+        export_df.to_parquet(full_path, index=False)
+
+    else:
+        raise ValueError('unknown output format: %s (expected one of %s)' % (output_format, ', '.join(_OUTPUT_FORMATS)))
+
+
+def export_csv(data_dir, output_dir):
+    # the intermediate stores as CSV files
+    for name in sorted(SCHEMAS):
+        store = open_store(data_dir, name)
+        if not store.exists():
+            continue
+
+        csv_path = os.path.abspath(output_dir + name + '.csv')
+        rows = store.export_csv(csv_path)
+        logging.info('exported %d rows to %s', rows, csv_path)
+
+
+def generate_excel(data_dir, output_dir, output_file, output_format=None):
+    if output_format is None:
+        output_format = _output_format(output_file)
+
+    export_df = build_export_frame(data_dir)
     full_path = os.path.abspath(output_dir + output_file)
-    writer = pandas.ExcelWriter(full_path, engine='xlsxwriter')
-    export_df.to_excel(writer, index=False)
-    writer.save()
-    logging.info('file saved under %s', full_path)
+    write_export(export_df, full_path, output_format)
+    logging.info('file saved under %s (%d rows, %s)', full_path, len(export_df), output_format)
+
+
+def generate_changelog(data_dir, output_dir, output_file, since=None):
+    # buildings affected by the changes recorded by incremental runs (since the given time if any)
+    import pandas
+    changelog_df = open_store(data_dir, 'changelog').read_frame()
+    if since is not None:
+        changelog_df = changelog_df[changelog_df['run'] >= since]
+
+    buildings_df = open_store(data_dir, 'buildings-db').read_frame().drop_duplicates()
+    buildings_df['Short Address'] = buildings_df['number'].str.cat(buildings_df['street'], sep=' ')
+    buildings_df = buildings_df[['building', 'Short Address', 'postal_code']]
+    building_changes_df = changelog_df[changelog_df['stage'] == 'buildings'].copy()
+    building_changes_df['building'] = building_changes_df['key'].astype(int)
+    postal_changes_df = changelog_df[changelog_df['stage'] != 'buildings'].rename(columns={'key': 'postal_code'})
+    changes_df = pandas.concat([
+        building_changes_df.merge(buildings_df, on='building', how='left'),
+        postal_changes_df.merge(buildings_df, on='postal_code', how='left'),
+    ])
+    changes_df = changes_df.rename(columns={'run': 'Run', 'stage': 'Stage', 'change': 'Change', 'building': 'Building',
+                                            'postal_code': 'Postal Code'})
+    columns = ['Run', 'Stage', 'Change', 'Building', 'Short Address', 'Postal Code']
+    changes_df = changes_df[columns].sort_values(by=['Run', 'Postal Code'], kind='stable')
+    full_path = os.path.abspath(output_dir + os.path.splitext(output_file)[0] + '-changes.csv')
+    changes_df.to_csv(full_path, index=False)
+    logging.info('changelog saved under %s (%d changes)', full_path, len(changes_df))
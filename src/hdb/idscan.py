@@ -0,0 +1,173 @@
+import logging
+import os
+import sqlite3
+import time
+
+_ID_MAP_FILE = 'building-ids.sqlite'
+_BLOCK_SIZE = 64
+_PROBE_STEP = 8
+_DENSE_RATIO = 0.2
+_MISS_LIMIT = 500
+_FIRST_FRONTIER_CHUNK = 1024
+_MAX_FRONTIER_CHUNK = 2048
+# recorded ids are written to the map in batches: at each pass, on close, and every _RECORD_BATCH ids
+_RECORD_BATCH = 1000
+
+
+def _connect(data_dir):
+    connection = sqlite3.connect(os.path.join(data_dir, _ID_MAP_FILE))
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS building_ids ('
+                       'building_id INTEGER PRIMARY KEY, hit INTEGER NOT NULL, checked REAL NOT NULL)')
+    connection.commit()
+    return connection
+
+
+def in_shard(building_id, shard, block_size=_BLOCK_SIZE):
+    # shard (index, count): blocks of ids are dealt round-robin, so that each shard scans whole blocks
+    index, count = shard
+    return (building_id // block_size) % count == index
+
+
+def merge_id_maps(data_dir, shard_dirs):
+    # most recently checked state of each id wins
+    connection = _connect(data_dir)
+    for shard_dir in shard_dirs:
+        shard_path = os.path.join(shard_dir, _ID_MAP_FILE)
+        if not os.path.exists(shard_path):
+            continue
+
+        connection.execute('ATTACH DATABASE ? AS shard', (shard_path,))
+        connection.execute('INSERT OR REPLACE INTO building_ids (building_id, hit, checked) '
+                           'SELECT shard_ids.building_id, shard_ids.hit, shard_ids.checked '
+                           'FROM shard.building_ids AS shard_ids LEFT JOIN building_ids AS known '
+                           'ON known.building_id = shard_ids.building_id '
+                           'WHERE known.checked IS NULL OR known.checked < shard_ids.checked')
+        connection.commit()
+        connection.execute('DETACH DATABASE shard')
+
+    connection.close()
+
+
+class BuildingIdScanner(object):
+    # plans the building ids to query in successive passes, learning from the persisted hit/miss map of
+    # previous runs and from the live results of earlier passes:
+    # - ids known to exist are always queried
+    # - known misses are re-queried in full in dense blocks, but only sampled every probe_step ids in
+    #   sparse blocks; a sampled hit expands the whole block in the next pass
+    # - past the highest known hit, chunks are scanned until miss_limit consecutive misses
+    #   (or max_building_id) mark the upper bound
+    # with a shard (index, count), only the ids of the shard's blocks are planned; the miss limit is scaled by
+    # the shard count, as a shard only sees one id in count past its highest hit
+
+    def __init__(self, data_dir, max_building_id=None, miss_limit=_MISS_LIMIT, block_size=_BLOCK_SIZE,
+                 probe_step=_PROBE_STEP, dense_ratio=_DENSE_RATIO, shard=None):
+        self._max_building_id = max_building_id
+        self._shard = shard
+        if shard is not None:
+            miss_limit *= shard[1]
+
+        self._miss_limit = miss_limit
+        self._block_size = block_size
+        self._probe_step = probe_step
+        self._dense_ratio = dense_ratio
+        self._connection = _connect(data_dir)
+        self._known = dict(self._connection.execute('SELECT building_id, hit FROM building_ids'))
+        self._scanned = set()
+        self._new_hits = set()
+        self._pending = list()
+        self._frontier = 0
+        # without history the upper bound is unknown: frontier chunks start large and double
+        self._frontier_chunk = miss_limit if self._known else _FIRST_FRONTIER_CHUNK
+        self._passes = 0
+        self._hits = 0
+        self._misses = 0
+        logging.info('building id map: %d known ids, %d hits', len(self._known), sum(self._known.values()))
+
+    def _within_bounds(self, building_id):
+        if self._shard is not None and not in_shard(building_id, self._shard, self._block_size):
+            return False
+
+        return self._max_building_id is None or building_id < self._max_building_id
+
+    def skip(self, building_ids):
+        # ids already processed in this run (resumed from a checkpoint)
+        self._scanned.update(building_ids)
+
+    def record(self, building_id, hit):
+        if hit:
+            self._hits += 1
+            if not self._known.get(building_id):
+                self._new_hits.add(building_id)
+
+        else:
+            self._misses += 1
+
+        self._known[building_id] = int(hit)
+        self._pending.append((building_id, int(hit), time.time()))
+        if len(self._pending) >= _RECORD_BATCH:
+            self._write_pending()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+
+        self._connection.executemany('INSERT OR REPLACE INTO building_ids (building_id, hit, checked) '
+                                     'VALUES (?, ?, ?)', self._pending)
+        self._connection.commit()
+        self._pending = list()
+
+    def _highest_hit(self):
+        hits = [building_id for building_id, hit in self._known.items() if hit]
+        return max(hits) if hits else 0
+
+    def _plan_known_range(self, upper_bound):
+        planned = list()
+        for block_start in range(0, upper_bound + 1, self._block_size):
+            block_ids = range(max(block_start, 1), min(block_start + self._block_size, upper_bound + 1))
+            known_states = [self._known[building_id] for building_id in block_ids if building_id in self._known]
+            dense = not known_states or float(sum(known_states)) / len(known_states) >= self._dense_ratio
+            # a sampled id found in an earlier pass of this run turns a sparse block dense
+            expanded = any(building_id in self._new_hits for building_id in block_ids)
+            for position, building_id in enumerate(block_ids):
+                if building_id in self._scanned:
+                    continue
+
+                if self._known.get(building_id) or dense or expanded or position % self._probe_step == 0:
+                    planned.append(building_id)
+
+        return planned
+
+    def _plan_frontier(self, highest_hit):
+        if highest_hit + self._miss_limit <= self._frontier:
+            return list()
+
+        frontier_end = max(self._frontier + self._frontier_chunk, highest_hit + self._miss_limit)
+        planned = list(range(self._frontier + 1, frontier_end + 1))
+        self._frontier = frontier_end
+        self._frontier_chunk = min(2 * self._frontier_chunk, _MAX_FRONTIER_CHUNK)
+        return planned
+
+    def next_batch(self):
+        self._write_pending()
+        highest_hit = self._highest_hit()
+        self._frontier = max(self._frontier, highest_hit)
+        planned = self._plan_known_range(self._frontier) + self._plan_frontier(highest_hit)
+        planned = [building_id for building_id in planned
+                   if building_id not in self._scanned and self._within_bounds(building_id)]
+        self._scanned.update(planned)
+        self._passes += 1
+        if planned:
+            logging.info('building id scan pass %d: %d ids up to %d (highest hit %d)',
+                         self._passes, len(planned), max(planned), highest_hit)
+
+        else:
+            logging.info('building id scan complete: %d hits, %d misses in this run, highest hit %d',
+                         self._hits, self._misses, highest_hit)
+
+        return planned
+
+    def close(self):
+        self._write_pending()
+        self._connection.close()
@@ -0,0 +1,233 @@
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+# seconds, upper bounds of the latency histogram buckets (Prometheus style, the last one is +Inf)
+_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., float('inf'))
+_REPORT_INTERVAL = 60.
+_LOG_SAMPLING = 100
+
+_lock = threading.Lock()
+_histograms = dict()
+_counters = collections.Counter()
+_started = time.monotonic()
+_last_report = time.monotonic()
+_sampling_counters = collections.Counter()
+
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(_BUCKETS)
+        self.count = 0
+        self.sum = 0.
+
+    def copy(self):
+        histogram = _Histogram()
+        histogram.buckets = list(self.buckets)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile
+        rank = q * self.count
+        cumulated = 0
+        for upper_bound, bucket_count in zip(_BUCKETS, self.buckets):
+            cumulated += bucket_count
+            if cumulated >= rank:
+                return upper_bound
+
+        return _BUCKETS[-1]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def set_report_interval(seconds):
+    global _REPORT_INTERVAL
+    _REPORT_INTERVAL = seconds
+
+
+def set_log_sampling(one_in):
+    global _LOG_SAMPLING
+    _LOG_SAMPLING = max(1, one_in)
+
+
+def reset():
+    global _started, _last_report
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _started = time.monotonic()
+        _last_report = time.monotonic()
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _Histogram()
+            _histograms[key] = histogram
+
+        histogram.observe(seconds)
+
+    _maybe_report()
+
+
+def count(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.monotonic()
+    try:
+        yield
+
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def debug_sampled(message, *args):
+    # per-request log lines: only one in every _LOG_SAMPLING calls is logged, at DEBUG level
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+
+    with _lock:
+        _sampling_counters[message] += 1
+        occurrences = _sampling_counters[message]
+
+    if occurrences % _LOG_SAMPLING == 1 or _LOG_SAMPLING == 1:
+        logging.debug(message + ' (sampled 1/%d)', *(args + (_LOG_SAMPLING,)))
+
+
+def _format_labels(labels):
+    return ','.join('%s=%s' % label for label in labels)
+
+
+def _maybe_report():
+    global _last_report
+    now = time.monotonic()
+    with _lock:
+        if now - _last_report < _REPORT_INTERVAL:
+            return
+
+        _last_report = now
+
+    log_summary()
+
+
+def log_summary():
+    elapsed = max(time.monotonic() - _started, 1e-3)
+    report = snapshot()
+    for histogram in report['histograms']:
+        logging.info('metrics %s{%s}: %d in %.0fs (%.1f/s), mean %.1fms, p50 <= %.1fms, p95 <= %.1fms',
+                     histogram['name'], _format_labels(histogram['labels'].items()), histogram['count'], elapsed,
+                     histogram['count'] / elapsed, 1000 * histogram['mean'], 1000 * histogram['p50'],
+                     1000 * histogram['p95'])
+
+    for counter in report['counters']:
+        logging.info('metrics %s{%s}: %d (%.1f/s)', counter['name'], _format_labels(counter['labels'].items()),
+                     counter['value'], counter['value'] / elapsed)
+
+
+def snapshot():
+    with _lock:
+        histograms = [(name, labels, histogram.copy()) for (name, labels), histogram in sorted(_histograms.items())]
+        counters = sorted(_counters.items())
+        elapsed = time.monotonic() - _started
+
+    report = {'elapsed_seconds': elapsed, 'histograms': list(), 'counters': list()}
+    for name, labels, histogram in histograms:
+        report['histograms'].append({
+            'name': name,
+            'labels': dict(labels),
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'mean': histogram.sum / histogram.count if histogram.count else 0.,
+            'p50': histogram.quantile(0.5),
+            'p95': histogram.quantile(0.95),
+            'p99': histogram.quantile(0.99),
+            'buckets': dict(('+Inf' if upper_bound == float('inf') else repr(upper_bound), bucket_count)
+                            for upper_bound, bucket_count in zip(_BUCKETS, histogram.buckets)),
+        })
+
+    for (name, labels), value in counters:
+        report['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+
+    return report
+
+
+def _write_atomically(path, content):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as output_file:
+        output_file.write(content)
+
+    os.replace(temp_path, path)
+
+
+def write_json_report(path):
+    report = snapshot()
+    # infinite bucket bounds are not valid JSON
+    for histogram in report['histograms']:
+        for quantile in ('p50', 'p95', 'p99'):
+            if histogram[quantile] == float('inf'):
+                histogram[quantile] = None
+
+    _write_atomically(path, json.dumps(report, indent=2))
+    logging.info('metrics report saved under %s', os.path.abspath(path))
+
+
+def _prometheus_labels(labels, extra=None):
+    labels = list(labels.items()) + (extra or [])
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def write_prometheus(path):
+    # text exposition format, e.g. for the node exporter textfile collector
+    report = snapshot()
+    lines = list()
+    declared = set()
+    for histogram in report['histograms']:
+        name = histogram['name']
+        if name not in declared:
+            declared.add(name)
+            lines.append('# TYPE %s histogram' % name)
+
+        cumulated = 0
+        for upper_bound, bucket_count in histogram['buckets'].items():
+            cumulated += bucket_count
+            lines.append('%s_bucket%s %d' % (name, _prometheus_labels(histogram['labels'], [('le', upper_bound)]),
+                                             cumulated))
+
+        lines.append('%s_sum%s %r' % (name, _prometheus_labels(histogram['labels']), histogram['sum']))
+        lines.append('%s_count%s %d' % (name, _prometheus_labels(histogram['labels']), histogram['count']))
+
+    for counter in report['counters']:
+        name = counter['name']
+        if name not in declared:
+            declared.add(name)
+            lines.append('# TYPE %s counter' % name)
+
+        lines.append('%s%s %d' % (name, _prometheus_labels(counter['labels']), counter['value']))
+
+    _write_atomically(path, '\n'.join(lines) + '\n')
+    logging.info('prometheus metrics saved under %s', os.path.abspath(path))
@@ -0,0 +1,87 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+_REPORT_INTERVAL = 10.
+
+
+class FetchParsePipeline(object):
+    # two-stage pipeline: a streaming fetch stage (threads or async) feeds raw responses into a pool of
+    # parser processes, so that parsing is not bound by the GIL of the fetching process; the pool
+    # (a ProcessPoolExecutor of parse_workers processes) is owned by the caller and may serve several pipelines
+
+    def __init__(self, parse_executor, parse_workers, max_parse_pending=None, report_interval=_REPORT_INTERVAL):
+        self._parse_executor = parse_executor
+        self._max_parse_pending = max_parse_pending or 4 * parse_workers
+        self._report_interval = report_interval
+        self._lock = threading.Lock()
+        self._fetch_queued = 0
+        self._fetch_done = 0
+        self._parse_done = 0
+        self._last_report = time.monotonic()
+
+    def _counting(self, args_iterable):
+        for args in args_iterable:
+            with self._lock:
+                self._fetch_queued += 1
+
+            yield args
+
+    def _report(self, parse_pending, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < self._report_interval:
+            return
+
+        self._last_report = now
+        logging.info('pipeline queues: fetch in flight %d, parse pending %d (fetched %d, parsed %d)',
+                     self._fetch_queued - self._fetch_done, parse_pending, self._fetch_done, self._parse_done)
+
+    def imap_unordered(self, fetch_stream_function, parse_function, args_iterable, on_error=None):
+        # fetch_stream_function(args_iterable) yields (args, raw) pairs as fetches complete,
+        # parse_function(*args, raw) runs in a worker process; yields (args, result) pairs
+        # on_error(args, error) is called for each failed parse, otherwise the failure is raised
+        pending = dict()
+
+        def completed(block):
+            done, _ = concurrent.futures.wait(list(pending), timeout=None if block else 0,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                args = pending.pop(future)
+                self._parse_done += 1
+                error = future.exception()
+                if error is None:
+                    yield args, future.result()
+
+                elif on_error is None:
+                    raise error
+
+                else:
+                    on_error(args, error)
+
+        try:
+            for args, raw in fetch_stream_function(self._counting(args_iterable)):
+                self._fetch_done += 1
+                # backpressure: the fetch stage stops pulling new work while parsers are saturated
+                while len(pending) >= self._max_parse_pending:
+                    for item in completed(block=True):
+                        yield item
+
+                pending[self._parse_executor.submit(parse_function, *(tuple(args) + (raw,)))] = args
+                for item in completed(block=False):
+                    yield item
+
+                self._report(len(pending))
+
+            while pending:
+                for item in completed(block=True):
+                    yield item
+
+                self._report(len(pending))
+
+        finally:
+            # the pool outlives the pipeline: parses not started yet are dropped
+            for future in pending:
+                future.cancel()
+
+        self._report(0, force=True)
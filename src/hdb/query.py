@@ -0,0 +1,327 @@
+import json
+import logging
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy
+import pyarrow
+
+from hdb.stores import ROOM_TYPES, last_per_key, open_store
+
+# read-only lookups over the buildings of a crawl, merged with the units and lease of their postal code as in
+# the export: the stores of the data directory are loaded once into columns (integer arrays, strings stored
+# once per distinct value); postal code, street and block have hash indexes mapping each key to the sorted
+# positions of its buildings, lease years are kept sorted for range lookups
+
+_DATA_DIR = '.hdb/'
+_PORT = 8780
+_NO_YEAR = 0
+_NO_POSITIONS = numpy.zeros(0, dtype=numpy.int32)
+_CRITERIA = ('postal_code', 'street', 'block', 'room_type')
+
+
+def _normalized(text):
+    # street and block lookups ignore case and spacing
+    return ' '.join(text.split()).upper() if text else ''
+
+
+def _postal_code(value):
+    return str(value).strip().zfill(6)
+
+
+def _lease_year(lease_commenced):
+    # lease commencement dates are dd/mm/yyyy strings
+    year = (lease_commenced or '')[-4:]
+    return int(year) if year.isdigit() else _NO_YEAR
+
+
+def _encoded(values):
+    # (codes, distinct values): each distinct string is kept once
+    distinct = dict()
+    codes = numpy.fromiter((distinct.setdefault(value, len(distinct)) for value in values), dtype=numpy.int32,
+                           count=len(values))
+    return codes, list(distinct)
+
+
+def _positions_index(codes, keys):
+    # key -> sorted positions of the rows holding it, where codes are the row codes and keys[code] the key of
+    # each code: the positions are slices of a single array ordered by code
+    order = numpy.argsort(codes, kind='stable').astype(numpy.int32)
+    bounds = numpy.searchsorted(codes[order], numpy.arange(len(keys) + 1))
+    index = dict()
+    for code, key in enumerate(keys):
+        positions = order[bounds[code]:bounds[code + 1]]
+        # distinct values may share a key once normalized
+        index[key] = numpy.union1d(index[key], positions) if key in index else positions
+
+    return index
+
+
+class HdbIndex(object):
+    # one row per building; lease and units columns are held per postal code and shared by its buildings
+
+    def __init__(self, buildings, units, leases):
+        # pyarrow tables as read from the buildings-db, units-db and leases-db stores; rows re-appended by
+        # resumed or incremental runs are dropped, the last one wins
+        buildings = last_per_key(buildings, ['building'])
+        buildings = buildings.take(numpy.argsort(buildings.column('building').to_numpy(), kind='stable'))
+        units = last_per_key(units, ['postal_code', 'room_type'])
+        leases = last_per_key(leases, ['postal_code'])
+        building_postal_codes = [postal_code.decode('ascii') if postal_code else ''
+                                 for postal_code in buildings.column('postal_code').to_pylist()]
+        numbers = [number or '' for number in buildings.column('number').to_pylist()]
+        streets = [street or '' for street in buildings.column('street').to_pylist()]
+        self._building = numpy.array(buildings.column('building').to_pylist(), dtype=numpy.int32)
+        self._postal, self._postal_codes = _encoded(building_postal_codes)
+        self._number, self._numbers = _encoded(numbers)
+        self._street, self._streets = _encoded(streets)
+        postal_rows = dict((postal_code, row) for row, postal_code in enumerate(self._postal_codes))
+
+        lease_columns = [leases.column(name).to_pylist() for name in
+                         ('postal_code', 'lease_commenced', 'lease_remaining', 'lease_period')]
+        self._lease_commenced = [None] * len(self._postal_codes)
+        self._lease_remaining = [None] * len(self._postal_codes)
+        self._lease_period = [None] * len(self._postal_codes)
+        postal_years = numpy.full(len(self._postal_codes), _NO_YEAR, dtype=numpy.int16)
+        for postal_code, commenced, remaining, period in zip(*lease_columns):
+            row = postal_rows.get(postal_code.decode('ascii') if postal_code else '')
+            if row is not None:
+                self._lease_commenced[row] = commenced
+                self._lease_remaining[row] = remaining
+                self._lease_period[row] = period
+                postal_years[row] = _lease_year(commenced)
+
+        room_type_column = units.column('room_type')
+        if pyarrow.types.is_dictionary(room_type_column.type):
+            room_type_column = room_type_column.cast(pyarrow.string())
+
+        unit_columns = [units.column('postal_code').to_pylist(), room_type_column.to_pylist(),
+                        units.column('room_count').to_pylist()]
+        self._room_types = list(ROOM_TYPES) + sorted(set(unit_columns[1]) - set(ROOM_TYPES) - {None})
+        room_type_columns = dict((room_type, column) for column, room_type in enumerate(self._room_types))
+        # room count per postal code and room type, 0 without any unit of that type
+        self._units = numpy.zeros((len(self._postal_codes), len(self._room_types)), dtype=numpy.int32)
+        for postal_code, room_type, room_count in zip(*unit_columns):
+            row = postal_rows.get(postal_code.decode('ascii') if postal_code else '')
+            if row is not None and room_type is not None:
+                self._units[row, room_type_columns[room_type]] = room_count or 0
+
+        self._lease_years = postal_years[self._postal]
+        self._year_order = numpy.argsort(self._lease_years, kind='stable').astype(numpy.int32)
+        self._sorted_years = self._lease_years[self._year_order]
+        self._by_postal_code = _positions_index(self._postal, self._postal_codes)
+        self._by_street = _positions_index(self._street, [_normalized(street) for street in self._streets])
+        self._by_block = _positions_index(self._number, [_normalized(number) for number in self._numbers])
+        self._by_room_type = dict(
+            (room_type, numpy.flatnonzero(self._units[self._postal, column] > 0).astype(numpy.int32))
+            for room_type, column in room_type_columns.items())
+
+    def __len__(self):
+        return len(self._building)
+
+    @property
+    def room_types(self):
+        return list(self._room_types)
+
+    def _lease_year_positions(self, first, last):
+        # positions of the buildings whose lease started between first and last (inclusive), in year order
+        first = _NO_YEAR + 1 if first is None else max(int(first), _NO_YEAR + 1)
+        last = numpy.iinfo(numpy.int16).max if last is None else int(last)
+        start = numpy.searchsorted(self._sorted_years, first, side='left')
+        end = numpy.searchsorted(self._sorted_years, last, side='right')
+        return self._year_order[start:end]
+
+    def positions(self, postal_code=None, street=None, block=None, lease_years=None, room_type=None):
+        # sorted positions of the buildings matching all the given criteria; lease_years is a (first, last)
+        # range where either bound may be None
+        # the hash indexes give the candidates, intersected smallest first; the lease year range and the room
+        # type filter the candidates, unless no key is given and their own index is used instead
+        keyed = [index.get(key, _NO_POSITIONS) for index, key in (
+            (self._by_postal_code, None if postal_code is None else _postal_code(postal_code)),
+            (self._by_street, None if street is None else _normalized(street)),
+            (self._by_block, None if block is None else _normalized(block))) if key is not None]
+        if keyed:
+            keyed.sort(key=len)
+            positions = keyed[0]
+            for other in keyed[1:]:
+                if not len(positions):
+                    break
+
+                positions = numpy.intersect1d(positions, other, assume_unique=True)
+
+        elif room_type is not None:
+            positions = self._by_room_type.get(room_type, _NO_POSITIONS)
+            room_type = None
+
+        elif lease_years is not None:
+            return numpy.sort(self._lease_year_positions(*lease_years))
+
+        else:
+            return numpy.arange(len(self), dtype=numpy.int32)
+
+        if room_type is not None:
+            if room_type not in self._room_types:
+                return _NO_POSITIONS
+
+            column = self._room_types.index(room_type)
+            positions = positions[self._units[self._postal[positions], column] > 0]
+
+        if lease_years is not None:
+            first, last = lease_years
+            years = self._lease_years[positions]
+            matching = years != _NO_YEAR
+            if first is not None:
+                matching &= years >= int(first)
+
+            if last is not None:
+                matching &= years <= int(last)
+
+            positions = positions[matching]
+
+        return positions
+
+    def records(self, positions):
+        # the columns are gathered once for all the positions, then zipped into one dict per building
+        postal_rows = self._postal[positions]
+        room_types = self._room_types
+        records = list()
+        for building, number, street, postal_row, lease_year, units in zip(
+                self._building[positions].tolist(), self._number[positions].tolist(),
+                self._street[positions].tolist(), postal_rows.tolist(), self._lease_years[positions].tolist(),
+                self._units[postal_rows].tolist()):
+            records.append({
+                'building': building,
+                'block': self._numbers[number],
+                'street': self._streets[street],
+                'postal_code': self._postal_codes[postal_row],
+                'lease_commenced': self._lease_commenced[postal_row],
+                'lease_year': lease_year if lease_year != _NO_YEAR else None,
+                'lease_remaining': self._lease_remaining[postal_row],
+                'lease_period': self._lease_period[postal_row],
+                'units': dict((room_type, count) for room_type, count in zip(room_types, units) if count > 0),
+            })
+
+        return records
+
+    def record(self, position):
+        return self.records([position])[0]
+
+    def find(self, postal_code=None, street=None, block=None, lease_years=None, room_type=None, limit=None):
+        # records of the matching buildings, in building id order
+        positions = self.positions(postal_code, street, block, lease_years, room_type)
+        if limit is not None:
+            positions = positions[:limit]
+
+        return self.records(positions)
+
+    def by_postal_code(self, postal_code):
+        return self.find(postal_code=postal_code)
+
+    def by_street(self, street):
+        return self.find(street=street)
+
+    def by_block(self, block, street=None):
+        return self.find(street=street, block=block)
+
+    def by_lease_year(self, first=None, last=None):
+        return self.find(lease_years=(first, last))
+
+    def by_room_type(self, room_type):
+        return self.find(room_type=room_type)
+
+
+def load(data_dir=_DATA_DIR):
+    start = time.monotonic()
+    index = HdbIndex(*[open_store(data_dir, name).read_table() for name in ('buildings-db', 'units-db', 'leases-db')])
+    logging.info('loaded %d buildings from %s in %.3f s', len(index), data_dir, time.monotonic() - start)
+    return index
+
+
+def _criteria(parameters):
+    # query string parameters -> keyword arguments of HdbIndex.find
+    parameters = dict(parameters)
+    criteria = dict((name, parameters.pop(name)) for name in _CRITERIA if name in parameters)
+    try:
+        first = parameters.pop('lease_year_from', None)
+        last = parameters.pop('lease_year_to', None)
+        if first is not None or last is not None:
+            criteria['lease_years'] = (None if first is None else int(first), None if last is None else int(last))
+
+        if 'limit' in parameters:
+            criteria['limit'] = int(parameters.pop('limit'))
+
+    except ValueError:
+        raise ValueError('lease_year_from, lease_year_to and limit must be integers')
+
+    if parameters:
+        raise ValueError('unknown parameters: %s' % ', '.join(sorted(parameters)))
+
+    return criteria
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the status line, headers and body of a response go out in a single segment: with Nagle's algorithm and
+    # separate writes, each keep-alive request would wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/stats':
+            index = self.server.index
+            self._send(200, {'buildings': len(index), 'room_types': index.room_types})
+            return
+
+        if url.path != '/buildings':
+            self._send(404, {'error': 'unknown path: %s' % url.path})
+            return
+
+        try:
+            criteria = _criteria(urllib.parse.parse_qsl(url.query))
+
+        except ValueError as error:
+            self._send(400, {'error': str(error)})
+            return
+
+        records = self.server.index.find(**criteria)
+        self._send(200, {'count': len(records), 'buildings': records})
+
+
+class QueryServer(ThreadingHTTPServer):
+    # GET /buildings?postal_code=&street=&block=&room_type=&lease_year_from=&lease_year_to=&limit= returns the
+    # matching buildings as JSON, GET /stats the size of the index
+    daemon_threads = True
+
+    def __init__(self, index, port=_PORT, host='127.0.0.1'):
+        ThreadingHTTPServer.__init__(self, (host, port), _QueryHandler)
+        self.index = index
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+def serve(index, port=_PORT, host='127.0.0.1'):
+    server = QueryServer(index, port, host)
+    logging.info('serving %d buildings on %s', len(index), server.url)
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
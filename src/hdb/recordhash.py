@@ -0,0 +1,64 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+_RECORD_HASH_FILE = 'record-hashes.sqlite'
+# hash of a key fetched without any record: kept with its check time like the others, so that empty keys
+# are only re-fetched once the refresh interval of their stage elapsed
+_EMPTY_HASH = 'empty'
+
+
+def record_hash(rows):
+    # order-independent fingerprint of the rows stored for a key
+    if not rows:
+        return _EMPTY_HASH
+
+    return hashlib.sha1('\n'.join(sorted(repr(row) for row in rows)).encode('utf-8')).hexdigest()
+
+
+def has_record(hash_value):
+    # False for keys never fetched (None) and keys fetched without any record
+    return hash_value is not None and hash_value != _EMPTY_HASH
+
+
+class RecordHashes(object):
+    # content hash and last check time of the record stored for each key of a stage (building id or postal code),
+    # used by incremental runs to decide what to re-fetch and what actually changed
+
+    def __init__(self, data_dir):
+        self._connection = sqlite3.connect(os.path.join(data_dir, _RECORD_HASH_FILE))
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS record_hash ('
+                                 'stage TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, checked REAL NOT NULL, '
+                                 'PRIMARY KEY (stage, key)) WITHOUT ROWID')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS stage_refresh (stage TEXT PRIMARY KEY, refreshed REAL)')
+        self._connection.commit()
+
+    def hashes(self, stage):
+        # key -> (hash, checked)
+        rows = self._connection.execute('SELECT key, hash, checked FROM record_hash WHERE stage = ?', (stage,))
+        return dict((key, (hash_value, checked)) for key, hash_value, checked in rows)
+
+    def update_many(self, stage, items):
+        # items of (key, hash, checked): a None hash drops the key
+        items = list(items)
+        self._connection.executemany('INSERT OR REPLACE INTO record_hash (stage, key, hash, checked) VALUES (?, ?, ?, ?)',
+                                     ((stage, key, hash_value, checked) for key, hash_value, checked in items
+                                      if hash_value is not None))
+        self._connection.executemany('DELETE FROM record_hash WHERE stage = ? AND key = ?',
+                                     ((stage, key) for key, hash_value, _ in items if hash_value is None))
+        self._connection.commit()
+
+    def last_refresh(self, stage):
+        row = self._connection.execute('SELECT refreshed FROM stage_refresh WHERE stage = ?', (stage,)).fetchone()
+        return row[0] if row else None
+
+    def mark_refreshed(self, stage, refreshed=None):
+        self._connection.execute('INSERT OR REPLACE INTO stage_refresh (stage, refreshed) VALUES (?, ?)',
+                                 (stage, time.time() if refreshed is None else refreshed))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,92 @@
+import array
+import collections
+
+_BATCH_ROWS = 256
+
+# rows produced by the parsers and written to the stores, in store column order: named tuples carry no
+# per-row attribute dict and compare equal to plain tuples
+Building = collections.namedtuple('Building', ['building', 'number', 'street', 'postal_code'])
+Units = collections.namedtuple('Units', ['postal_code', 'room_type', 'room_count'])
+Lease = collections.namedtuple('Lease', ['postal_code', 'lease_commenced', 'lease_remaining', 'lease_period'])
+# one ethnic enquiry (buyer or seller side) and the quota of a postal code merged from its enquiries
+EthnicResult = collections.namedtuple('EthnicResult', ['postal_code', 'ethnic', 'citizenship', 'seller', 'buyer',
+                                                       'buyer_results_comment'])
+EthnicQuota = collections.namedtuple('EthnicQuota', ['postal_code', 'citizenship', 'ethnic', 'seller', 'buyer',
+                                                     'buyer_results_comment'])
+
+
+class EncodedColumn(object):
+    # values stored once each, rows as an array of codes into them
+    __slots__ = ('codes', 'values', '_codes_by_value')
+
+    def __init__(self):
+        self.codes = array.array('i')
+        self.values = list()
+        self._codes_by_value = dict()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, value):
+        self.extend((value,))
+
+    def extend(self, values):
+        # values is a sequence: new values are registered first, then all the codes are looked up at once
+        codes_by_value = self._codes_by_value
+        for value in values:
+            if value not in codes_by_value:
+                codes_by_value[value] = len(self.values)
+                self.values.append(value)
+
+        self.codes.extend(map(codes_by_value.__getitem__, values))
+
+    def decoded(self):
+        values = self.values
+        return [values[code] for code in self.codes]
+
+
+class ColumnAccumulator(object):
+    # rows are spread into one container per column as they are appended instead of being kept as tuples;
+    # encoded columns suit values repeated across rows (postal codes, street names, room types, lease
+    # periods, ethnic quota texts), the others are plain lists
+    # appended rows are staged and spread by batches of batch_rows, which keeps the cost per row low
+
+    def __init__(self, names, encoded=(), batch_rows=_BATCH_ROWS):
+        self.names = list(names)
+        self._columns = [EncodedColumn() if name in encoded else list() for name in self.names]
+        self._batch_rows = batch_rows
+        self._staged = list()
+
+    def __len__(self):
+        return (len(self._columns[0]) if self._columns else 0) + len(self._staged)
+
+    def _spread(self):
+        if self._staged:
+            for column, values in zip(self._columns, zip(*self._staged)):
+                column.extend(values)
+
+            self._staged = list()
+
+    def append(self, row):
+        self._staged.append(row)
+        if len(self._staged) >= self._batch_rows:
+            self._spread()
+
+    def extend(self, rows):
+        self._staged.extend(rows)
+        if len(self._staged) >= self._batch_rows:
+            self._spread()
+
+    def column(self, name):
+        # the values of a column, decoded
+        column = self.raw_column(name)
+        return column.decoded() if isinstance(column, EncodedColumn) else list(column)
+
+    def raw_column(self, name):
+        # an EncodedColumn or a list
+        self._spread()
+        return self._columns[self.names.index(name)]
+
+    def clear(self):
+        self._columns = [EncodedColumn() if isinstance(column, EncodedColumn) else list() for column in self._columns]
+        self._staged = list()
@@ -0,0 +1,88 @@
+import collections
+import concurrent.futures
+import logging
+import time
+
+_REPORT_INTERVAL = 10.
+
+
+class DagScheduler(object):
+    # runs the tasks of several crawl stages on one worker budget: the callback of a task may queue tasks of
+    # the stages depending on it as soon as its result is in, so that a stage starts with the first keys found
+    # by the stage before it instead of waiting for that stage to drain
+    # - at most max_pending tasks are started and not yet completed, across all stages
+    # - free slots are dealt round-robin to the stages with ready tasks, so that a stage held back by its
+    #   endpoint (throttling, slow responses) does not take the whole budget while the others have work
+    # - callbacks run in the thread calling run(), one at a time
+
+    def __init__(self, stages, max_pending, report_interval=_REPORT_INTERVAL):
+        self._ready = collections.OrderedDict((stage, collections.deque()) for stage in stages)
+        self._max_pending = max_pending
+        self._report_interval = report_interval
+        self._pending = dict()
+        self._turn = 0
+        self._queued = collections.Counter()
+        self._completed = collections.Counter()
+        self._last_report = time.monotonic()
+
+    def add(self, stage, start, callback, errback=None):
+        # start() starts the task and returns a concurrent.futures.Future, callback(result) handles its result;
+        # errback(error) handles its failure, otherwise the failure is raised by run()
+        self._ready[stage].append((start, callback, errback))
+        self._queued[stage] += 1
+
+    def _start_ready(self):
+        # the turn carries over between calls: a single free slot goes to the stage after the last one served
+        stages = list(self._ready)
+        idle_turns = 0
+        while idle_turns < len(stages) and len(self._pending) < self._max_pending:
+            stage = stages[self._turn % len(stages)]
+            self._turn += 1
+            ready = self._ready[stage]
+            if not ready:
+                idle_turns += 1
+                continue
+
+            idle_turns = 0
+            start, callback, errback = ready.popleft()
+            self._pending[start()] = (stage, callback, errback)
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < self._report_interval:
+            return
+
+        self._last_report = now
+        in_flight = collections.Counter(stage for stage, _, _ in self._pending.values())
+        logging.info('scheduler: %s', ', '.join('%s %d/%d (%d in flight)' % (
+            stage, self._completed[stage], self._queued[stage], in_flight[stage]) for stage in self._ready))
+
+    def run(self):
+        try:
+            while True:
+                self._start_ready()
+                if not self._pending:
+                    break
+
+                done, _ = concurrent.futures.wait(list(self._pending), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage, callback, errback = self._pending.pop(future)
+                    self._completed[stage] += 1
+                    error = future.exception()
+                    if error is None:
+                        callback(future.result())
+
+                    elif errback is None:
+                        raise error
+
+                    else:
+                        errback(error)
+
+                self._report()
+
+        finally:
+            # drops the started tasks when a task or a callback failed
+            for future in self._pending:
+                future.cancel()
+
+        self._report(force=True)
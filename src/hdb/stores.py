@@ -0,0 +1,57 @@
+import logging
+import os
+
+import pyarrow
+
+from hdb.columnstore import ColumnStore
+
+# column stores of a data directory, as written by the crawl (hdb.hdbdownload) and read by the export and the
+# query index (hdb.query)
+
+_POSTAL_CODE = pyarrow.binary(6)
+SCHEMAS = {
+    'buildings-db': pyarrow.schema([
+        ('building', pyarrow.int32()),
+        ('number', pyarrow.string()),
+        ('street', pyarrow.string()),
+        ('postal_code', _POSTAL_CODE),
+    ]),
+    'units-db': pyarrow.schema([
+        ('postal_code', _POSTAL_CODE),
+        ('room_type', pyarrow.dictionary(pyarrow.int16(), pyarrow.string())),
+        ('room_count', pyarrow.int32()),
+    ]),
+    'leases-db': pyarrow.schema([
+        ('postal_code', _POSTAL_CODE),
+        ('lease_commenced', pyarrow.string()),
+        ('lease_remaining', pyarrow.string()),
+        ('lease_period', pyarrow.string()),
+    ]),
+    # changes found by incremental runs; key is a building id or a postal code depending on the stage
+    'changelog': pyarrow.schema([
+        ('run', pyarrow.timestamp('s')),
+        ('stage', pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+        ('key', pyarrow.string()),
+        ('change', pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+    ]),
+}
+ROOM_TYPES = ['1-room', '2-room', '3-room', '4-room', '5-room',
+              'Executive', 'HUDC', 'Multi-generation', 'Studio Apartment', 'Type S1', 'Type S2',
+              ]
+
+
+def open_store(data_dir, name):
+    store = ColumnStore(data_dir + name, SCHEMAS[name])
+    legacy_csv = data_dir + name + '.csv'
+    if not store.exists() and os.path.exists(legacy_csv):
+        # data directories created before the columnar store
+        logging.info('importing %d rows from %s', store.import_csv(legacy_csv), legacy_csv)
+
+    return store
+
+
+def last_per_key(table, key_columns):
+    # rows appended again for the same key (resumed stages, shards, refreshes): the last one is kept
+    keys = zip(*[table.column(key_column).to_pylist() for key_column in key_columns])
+    last_positions = dict((key, position) for position, key in enumerate(keys))
+    return table.take(sorted(last_positions.values()))
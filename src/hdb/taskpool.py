@@ -1,22 +1,44 @@
+import functools
 import logging
+import queue
+import threading
+import time
 from multiprocessing.pool import ThreadPool
 
+from hdb import metrics
+
+
+def timed_task(task_function, args, queued):
+    # runs task_function(*args) in a worker of another executor with the metrics of the TaskPool workers
+    started = time.monotonic()
+    metrics.observe('hdb_taskpool_queue_wait_seconds', started - queued, pool='threads')
+    try:
+        return task_function(*args)
+
+    finally:
+        metrics.observe('hdb_taskpool_run_seconds', time.monotonic() - started, pool='threads')
+
 
 class TaskPool(object):
 
-    def __init__(self, pool_size=5):
+    def __init__(self, pool_size=5, max_pending=None, on_error=None):
+        # on_error(args, error) is called for each task that raised, the other tasks go on; without it the
+        # first failure is raised to the caller
         self._pool_size = pool_size
-        self._pool = ThreadPool(pool_size)
+        self._max_pending = max_pending or 2 * pool_size
+        self._on_error = on_error
+        # failures handled by on_error are reported by it, the traceback is only logged in debug
+        self._failure_log_level = logging.ERROR if on_error is None else logging.DEBUG
         self._tasks_args = list()
 
     @staticmethod
-    def _task_function_wrapper(single_param):
+    def _task_function_wrapper(single_param, failure_log_level=logging.ERROR):
         wrapped_task, wrapped_task_id, wrapped_args, wrapped_kwargs = single_param
         try:
             result = wrapped_task(*wrapped_args, **wrapped_kwargs)
 
         except Exception as err:
-            logging.error('task %d failed: %s', wrapped_task_id, err, exc_info=True)
+            logging.log(failure_log_level, 'task %d failed: %s', wrapped_task_id, err, exc_info=True)
             raise
 
         return result
@@ -25,24 +47,118 @@ class TaskPool(object):
         task_id = len(self._tasks_args) + 1
         self._tasks_args.append((task_function, task_id, args, kwargs))
 
+    def _failed(self, task_args, error):
+        if self._on_error is None:
+            raise error
+
+        _, _, args, _ = task_args
+        self._on_error(args, error)
+
+    @staticmethod
+    def _guarded_task(task_args, failure_log_level=logging.ERROR):
+        try:
+            return True, TaskPool._task_function_wrapper(task_args, failure_log_level)
+
+        except Exception as err:
+            return False, err
+
     def execute(self):
+        # results in task order, None for the failed tasks
         logging.debug('processing %d tasks', len(self._tasks_args))
+        guarded_task = functools.partial(TaskPool._guarded_task, failure_log_level=self._failure_log_level)
         if self._pool_size == 1:
-            results = list()
-            for task_args in self._tasks_args:
-                result = TaskPool._task_function_wrapper(task_args)
-                results.append(result)
+            outcomes = [guarded_task(task_args) for task_args in self._tasks_args]
 
         else:
-            results = self._pool.map(TaskPool._task_function_wrapper, self._tasks_args)
+            pool = ThreadPool(self._pool_size)
+            outcomes = pool.map(guarded_task, self._tasks_args)
+            pool.close()
+            pool.join()
 
-        self._pool.close()
-        self._pool.join()
+        results = list()
+        for task_args, (success, result) in zip(self._tasks_args, outcomes):
+            if not success:
+                self._failed(task_args, result)
+                result = None
 
-        # serialized version below
-        #results = list()
-        #for task_function, task_id, args, kwargs in self._tasks_args:
-        #    result = task_function(*args, **kwargs)
-        #    results.append(result)
+            results.append(result)
 
         return results
+
+    @staticmethod
+    def _worker(tasks_queue, results_queue, failure_log_level):
+        while True:
+            item = tasks_queue.get()
+            if item is None:
+                break
+
+            task_args, queued = item
+            started = time.monotonic()
+            metrics.observe('hdb_taskpool_queue_wait_seconds', started - queued, pool='threads')
+            success, result = TaskPool._guarded_task(task_args, failure_log_level)
+            metrics.observe('hdb_taskpool_run_seconds', time.monotonic() - started, pool='threads')
+            results_queue.put((task_args, success, result))
+
+    def imap_unordered(self, task_function, args_iterable):
+        # streaming mode: argument tuples are pulled lazily from args_iterable and results are yielded
+        # as they complete, with at most max_pending tasks queued or running at any time
+        if self._pool_size == 1:
+            for task_id, args in enumerate(args_iterable, 1):
+                task_args = (task_function, task_id, args, {})
+                success, result = TaskPool._guarded_task(task_args, self._failure_log_level)
+                if not success:
+                    self._failed(task_args, result)
+                    continue
+
+                yield result
+
+            return
+
+        tasks_queue = queue.Queue(maxsize=self._max_pending)
+        results_queue = queue.Queue()
+        worker_args = (tasks_queue, results_queue, self._failure_log_level)
+        workers = [threading.Thread(target=TaskPool._worker, args=worker_args, daemon=True)
+                   for _ in range(self._pool_size)]
+        for worker in workers:
+            worker.start()
+
+        args_iterator = iter(args_iterable)
+        task_id = 0
+        pending = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and pending < self._max_pending:
+                    try:
+                        args = next(args_iterator)
+
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    task_id += 1
+                    tasks_queue.put(((task_function, task_id, args, {}), time.monotonic()))
+                    pending += 1
+
+                if pending == 0:
+                    break
+
+                task_args, success, result = results_queue.get()
+                pending -= 1
+                if not success:
+                    self._failed(task_args, result)
+                    continue
+
+                yield result
+
+        finally:
+            # drops queued tasks when the consumer stops early or a failure was raised
+            while True:
+                try:
+                    tasks_queue.get_nowait()
+
+                except queue.Empty:
+                    break
+
+            for _ in workers:
+                tasks_queue.put(None)
@@ -0,0 +1,380 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+import urllib.parse
+
+from hdb import metrics
+
+_THROTTLING_STATUSES = (429, 503)
+_WINDOW = 20
+_LATENCY_FACTOR = 2.
+_ERROR_THRESHOLD = 0.1
+_REPORT_INTERVAL = 10.
+
+_PROBE_INTERVAL = 0.5
+
+_RATE_LIMIT = None
+_BURST = None
+_ADAPTIVE = None
+# consecutive failures opening the circuit, first and longest pause in seconds
+_CIRCUIT_BREAKER = (10, 5., 60.)
+_endpoints_lock = threading.Lock()
+_endpoints = dict()
+
+
+class TokenBucket(object):
+    # requests per second with bursts of up to burst requests, shared by all the workers of an endpoint
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._capacity = float(burst or max(1., rate))
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # takes a token, returns the seconds to wait before it may be used
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= 1.
+            return 0. if self._tokens >= 0. else -self._tokens / self._rate
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AIMDController(object):
+    # concurrency limit of an endpoint: additive increase after each healthy window of requests,
+    # multiplicative decrease when the error rate or latency degrades or the server throttles
+
+    def __init__(self, name, initial, minimum, maximum, window=_WINDOW, latency_factor=_LATENCY_FACTOR,
+                 error_threshold=_ERROR_THRESHOLD, report_interval=_REPORT_INTERVAL):
+        self._name = name
+        self._limit = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._window = window
+        self._latency_factor = latency_factor
+        self._error_threshold = error_threshold
+        self._report_interval = report_interval
+        self._condition = threading.Condition()
+        self._async_waiters = list()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._samples = list()
+        self._since_decrease = window
+        self._baseline_latency = None
+        self._window_start = time.monotonic()
+        self._last_report = time.monotonic()
+        self._completed = 0
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def _try_acquire_locked(self):
+        if self._in_flight >= self._limit:
+            return False
+
+        self._in_flight += 1
+        self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        return True
+
+    def acquire(self):
+        with self._condition:
+            while not self._try_acquire_locked():
+                self._condition.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._try_acquire_locked():
+                    return
+
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+
+            await waiter
+
+    def _wake_waiters_locked(self):
+        self._condition.notify_all()
+        waiters = self._async_waiters
+        self._async_waiters = list()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _rate(self):
+        return self._completed / max(time.monotonic() - self._window_start, 1e-3)
+
+    def _set_limit_locked(self, limit, reason):
+        limit = max(self._minimum, min(self._maximum, limit))
+        if limit != self._limit:
+            logging.info('%s: concurrency %d -> %d (%s), %.1f req/s', self._name, self._limit, limit, reason,
+                         self._rate())
+            self._limit = limit
+
+        self._samples = list()
+        self._peak_in_flight = self._in_flight
+        self._window_start = time.monotonic()
+        self._completed = 0
+
+    def _decrease_locked(self, reason):
+        # a single decrease per window: requests already in flight report the same degradation
+        if self._since_decrease < self._window:
+            return
+
+        self._since_decrease = 0
+        self._set_limit_locked(self._limit // 2, reason)
+
+    def _adjust_locked(self):
+        latencies = sorted(latency for latency, _ in self._samples)
+        median_latency = latencies[len(latencies) // 2]
+        error_rate = float(sum(1 for _, success in self._samples if not success)) / len(self._samples)
+        if self._baseline_latency is None or median_latency < self._baseline_latency:
+            self._baseline_latency = median_latency
+
+        if error_rate > self._error_threshold:
+            self._decrease_locked('error rate %.0f%%' % (100 * error_rate))
+
+        elif median_latency > self._latency_factor * self._baseline_latency:
+            self._decrease_locked('median latency %.0fms above %.1fx baseline %.0fms' % (
+                1000 * median_latency, self._latency_factor, 1000 * self._baseline_latency))
+
+        elif self._peak_in_flight >= self._limit:
+            # only raised when the current limit is actually used
+            self._set_limit_locked(self._limit + 1, 'healthy: median latency %.0fms, error rate %.0f%%' % (
+                1000 * median_latency, 100 * error_rate))
+
+        else:
+            self._set_limit_locked(self._limit, 'unchanged')
+
+    def release(self, latency, success, throttled=False):
+        with self._condition:
+            self._in_flight -= 1
+            self._completed += 1
+            self._since_decrease += 1
+            self._samples.append((latency, success))
+            if throttled:
+                self._decrease_locked('throttled by server')
+
+            elif len(self._samples) >= self._window:
+                self._adjust_locked()
+
+            now = time.monotonic()
+            if now - self._last_report >= self._report_interval:
+                self._last_report = now
+                logging.info('%s: concurrency %d in flight, limit %d, %.1f req/s', self._name, self._in_flight,
+                             self._limit, self._rate())
+
+            self._wake_waiters_locked()
+
+
+class CircuitBreaker(object):
+    # pauses the requests to an endpoint while it keeps failing: the circuit opens after failure_threshold
+    # consecutive failures and, once the pause is over, lets a single probe request through; a successful
+    # probe closes the circuit, a failed one opens it again for twice as long (up to max_cooldown); requests
+    # sent before the circuit opened do not count once it is open
+
+    def __init__(self, name, failure_threshold, cooldown, max_cooldown):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = None
+        self._opened = None
+        self._current_cooldown = cooldown
+        self._probing = False
+
+    def wait_time(self):
+        # seconds to wait before asking again, 0 when the request may be sent
+        with self._lock:
+            if self._open_until is None:
+                return 0.
+
+            now = time.monotonic()
+            if now < self._open_until:
+                return self._open_until - now
+
+            if self._probing:
+                return _PROBE_INTERVAL
+
+            self._probing = True
+            return 0.
+
+    def _open_locked(self, reason):
+        self._opened = time.monotonic()
+        self._open_until = self._opened + self._current_cooldown
+        logging.warning('%s: circuit open for %.0fs (%s)', self._name, self._current_cooldown, reason)
+        metrics.count('hdb_circuit_breaker_open_total', endpoint=self._name)
+
+    def record(self, success, started):
+        # started: monotonic time at which the request was sent
+        with self._lock:
+            if self._open_until is not None and started < self._opened:
+                return
+
+            if success:
+                if self._open_until is not None:
+                    logging.info('%s: circuit closed', self._name)
+
+                self._failures = 0
+                self._open_until = None
+                self._current_cooldown = self._cooldown
+                self._probing = False
+                return
+
+            self._failures += 1
+            if self._probing:
+                self._probing = False
+                self._current_cooldown = min(2 * self._current_cooldown, self._max_cooldown)
+                self._open_locked('probe failed')
+
+            elif self._open_until is None and self._failures >= self._failure_threshold:
+                self._open_locked('%d consecutive failures' % self._failures)
+
+
+class _Endpoint(object):
+
+    def __init__(self, name):
+        self.bucket = TokenBucket(_RATE_LIMIT, _BURST) if _RATE_LIMIT else None
+        self.breaker = CircuitBreaker(name, *_CIRCUIT_BREAKER) if _CIRCUIT_BREAKER else None
+        self.controller = None
+        if _ADAPTIVE is not None:
+            initial, minimum, maximum = _ADAPTIVE
+            self.controller = AIMDController(name, initial, minimum, maximum)
+
+
+def set_rate_limit(rate, burst=None):
+    # requests per second allowed on each endpoint, None to disable
+    global _RATE_LIMIT, _BURST
+    with _endpoints_lock:
+        _RATE_LIMIT = rate
+        _BURST = burst
+        _endpoints.clear()
+
+
+def set_adaptive_concurrency(maximum, initial=None, minimum=1):
+    # per endpoint concurrency adapted between minimum and maximum, None to disable
+    global _ADAPTIVE
+    with _endpoints_lock:
+        _ADAPTIVE = None if maximum is None else (initial or max(minimum, maximum // 4), minimum, maximum)
+        _endpoints.clear()
+
+
+def set_circuit_breaker(failure_threshold, cooldown=5., max_cooldown=60.):
+    # per endpoint circuit breaker opened after failure_threshold consecutive failures, None to disable
+    global _CIRCUIT_BREAKER
+    with _endpoints_lock:
+        _CIRCUIT_BREAKER = None if not failure_threshold else (failure_threshold, cooldown, max_cooldown)
+        _endpoints.clear()
+
+
+def _endpoint(url):
+    if _RATE_LIMIT is None and _ADAPTIVE is None and _CIRCUIT_BREAKER is None:
+        return None
+
+    # last path segment, e.g. BC16SRetrievePropInfoXML
+    name = urllib.parse.urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+    with _endpoints_lock:
+        endpoint = _endpoints.get(name)
+        if endpoint is None:
+            endpoint = _Endpoint(name)
+            _endpoints[name] = endpoint
+
+        return endpoint
+
+
+def _is_throttling(error):
+    # requests.HTTPError carries the response, aiohttp.ClientResponseError the status
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status', None)
+    return status in _THROTTLING_STATUSES
+
+
+def _release(endpoint, start, success, throttled):
+    if endpoint.breaker is not None:
+        endpoint.breaker.record(success, start)
+
+    if endpoint.controller is not None:
+        endpoint.controller.release(time.monotonic() - start, success, throttled)
+
+
+@contextlib.contextmanager
+def request(url):
+    endpoint = _endpoint(url)
+    if endpoint is None:
+        yield
+        return
+
+    if endpoint.breaker is not None:
+        wait = endpoint.breaker.wait_time()
+        while wait > 0:
+            time.sleep(wait)
+            wait = endpoint.breaker.wait_time()
+
+    if endpoint.bucket is not None:
+        wait = endpoint.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    if endpoint.controller is not None:
+        endpoint.controller.acquire()
+
+    start = time.monotonic()
+    success = True
+    throttled = False
+    try:
+        yield
+
+    except Exception as error:
+        success = False
+        throttled = _is_throttling(error)
+        raise
+
+    finally:
+        _release(endpoint, start, success, throttled)
+
+
+@contextlib.asynccontextmanager
+async def request_async(url):
+    endpoint = _endpoint(url)
+    if endpoint is None:
+        yield
+        return
+
+    if endpoint.breaker is not None:
+        wait = endpoint.breaker.wait_time()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = endpoint.breaker.wait_time()
+
+    if endpoint.bucket is not None:
+        wait = endpoint.bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    if endpoint.controller is not None:
+        await endpoint.controller.acquire_async()
+
+    start = time.monotonic()
+    success = True
+    throttled = False
+    try:
+        yield
+
+    except Exception as error:
+        success = False
+        throttled = _is_throttling(error)
+        raise
+
+    finally:
+        _release(endpoint, start, success, throttled)
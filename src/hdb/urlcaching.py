@@ -1,192 +1,463 @@
+import atexit
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import logging
 import os
-
-import itertools
 import threading
+import time
 
-from datetime import datetime
-import requests
-import hashlib
+from hdb import cachearchive, cachecodec, metrics, throttle
+from hdb.cachestore import SQLiteCache, DirectoryTreeCache
 
 _CACHE_FILE_PATH = None
-_MAX_NODE_FILES = 0x400
-_REBALANCING_LIMIT = 0x1000
-
-
-_rebalancing = threading.Condition()
-
-
-def set_cache_http(cache_file_path):
-    global _CACHE_FILE_PATH
-    cache_file_path_full = os.path.abspath(cache_file_path)
+_SQLITE_FILE = 'cache.sqlite'
+_MIGRATION_BATCH_SIZE = 1000
+_DICTIONARY_SAMPLES = 2000
+_MAX_CACHE_SIZE = None
+_EVICTION_POLICY = 'lru'
+_MEMORY_CACHE_ENTRIES = 1024
+_TTL_RULES = list()
+_HTTP_POOL_SIZE = 10
+_HTTP_TIMEOUT = 60
+_REVALIDATE = False
+# validators of a cached response (ETag, Last-Modified, content hash) are cached under their own key
+_VALIDATORS_PREFIX = 'validators:'
+
+
+_cache = None
+_memory_lock = threading.Lock()
+_memory_cache = collections.OrderedDict()
+_counters_lock = threading.Lock()
+# counters of the live threads, and the sum of those of the threads that ended
+_thread_counters = dict()
+_ended_threads_counters = collections.Counter()
+_local = threading.local()
+_session_lock = threading.Lock()
+_session = None
+_in_flight_lock = threading.Lock()
+_in_flight = dict()
+
+
+def set_http_pool_size(pool_size):
+    global _HTTP_POOL_SIZE, _session
+    with _session_lock:
+        _HTTP_POOL_SIZE = pool_size
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            # imported on first use: cache-only commands do not pay for the HTTP stack
+            import requests
+            import requests.adapters
+            # one keep-alive connection per worker thread, shared across all requests
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=_HTTP_POOL_SIZE, pool_block=True)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+        return _session
+
+
+def _download(url):
+    with throttle.request(url):
+        response = _get_session().get(url, timeout=_HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+
+def _download_conditional(url, headers):
+    # (text, etag, last_modified) where text is None for a 304 Not Modified response
+    with throttle.request(url):
+        response = _get_session().get(url, headers=headers, timeout=_HTTP_TIMEOUT)
+        response.raise_for_status()
+        text = None if response.status_code == 304 else response.text
+        return text, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+def set_cache_http(cache_file_path, backend='sqlite', codec=None):
+    global _CACHE_FILE_PATH, _cache
+    cache_file_path_full = os.path.abspath(os.path.expanduser(cache_file_path))
     _CACHE_FILE_PATH = cache_file_path_full
     if not os.path.exists(_CACHE_FILE_PATH):
         os.makedirs(_CACHE_FILE_PATH)
 
-    logging.debug('setting cache path: %s', cache_file_path_full)
+    if _cache is not None:
+        _cache.close()
 
+    dictionary_data = _load_dictionary(cache_file_path_full)
+    if codec is None:
+        codec = 'zstd-dict' if dictionary_data is not None and cachecodec.zstandard is not None else 'zlib'
 
-def is_cache_used():
-    return _CACHE_FILE_PATH is not None
+    cachecodec.set_codec(codec, dictionary_data)
+    _cache = _open_backend(cache_file_path_full, backend)
+    _cache.set_max_size(_MAX_CACHE_SIZE, _EVICTION_POLICY)
+    with _memory_lock:
+        _memory_cache.clear()
 
+    logging.debug('setting cache path: %s (%s, %s)', cache_file_path_full, backend, codec)
 
-def _get_directories_under(path):
-    return (node for node in os.listdir(path) if os.path.isdir(os.path.join(path, node)))
 
+def _load_dictionary(cache_file_path):
+    dictionary_path = os.path.sep.join([cache_file_path, cachecodec._DICTIONARY_FILE])
+    if not os.path.exists(dictionary_path):
+        return None
 
-def _get_files_under(path):
-    return (node for node in os.listdir(path) if os.path.isfile(os.path.join(path, node)))
+    with open(dictionary_path, 'rb') as dictionary_file:
+        return dictionary_file.read()
 
 
-def _generator_count(a_generator):
-    return sum(1 for item in a_generator)
+def _open_backend(cache_file_path, backend):
+    if backend == 'sqlite':
+        legacy_index = os.path.sep.join([cache_file_path, 'index'])
+        if os.path.exists(legacy_index) and not os.path.exists(os.path.sep.join([cache_file_path, _SQLITE_FILE])):
+            logging.warning('found a directory-tree cache under %s: run hdbcachemigrate.py to import it', cache_file_path)
 
+        return SQLiteCache(os.path.sep.join([cache_file_path, _SQLITE_FILE]))
 
-def _divide_node(path, nodes_path):
-    level = len(nodes_path)
-    new_node_sup_init = 'FF' * 20
-    new_node_inf_init = '7F' + 'FF' * 19
-    if level > 0:
-        new_node_sup = nodes_path[-1]
-        new_node_diff = (int(new_node_sup_init, 16) - int(new_node_inf_init, 16)) >> level
-        new_node_inf = '%0.40X' % (int(new_node_sup, 16) - new_node_diff)
+    elif backend == 'tree':
+        return DirectoryTreeCache(cache_file_path)
 
     else:
-        new_node_sup = new_node_sup_init
-        new_node_inf = new_node_inf_init
+        raise ValueError('unknown cache backend: %s' % backend)
 
-    new_path_1 = os.path.sep.join([path] + nodes_path + [new_node_inf.lower()])
-    new_path_2 = os.path.sep.join([path] + nodes_path + [new_node_sup.lower()])
-    return os.path.abspath(new_path_1), os.path.abspath(new_path_2)
 
+@atexit.register
+def close_cache():
+    # a second call is a no-op, and later lookups go through the "cache not set" path
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
 
-def rebalance_cache_tree(path, nodes_path=None):
-    if not nodes_path:
-        nodes_path = list()
 
-    current_path = os.path.sep.join([path] + nodes_path)
-    files_node = _get_files_under(current_path)
-    rebalancing_required = _generator_count(itertools.islice(files_node, _MAX_NODE_FILES + 1)) > _MAX_NODE_FILES
-    if rebalancing_required:
-        new_path_1, new_path_2 = _divide_node(path, nodes_path)
-        logging.info('rebalancing required, creating nodes: %s and %s', os.path.abspath(new_path_1), os.path.abspath(new_path_2))
-        _rebalancing.acquire()
-        _rebalancing.wait()
-        if not os.path.exists(new_path_1):
-            os.makedirs(new_path_1)
+def is_cache_used():
+    return _cache is not None
 
-        if not os.path.exists(new_path_2):
-            os.makedirs(new_path_2)
 
-        for filename in _get_files_under(current_path):
-            file_path = os.path.sep.join([current_path, filename])
-            if file_path <= new_path_1:
-                logging.info('moving %s to %s', filename, new_path_1)
-                os.rename(file_path, os.path.sep.join([new_path_1, filename]))
+def set_cache_ttl(url_pattern, ttl_seconds):
+    # entries whose key contains url_pattern are treated as missing once older than ttl_seconds
+    global _TTL_RULES
+    _TTL_RULES = [(pattern, ttl) for pattern, ttl in _TTL_RULES if pattern != url_pattern]
+    _TTL_RULES.append((url_pattern, ttl_seconds))
 
-            else:
-                logging.info('moving %s to %s', filename, new_path_2)
-                os.rename(file_path, os.path.sep.join([new_path_2, filename]))
 
-        _rebalancing.release()
+def _ttl_for(key):
+    # most recently set rule wins
+    for pattern, ttl in reversed(_TTL_RULES):
+        if pattern in key:
+            return ttl
 
-    for directory in _get_directories_under(current_path):
-        rebalance_cache_tree(path, nodes_path + [directory])
+    return None
 
 
-def find_node(digest, path=None):
-    if not path:
-        path = _CACHE_FILE_PATH
+def set_cache_revalidation(enabled):
+    # expired entries are revalidated with a conditional request (If-None-Match, If-Modified-Since) instead of
+    # being downloaded again; a 304 response or a body with the same content hash reports them as unchanged
+    global _REVALIDATE
+    _REVALIDATE = enabled
 
-    directories = sorted(_get_directories_under(path))
 
-    if not directories:
-        return path
+def set_cache_max_size(max_size, eviction_policy='lru'):
+    global _MAX_CACHE_SIZE, _EVICTION_POLICY
+    _MAX_CACHE_SIZE = max_size
+    _EVICTION_POLICY = eviction_policy
+    if _cache is not None:
+        _cache.set_max_size(max_size, eviction_policy)
 
-    else:
-        target_directory = None
-        for directory_name in directories:
-            if digest <= directory_name:
-                target_directory = directory_name
-                break
 
-        if not target_directory:
-            raise Exception('Inconsistent cache tree')
+def set_memory_cache_size(entries):
+    global _MEMORY_CACHE_ENTRIES
+    with _memory_lock:
+        _MEMORY_CACHE_ENTRIES = entries
+        while len(_memory_cache) > _MEMORY_CACHE_ENTRIES:
+            _memory_cache.popitem(last=False)
 
-        return find_node(digest, path=os.path.sep.join([path, target_directory]))
 
+def _fold_ended_threads():
+    # called with _counters_lock held: worker threads come and go with each stage, their counters must not
+    # accumulate for the life of the process
+    for thread in [thread for thread in _thread_counters if not thread.is_alive()]:
+        _ended_threads_counters.update(dict(_thread_counters.pop(thread)))
 
-def get_cache_filename(key):
-    hash_md5 = hashlib.md5()
-    hash_md5.update(key.encode('utf-8'))
-    digest = hash_md5.hexdigest()
-    target_node = find_node(digest)
-    cache_filename = os.sep.join([target_node, digest])
-    return cache_filename
 
+def _count(counter):
+    # per-thread counters, summed on demand: counting a hit takes no lock
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = collections.Counter()
+        _local.counters = counters
+        with _counters_lock:
+            _fold_ended_threads()
+            _thread_counters[threading.current_thread()] = counters
+
+    counters[counter] += 1
+
+
+def cache_counters():
+    with _counters_lock:
+        _fold_ended_threads()
+        counters = collections.Counter(_ended_threads_counters)
+        for thread_counters in _thread_counters.values():
+            counters.update(dict(thread_counters))
+
+    counters = dict(counters)
+    counters['evictions'] = _cache.evictions if _cache is not None else 0
+    return counters
 
-def is_cached(key):
-    cache_filename = get_cache_filename(key)
-    return os.path.exists(cache_filename)
 
+def _is_expired(key, stored_at):
+    ttl = _ttl_for(key)
+    return ttl is not None and time.time() - stored_at > ttl
 
-def file_size(filename):
-    count = -1
-    with open(filename) as file_lines:
-        for count, line in enumerate(file_lines):
+
+def _lookup(key, count=True):
+    # no lock on the read path: single OrderedDict operations are atomic, and only writers (_remember,
+    # set_memory_cache_size) take _memory_lock to keep the size bound
+    entry = _memory_cache.get(key)
+    if entry is not None:
+        try:
+            _memory_cache.move_to_end(key)
+
+        except KeyError:
+            # evicted in the meantime
             pass
 
-    return count + 1
+        if not _is_expired(key, entry[1]):
+            if count:
+                _count('memory_hits')
 
+            return entry[0]
 
-def _add_to_cache(key, value):
-    _rebalancing.acquire()
-    try:
-        logging.debug('adding to cache: %s', key)
-        filename = get_cache_filename(key)
-        index_name = os.path.sep.join([_CACHE_FILE_PATH, 'index'])
-        today = datetime.today().strftime('%Y%m%d')
-        with open(filename, 'w') as cache_content:
-            cache_content.write(value)
+        _memory_cache.pop(key, None)
 
-        with open(index_name, 'a') as index_file:
-            filename_digest = filename.split(os.path.sep)[-1]
-            index_file.write('%s %s: "%s"\n' % (today, filename_digest, key))
+    entry = _cache.get_entry(key)
+    if entry is None:
+        if count:
+            _count('misses')
 
-    finally:
-        _rebalancing.notify_all()
-        _rebalancing.release()
+        return None
+
+    if _is_expired(key, entry[1]):
+        if count:
+            _count('expired')
+
+        return None
+
+    if count:
+        _count('disk_hits')
+
+    _remember(key, entry)
+    return entry[0]
 
-    if file_size(index_name) % _REBALANCING_LIMIT == 0:
-        logging.debug('rebalancing cache')
-        rebalance_cache_tree(_CACHE_FILE_PATH)
+
+def _remember(key, entry):
+    with _memory_lock:
+        _memory_cache[key] = entry
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > _MEMORY_CACHE_ENTRIES:
+            _memory_cache.popitem(last=False)
+
+
+def is_cached(key):
+    return _lookup(key, count=False) is not None
+
+
+def _add_to_cache(key, value):
+    metrics.debug_sampled('adding to cache: %s', key)
+    _cache.put(key, value)
+    _remember(key, (value, time.time()))
+    _count('writes')
 
 
 def _get_from_cache(key):
-    _rebalancing.acquire()
+    logging.debug('reading from cache: %s', key)
+    return _lookup(key)
+
+
+def train_cache_dictionary(sample_count=_DICTIONARY_SAMPLES):
+    # the dictionary is only used for entries written after training, older entries keep their codec
+    samples = [value for _, value, _ in itertools.islice(_cache.items(), sample_count)]
+    dictionary_data = cachecodec.train_dictionary(samples)
+    dictionary_path = os.path.sep.join([_CACHE_FILE_PATH, cachecodec._DICTIONARY_FILE])
+    with open(dictionary_path, 'wb') as dictionary_file:
+        dictionary_file.write(dictionary_data)
+
+    cachecodec.set_codec('zstd-dict', dictionary_data)
+    logging.info('saved %d bytes compression dictionary under %s', len(dictionary_data), dictionary_path)
+
+
+def cache_stats():
+    entries, raw_bytes, stored_bytes = _cache.stats()
+    return {
+        'entries': entries,
+        'raw_bytes': raw_bytes,
+        'stored_bytes': stored_bytes,
+        'compression_ratio': float(raw_bytes) / stored_bytes if stored_bytes else 1.,
+        'saved_bytes': raw_bytes - stored_bytes,
+    }
+
+
+def export_cache(archive_path):
+    _cache.flush()
+    return cachearchive.export_archive(_cache, archive_path)
+
+
+def import_cache(archive_path):
+    # merges an exported archive into the cache, e.g. to prewarm it before a crawl: newest entries win
+    written = cachearchive.import_archive(_cache, archive_path)
+    with _memory_lock:
+        _memory_cache.clear()
+
+    return written
+
+
+def migrate_cache_tree(tree_path, target_path=None):
+    tree_path = os.path.abspath(os.path.expanduser(tree_path))
+    if target_path is None:
+        target_path = os.path.sep.join([tree_path, _SQLITE_FILE])
+
+    source = DirectoryTreeCache(tree_path)
+    target = SQLiteCache(target_path)
+    batch = list()
+    count = 0
+    for key, value, created in source.items():
+        batch.append((key, value, created))
+        if len(batch) == _MIGRATION_BATCH_SIZE:
+            target.put_many(batch)
+            count += len(batch)
+            logging.info('migrated %d entries', count)
+            batch = list()
+
+    target.put_many(batch)
+    count += len(batch)
+    target.close()
+    logging.info('migrated %d entries from %s to %s', count, tree_path, target_path)
+    return count
+
+
+def open_url(url):
+    return open_url_checked(url)[0]
+
+
+def open_url_checked(url):
+    # (content, modified): modified is False when the expired cache entry of the url was revalidated as
+    # unchanged, i.e. the content is the one of its previous download
+    # concurrent requests for the same url share a single download
+    with _in_flight_lock:
+        future = _in_flight.get(url)
+        owner = future is None
+        if owner:
+            future = concurrent.futures.Future()
+            _in_flight[url] = future
+
+    if not owner:
+        _count('coalesced')
+        return future.result()
+
     try:
-        logging.debug('reading from cache: %s', key)
-        with open(get_cache_filename(key), 'r') as cache_content:
-            content = cache_content.read()
+        result = _open_url(url)
+        future.set_result(result)
+        return result
+
+    except BaseException as error:
+        future.set_exception(error)
+        raise
 
     finally:
-        _rebalancing.notify_all()
-        _rebalancing.release()
+        with _in_flight_lock:
+            del _in_flight[url]
 
-    return content
 
+def _content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 
-def open_url(url):
-    logging.debug('opening url: %s', url)
-    if is_cache_used():
-        if not is_cached(url):
-            content = requests.get(url).text
-            _add_to_cache(url, content)
 
-        content = _get_from_cache(url)
+def _revalidation_request(url):
+    # (stale content, validators, conditional request headers) for the expired or missing entry of the url
+    entry = _cache.get_entry(url)
+    if entry is None:
+        return None, None, {}
+
+    validators_entry = _cache.get_entry(_VALIDATORS_PREFIX + url)
+    if validators_entry is None:
+        # cached before revalidation was enabled: only the content hash can be compared
+        return entry[0], None, {}
+
+    validators = json.loads(validators_entry[0])
+    headers = dict()
+    if validators['etag']:
+        headers['If-None-Match'] = validators['etag']
+
+    if validators['last_modified']:
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    return entry[0], validators, headers
+
+
+def _store_revalidated(url, stale, validators, content, etag, last_modified):
+    # caches the response of a conditional request along with its validators, a None content being a 304
+    # for the stale entry; returns (content, modified)
+    if content is None:
+        if stale is None:
+            raise ValueError('304 Not Modified without a cached entry: %s' % url)
+
+        content = stale
+        modified = False
+        etag = etag or validators['etag']
+        last_modified = last_modified or validators['last_modified']
+        _count('revalidated')
 
     else:
-        # straight access
-        content = requests.get(url).text
+        content_hash = _content_hash(content)
+        previous_hash = validators['hash'] if validators is not None else stale and _content_hash(stale)
+        modified = content_hash != previous_hash
+        if not modified:
+            _count('unchanged')
+
+    # rewriting the entry restarts its TTL
+    _add_to_cache(url, content)
+    _cache.put(_VALIDATORS_PREFIX + url, json.dumps({'etag': etag, 'last_modified': last_modified,
+                                                     'hash': _content_hash(content)}))
+    return content, modified
+
+
+def _revalidate(url):
+    start = time.monotonic()
+    stale, validators, headers = _revalidation_request(url)
+    content, etag, last_modified = _download_conditional(url, headers)
+    source = 'network' if content is not None else 'revalidated'
+    content, modified = _store_revalidated(url, stale, validators, content, etag, last_modified)
+    metrics.observe('hdb_open_url_seconds', time.monotonic() - start, source=source)
+    metrics.count('hdb_open_url_bytes_total', len(content), source=source)
+    return content, modified
+
+
+def _open_url(url):
+    metrics.debug_sampled('opening url: %s', url)
+    if is_cache_used():
+        start = time.monotonic()
+        content = _get_from_cache(url)
+        if content is not None:
+            metrics.observe('hdb_open_url_seconds', time.monotonic() - start, source='cache')
+            metrics.count('hdb_open_url_bytes_total', len(content), source='cache')
+            return content, True
+
+        if _REVALIDATE:
+            return _revalidate(url)
+
+    start = time.monotonic()
+    content = _download(url)
+    metrics.observe('hdb_open_url_seconds', time.monotonic() - start, source='network')
+    metrics.count('hdb_open_url_bytes_total', len(content), source='network')
+    if is_cache_used():
+        _add_to_cache(url, content)
 
-    return content
+    return content, True
@@ -0,0 +1,173 @@
+import re
+import threading
+
+from lxml import etree
+
+from hdb.records import Lease, Units
+
+_local = threading.local()
+_POSTAL_CODE_FORMAT = re.compile(r'[0-9]{6}')
+
+
+def _named(tag_name):
+    # namespace-agnostic element matching, in the same way BeautifulSoup matched tag names
+    return "*[local-name()='%s']" % tag_name
+
+
+_BLOCK = etree.XPath('(//%s)[1]' % _named('Block'))
+_STREET_NAME = etree.XPath('(//%s)[1]' % _named('StreetName'))
+_POSTAL_CODE = etree.XPath('(//%s)[1]' % _named('PostalCode'))
+_RESIDENT_UNITS = etree.XPath('//%s' % _named('ResidentUnit'))
+# first match at or after the unit in document order, like BeautifulSoup's find_next
+_UNIT_ROOM_TYPE = etree.XPath('(descendant::%s | following::%s)[1]' % (_named('actUseTypTxt'), _named('actUseTypTxt')))
+_UNIT_COUNT = etree.XPath('(descendant::%s | following::%s)[1]' % (_named('count'), _named('count')))
+_LEASE_INFORMATION = etree.XPath('(//%s)[1]' % _named('LeaseInformation'))
+_LEASE_COMMENCED = etree.XPath('(descendant::%s)[1]' % _named('LeaseCommencedDate'))
+_LEASE_REMAINING = etree.XPath('(descendant::%s)[1]' % _named('LeaseRemaining'))
+_LEASE_PERIOD = etree.XPath('(descendant::%s)[1]' % _named('LeasePeriod'))
+_SELLER_RESULTS = etree.XPath('(//%s)[1]' % _named('sellerResults'))
+_BUYER_RESULTS_COMMENT = etree.XPath('(//%s)[1]' % _named('buyerResultsTableHeading2'))
+_BUYER_RESULTS = etree.XPath('(//%s)[1]' % _named('buyerResults'))
+
+
+def _parser():
+    # lxml parsers must not be shared between threads
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = etree.XMLParser(recover=True, encoding='utf-8', resolve_entities=False, no_network=True)
+        _local.parser = parser
+
+    return parser
+
+
+def parse_document(xml_text):
+    if isinstance(xml_text, str):
+        xml_text = xml_text.encode('utf-8')
+
+    if not xml_text.strip():
+        return None
+
+    root = etree.fromstring(xml_text, _parser())
+    if root is None:
+        return None
+
+    return root.getroottree()
+
+
+def _first(xpath, node):
+    if node is None:
+        return None
+
+    matches = xpath(node)
+    if not matches:
+        return None
+
+    return matches[0]
+
+
+def _has_contents(element):
+    return element.text is not None or len(element) > 0
+
+
+def _leading_text(element):
+    return (element.text or '').strip()
+
+
+def _required_text(element, tag_name):
+    if element is None or not _has_contents(element):
+        raise ValueError('missing content for tag %s' % tag_name)
+
+    return _leading_text(element)
+
+
+def _optional_text(element):
+    if element is None or not _has_contents(element):
+        return ''
+
+    return _leading_text(element)
+
+
+def checked_postal_code(postal_code):
+    # postal codes are stored as 6 ASCII digits
+    if not isinstance(postal_code, str) or not _POSTAL_CODE_FORMAT.fullmatch(postal_code):
+        raise ValueError('invalid postal code %r' % (postal_code,))
+
+    return postal_code
+
+
+def _room_count(text, postal_code):
+    try:
+        return int(text)
+
+    except ValueError:
+        raise ValueError('invalid unit count %r for postal code %s' % (text, postal_code))
+
+
+def parse_prop_info(xml_text):
+    document = parse_document(xml_text)
+    block_tag = _first(_BLOCK, document)
+    if block_tag is None or not _has_contents(block_tag):
+        return None
+
+    block = _leading_text(block_tag)
+    street_name = _required_text(_first(_STREET_NAME, document), 'StreetName')
+    postal_code = checked_postal_code(_required_text(_first(_POSTAL_CODE, document), 'PostalCode'))
+    return block, street_name, postal_code
+
+
+def parse_residential_units(postal_code, xml_text):
+    postal_code = checked_postal_code(postal_code)
+    document = parse_document(xml_text)
+    if document is None:
+        return list()
+
+    unit_data = list()
+    for unit in _RESIDENT_UNITS(document):
+        room_type_tag = _first(_UNIT_ROOM_TYPE, unit)
+        count_tag = _first(_UNIT_COUNT, unit)
+        if room_type_tag is None or count_tag is None:
+            raise ValueError('incomplete ResidentUnit for postal code %s' % postal_code)
+
+        room_type = ''
+        room_count = 0
+        if _has_contents(room_type_tag):
+            room_type = _leading_text(room_type_tag)
+
+        if _has_contents(count_tag):
+            room_count = _room_count(_leading_text(count_tag), postal_code)
+
+        unit_data.append(Units(postal_code, room_type, room_count))
+
+    return unit_data
+
+
+def parse_lease_data(postal_code, xml_text):
+    postal_code = checked_postal_code(postal_code)
+    lease_info = _first(_LEASE_INFORMATION, parse_document(xml_text))
+    if lease_info is None:
+        raise ValueError('missing LeaseInformation for postal code %s' % postal_code)
+
+    lease_commenced = ''
+    lease_commenced_tag = _first(_LEASE_COMMENCED, lease_info)
+    if lease_commenced_tag is not None:
+        lease_commenced = _required_text(lease_commenced_tag, 'LeaseCommencedDate')
+
+    lease_remaining = ''
+    lease_remaining_tag = _first(_LEASE_REMAINING, lease_info)
+    if lease_remaining_tag is not None:
+        lease_remaining = _required_text(lease_remaining_tag, 'LeaseRemaining')
+
+    lease_period = ''
+    lease_period_tag = _first(_LEASE_PERIOD, lease_info)
+    if lease_period_tag is not None:
+        lease_period = _required_text(lease_period_tag, 'LeasePeriod')
+
+    return Lease(postal_code, lease_commenced, lease_remaining, lease_period)
+
+
+def parse_ethnic_result(xml_text):
+    document = parse_document(xml_text)
+    seller_results = _optional_text(_first(_SELLER_RESULTS, document))
+    buyer_results_comment = _optional_text(_first(_BUYER_RESULTS_COMMENT, document))
+    buyer_results = _optional_text(_first(_BUYER_RESULTS, document))
+    return seller_results, buyer_results, buyer_results_comment